@@ -0,0 +1,57 @@
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import sys
+import tempfile
+import time
+
+# If bench_patches.py is moved from dev dir please update
+HOME = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, HOME)
+
+from pyupdater.utils.diff_engines import get_engine, get_engine_names  # noqa
+
+
+def bench(src_path, dst_path, names):
+    print('{:<10} {:>12} {:>10} {:>10}'.format(
+        'engine', 'patch bytes', 'diff s', 'patch s'))
+    tmp = tempfile.mkdtemp()
+    for name in names:
+        engine = get_engine(name)
+        if engine is None:
+            print('{:<10} not installed'.format(name))
+            continue
+        patch_path = os.path.join(tmp, name + '.patch')
+        out_path = os.path.join(tmp, name + '.out')
+
+        start = time.time()
+        engine.diff(src_path, dst_path, patch_path)
+        diff_time = time.time() - start
+
+        with open(patch_path, 'rb') as f:
+            patch = f.read()
+        start = time.time()
+        engine.patch_file(src_path, patch, out_path)
+        patch_time = time.time() - start
+
+        with open(out_path, 'rb') as f, open(dst_path, 'rb') as g:
+            ok = f.read() == g.read()
+        print('{:<10} {:>12} {:>10.2f} {:>10.2f}{}'.format(
+            name, len(patch), diff_time, patch_time,
+            '' if ok else '  BAD OUTPUT'))
+        os.remove(patch_path)
+        os.remove(out_path)
+    os.rmdir(tmp)
+
+
+def main():
+    if len(sys.argv) < 3:
+        print('Usage: bench_patches.py <old archive> <new archive> '
+              '[engine ...]')
+        sys.exit(1)
+    bench(sys.argv[1], sys.argv[2], sys.argv[3:] or get_engine_names())
+
+
+if __name__ == '__main__':
+    main()
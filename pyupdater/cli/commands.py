@@ -35,12 +35,15 @@ from pyupdater.builder import Builder, ExternalLib
 from pyupdater.cli.helpers import (initial_setup,
                                    print_plugin_settings,
                                    setup_client_config_path,
+                                   setup_chunk_size,
+                                   setup_patch_bases,
                                    setup_company,
                                    setup_max_download_retries,
                                    setup_patches,
                                    setup_plugin,
                                    setup_urls)
 from pyupdater.key_handler.keys import Keys, KeyImporter
+from pyupdater.server import UpdateServer
 from pyupdater.utils import check_repo, get_http_pool, PluginManager
 from pyupdater.utils.config import Config, ConfigManager
 from pyupdater.utils.exceptions import UploaderError, UploaderPluginError
@@ -166,6 +169,14 @@ def _cmd_settings(*args):  # pragma: no cover
     if ns.patches is True:
         setup_patches(config)
 
+    # Size of the chunks hashed for partial re-downloads
+    if ns.chunk_size is True:
+        setup_chunk_size(config)
+
+    # Number of previous releases patches are made from
+    if ns.patch_bases is True:
+        setup_patch_bases(config)
+
     # Setup config for requested upload plugin
     if ns.plugin is not None:
         setup_plugin(ns.plugin, config)
@@ -435,6 +446,32 @@ def _cmd_upload(*args):  # pragma: no cover
         log.error(err)
 
 
+# Serve the deploy folder, or any folder, over http
+def _cmd_serve(*args):  # pragma: no cover
+    ns = args[0]
+
+    origin = list(ns.origin or [])
+    root = ns.dir
+    if root is None or ns.proxy is True:
+        check_repo_ex(exit_on_error=True)
+    if root is None:
+        root = os.path.join(os.getcwd(), settings.USER_DATA_FOLDER, 'deploy')
+    if ns.proxy is True:
+        cm = ConfigManager()
+        origin.extend(cm.load_config().get('UPDATE_URLS') or [])
+
+    if not os.path.isdir(root) and len(origin) == 0:
+        log.error('%s is not a directory', root)
+        return
+
+    server = UpdateServer(root, host=ns.host, port=ns.port, origin=origin,
+                          manifest_ttl=ns.manifest_ttl)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
+
+
 # Print the version of PyUpdater to the console.
 def _cmd_version(*args):
     print('PyUpdater {}'.format(__version__))
@@ -105,6 +105,50 @@ def setup_max_download_retries(config):  # pragma: no cover
     config.MAX_DOWNLOAD_RETRIES = temp
 
 
+def setup_chunk_size(config):  # pragma: no cover
+    default = config.get('UPDATE_CHUNK_SIZE', 0)
+    while 1:
+        temp = terminal.get_correct_answer('Enter bytes per chunk hash. '
+                                           '0 disables chunk hashes',
+                                           required=True, default=str(default))
+        try:
+            temp = int(temp)
+        except Exception as err:
+            log.error(err)
+            log.debug(err, exc_info=True)
+            continue
+
+        if temp < 0:
+            log.error('Chunk size cannot be negative')
+            continue
+
+        break
+
+    config.UPDATE_CHUNK_SIZE = temp
+
+
+def setup_patch_bases(config):  # pragma: no cover
+    default = config.get('UPDATE_PATCH_BASES', 1)
+    while 1:
+        temp = terminal.get_correct_answer('Enter number of previous '
+                                           'releases to make patches from',
+                                           required=True, default=str(default))
+        try:
+            temp = int(temp)
+        except Exception as err:
+            log.error(err)
+            log.debug(err, exc_info=True)
+            continue
+
+        if temp < 1:
+            log.error('Need at least 1 release to make patches from')
+            continue
+
+        break
+
+    config.UPDATE_PATCH_BASES = temp
+
+
 def setup_patches(config):  # pragma: no cover
     question = 'Would you like to enable patch updates?'
     config.UPDATE_PATCHES = terminal.ask_yes_no(question, default='yes')
@@ -185,6 +185,12 @@ def add_settings_parser(subparsers):
                                  action='store_true')
     settings_parser.add_argument('--patches', help='Changed patch support',
                                  action='store_true')
+    settings_parser.add_argument('--chunk-size', help='Change the size of '
+                                 'chunks hashed for partial re-downloads',
+                                 action='store_true', dest='chunk_size')
+    settings_parser.add_argument('--patch-bases', help='Change the number '
+                                 'of previous releases patches are made from',
+                                 action='store_true', dest='patch_bases')
     settings_parser.add_argument('--plugin', help='Change the named plugin\'s '
                                  'settings', dest='plugin')
     settings_parser.add_argument('--show-plugin', help='Show the name '
@@ -194,6 +200,27 @@ def add_settings_parser(subparsers):
                                  action='store_true')
 
 
+def add_serve_parser(subparsers):
+    serve_parser = subparsers.add_parser('serve', help='Serves updates over '
+                                         'http')
+    serve_parser.add_argument('--dir', help='Folder to serve. Defaults to '
+                              'the deploy folder', dest='dir')
+    serve_parser.add_argument('--host', help='Address to listen on',
+                              default='')
+    serve_parser.add_argument('-p', '--port', help='Port to listen on',
+                              type=int, default=8000)
+    serve_parser.add_argument('--origin', help='Update url to proxy & '
+                              'cache. Can be used more than once',
+                              action='append', dest='origin')
+    serve_parser.add_argument('--proxy', help='Proxy & cache the update '
+                              'urls of the repo', action='store_true')
+    serve_parser.add_argument('--manifest-ttl', help='Seconds proxied '
+                              'version & key files, & files missing from the '
+                              'version manifest, are used before checking '
+                              'the origin for changes', type=int, default=60,
+                              dest='manifest_ttl')
+
+
 def add_upload_parser(subparsers):
     upload_parser = subparsers.add_parser('upload', help='Uploads files')
     upload_parser.add_argument('--keep', help='Keep files after upload',
@@ -219,6 +246,7 @@ def get_parser():
     add_make_spec_parser(subparsers)
     add_package_parser(subparsers)
     add_plugin_parser(subparsers)
+    add_serve_parser(subparsers)
     add_settings_parser(subparsers)
     add_upload_parser(subparsers)
     add_version_parser(subparsers)
@@ -23,26 +23,31 @@
 # OR OTHER DEALINGS IN THE SOFTWARE.
 # ------------------------------------------------------------------------------
 from __future__ import unicode_literals
-import gzip
 import json
 import logging
 import os
+import threading
 import warnings
+import zlib
 
 import appdirs
 from dsdev_utils.app import FROZEN
 from dsdev_utils.helpers import (EasyAccessDict as _EAD,
-                                 gzip_decompress as _gzip_decompress,
                                  Version as _Version)
 from dsdev_utils.logger import logging_formatter
-from dsdev_utils.paths import app_cwd, ChDir as _ChDir
+from dsdev_utils.paths import app_cwd
 from dsdev_utils.system import get_system as _get_system
 import ed25519
 import six
 
 from pyupdater import settings, __version__
-from pyupdater.client.downloader import FileDownloader as _FD
+from pyupdater.client.downloader import (create_http_pool as _create_pool,
+                                         FileDownloader as _FD,
+                                         RateLimiter as _RateLimiter)
+from pyupdater.client.cache import DownloadCache as _DownloadCache
+from pyupdater.client.mirrors import MirrorSelector as _MirrorSelector
 from pyupdater.client.updates import AppUpdate, _get_highest_version, LibUpdate
+from pyupdater.utils import JSONStore as _JSONStore
 from pyupdater.utils.config import Config as _Config
 from pyupdater.utils.exceptions import ClientError
 
@@ -83,6 +88,11 @@ class Client(object):
     test (bool): Used to initialize a test client
 
     """
+
+    # Update objects returned by update_check
+    _app_update_class = AppUpdate
+    _lib_update_class = LibUpdate
+
     def __init__(self, obj, **kwargs):
 
         refresh = kwargs.get('refresh')
@@ -190,6 +200,33 @@ class Client(object):
         # Max number of download retries
         self.max_download_retries = config.get('MAX_DOWNLOAD_RETRIES')
 
+        # Number of concurrent connections used for full update downloads
+        self.download_segments = config.get('DOWNLOAD_SEGMENTS')
+
+        # Number of patches downloaded while earlier ones are applied
+        self.patch_downloads = config.get('PATCH_DOWNLOADS', 4)
+
+        # Hash & write full update downloads on worker threads
+        self.download_pipeline = config.get('DOWNLOAD_PIPELINE', False)
+
+        # Start the full download when a patch update falls behind
+        self.hedged_updates = config.get('HEDGED_UPDATES', False)
+
+        # Percent of patches applied by that share of the expected time
+        self.hedge_milestone = config.get('HEDGE_MILESTONE', 50)
+
+        # Seconds a patch update may take when its time can't be estimated
+        self.hedge_timeout = config.get('HEDGE_TIMEOUT', 30)
+
+        # Min seconds between download progress events
+        self.progress_interval = config.get('PROGRESS_INTERVAL', 0.1)
+
+        # Verified downloads shared by all apps on this machine.
+        # True for the default location or a path to a folder.
+        self.download_cache = Client._create_download_cache(
+            config.get('DOWNLOAD_CACHE'),
+            config.get('DOWNLOAD_CACHE_SIZE', settings.DOWNLOAD_CACHE_SIZE))
+
         # The name of the version file to download
         self.version_file = settings.VERSION_FILE_FILENAME
 
@@ -199,15 +236,37 @@ class Client(object):
         # urllib3 headers
         self.urllib3_headers = obj.URLLIB3_HEADERS
 
+        # Connection pool used by every download of this session.
+        # Keeps connections to the update server alive between files.
+        self.http_pool = _create_pool(self.verify is True,
+                                      self.urllib3_headers,
+                                      maxsize=max(self.download_segments or 1,
+                                                  self.patch_downloads or 1,
+                                                  4))
+
+        # Download speed limit in bytes per second shared by every
+        # download of this session. Change with set_download_rate.
+        self.rate_limiter = _RateLimiter(config.get('DOWNLOAD_RATE_LIMIT'))
+
         # Creating data & update directories
         self._setup()
 
+        # ETag & Last-Modified of the version & key files kept in data_dir
+        self._http_cache = _JSONStore(
+            os.path.join(self.data_dir, settings.HTTP_CACHE_FILENAME))
+        self._http_cache_lock = threading.Lock()
+
+        # Ranks update urls by speed & health. Ranking is kept in data_dir
+        self._mirrors = _MirrorSelector(self.update_urls, self.data_dir,
+                                        self.http_pool)
+
         if refresh is True:
             self.refresh()
     # End ToDo
 
     def refresh(self):
         """Will download and verify the version manifest."""
+        self._rank_mirrors()
         self._get_signing_key()
         self._get_update_manifest()
 
@@ -305,8 +364,19 @@ class Client(object):
             'app_name': self.app_name,
             'verify': self.verify,
             'max_download_retries': self.max_download_retries,
+            'download_segments': self.download_segments,
+            'download_pipeline': self.download_pipeline,
+            'patch_downloads': self.patch_downloads,
+            'hedged_updates': self.hedged_updates,
+            'hedge_milestone': self.hedge_milestone,
+            'hedge_timeout': self.hedge_timeout,
+            'progress_interval': self.progress_interval,
+            'download_cache': self.download_cache,
             'progress_hooks': list(set(self.progress_hooks)),
             'urllib3_headers': self.urllib3_headers,
+            'http_pool': self.http_pool,
+            'rate_limiter': self.rate_limiter,
+            'mirrors': self._mirrors,
         }
 
         # Return update object with which handles downloading,
@@ -314,9 +384,9 @@ class Client(object):
         if app is True:
             # AppUpdate is a subclass of LibUpdate that add methods
             # to restart the application
-            return AppUpdate(data)
+            return self._app_update_class(data)
         else:
-            return LibUpdate(data)
+            return self._lib_update_class(data)
 
     def add_progress_hook(self, cb):
         """Add a download progress callback function to the list of progress
@@ -330,17 +400,50 @@ class Client(object):
 
         status: Status of download
 
+        percent: The percentage downloaded so far as a float. None if
+        the total size is unknown
+
+        rate: Download speed in bytes per second
+
+        eta: Seconds until the download is finished. None if unknown
+
+        Hooks are called from a background thread at most every
+        PROGRESS_INTERVAL seconds or every 1% downloaded.
+
         Args:
 
         cb (function): Function which takes a dict as its first argument
         """
         self.progress_hooks.append(cb)
 
+    def set_download_rate(self, rate):
+        """Limits the combined speed of all downloads. Also applies to
+        downloads already in progress.
+
+        ######Args:
+
+        rate (int): Max bytes per second. None for unlimited
+        """
+        self.rate_limiter.set_rate(rate)
+
+    # Puts the fastest healthy mirror first. Mirrors are only probed
+    # when the saved ranking is out of date.
+    def _rank_mirrors(self):
+        if len(self._mirrors.urls) < 2:
+            return
+        if self._mirrors.needs_probe():
+            self._mirrors.probe()
+        self.update_urls = self._mirrors.get_urls()
+        log.debug('Mirror order: %s', self.update_urls)
+
     def _get_signing_key(self):
 
         # Here we will download the keys.gz file, decompress it then return
         # its contents. If an error happens you'll get None.
-        key_data_str = self._get_key_data()
+        self._load_signing_key(self._get_key_data())
+
+    # Verifies the downloaded key data & sets self.app_key
+    def _load_signing_key(self, key_data_str):
         if key_data_str is None:
             return
 
@@ -378,93 +481,126 @@ class Client(object):
     # in case of no Internet connection. Useful when an update
     # needs to be installed without an network connection
     def _get_manifest_from_disk(self):
-        with _ChDir(self.data_dir):
-            # This could be the first run or an accidental deletion of the
-            # cached version manifest.
-            if not os.path.exists(self.version_file):
-                log.debug('No version file on file system')
-                return None
-            else:
-                log.debug('Found version file on file system')
-                # Attempt to open the cached version file
-                try:
-                    with open(self.version_file, 'rb') as f:
-                        data = f.read()
-                    log.debug('Loaded version file from file system')
-                except Exception as err:
-                    log.debug('Failed to load version file from file '
-                              'system')
-                    log.debug(err, exc_info=True)
-                    return None
-
-                # Attempt the decompress
-                try:
-                    decompressed_data = _gzip_decompress(data)
-                except Exception as err:
-                    log.debug(err)
-                    return None
-
-                return decompressed_data
+        return self._get_file_from_disk(self.version_file)
+
+    # Reads & decompresses the copy of a downloaded file kept in data_dir
+    def _get_file_from_disk(self, filename):
+        # Not changing directories since downloads may run in
+        # other threads
+        path = os.path.join(self.data_dir, filename)
+        # This could be the first run or an accidental deletion of the
+        # cached file.
+        if not os.path.exists(path):
+            log.debug('No %s on file system', filename)
+            return None
 
-    # Downloading the manifest. If successful also writes it to file-system
-    def _get_manifest_from_http(self):
-        log.debug('Downloading online version file')
+        log.debug('Found %s on file system', filename)
+        # Attempt to open the cached file
         try:
-            fd = _FD(self.version_file, self.update_urls, verify=self.verify,
-                     urllb3_headers=self.urllib3_headers)
-            data = fd.download_verify_return()
-            try:
-                decompressed_data = _gzip_decompress(data)
-            except IOError:
-                log.debug('Failed to decompress gzip file')
-                # Will be caught down below.
-                # Just logging the error
-                raise
-            log.debug('Version file download successful')
-            # Writing version file to application data directory
-            self._write_manifest_2_filesystem(decompressed_data)
-            return decompressed_data
+            with open(path, 'rb') as f:
+                data = f.read()
+            log.debug('Loaded %s from file system', filename)
         except Exception as err:
-            log.debug('Version file download failed')
+            log.debug('Failed to load %s from file system', filename)
             log.debug(err, exc_info=True)
             return None
 
+        # Attempt the decompress
+        try:
+            decompressed_data = Client._gzip_decompress_buffer(data)
+        except Exception as err:
+            log.debug(err)
+            return None
+
+        return decompressed_data
+
+    # Downloading the manifest. If successful also writes it to file-system
+    def _get_manifest_from_http(self):
+        log.debug('Downloading online version file')
+        return self._get_file_from_http(self.version_file)
+
     # Downloading the key file.
     def _get_key_data(self):
         log.debug('Downloading key file')
+        return self._get_file_from_http(self.key_file)
+
+    # Downloads & decompresses a gzipped file. The downloaded file is
+    # kept in data_dir along with its ETag & Last-Modified headers. If
+    # the server says the file hasn't changed since, the copy on disk
+    # is used instead of downloading it again.
+    def _get_file_from_http(self, filename, conditional=True):
+        validators = None
+        if conditional and os.path.exists(os.path.join(self.data_dir,
+                                                       filename)):
+            validators = self._http_cache.get(filename)
         try:
-            fd = _FD(self.key_file, self.update_urls, verify=self.verify,
-                     urllb3_headers=self.urllib3_headers)
-            data = fd.download_verify_return()
+            fd = _FD(filename, self.update_urls, verify=self.verify,
+                     urllb3_headers=self.urllib3_headers,
+                     http_pool=self.http_pool,
+                     rate_limiter=self.rate_limiter,
+                     validators=validators,
+                     mirrors=self._mirrors)
+            data = fd.download_verify_buffer()
+            if fd.not_modified is True:
+                decompressed_data = self._get_file_from_disk(filename)
+                if decompressed_data is not None:
+                    return decompressed_data
+                # Copy on disk is unusable. Downloading it in full.
+                log.debug('Cached %s is unusable', filename)
+                self._save_validators(filename, None)
+                return self._get_file_from_http(filename, conditional=False)
             try:
-                decompressed_data = _gzip_decompress(data)
+                decompressed_data = Client._gzip_decompress_buffer(data)
+                # Writing file to application data directory
+                self._write_file_2_filesystem(filename, data)
             except IOError:
                 log.debug('Failed to decompress gzip file')
+                # Will be caught down below.
+                # Just logging the error
                 raise
-            log.debug('Key file download successful')
-            # Writing version file to application data directory
-            self._write_manifest_2_filesystem(decompressed_data)
+            finally:
+                fd.release()
+            self._save_validators(filename, fd.validators)
+            log.debug('%s download successful', filename)
             return decompressed_data
         except Exception as err:
-            log.debug('Version file download failed')
+            log.debug('%s download failed', filename)
             log.debug(err, exc_info=True)
             return None
 
     # Adds the ability to apply updates when there isn't an
-    # Internet connection.
-    def _write_manifest_2_filesystem(self, data):
-        with _ChDir(self.data_dir):
-            log.debug('Writing version file to disk')
-            with gzip.open(self.version_file, 'wb') as f:
-                f.write(data)
+    # Internet connection. The file is saved as downloaded so the
+    # validators of the download stay valid for it.
+    def _write_file_2_filesystem(self, filename, data):
+        # Not changing directories since downloads may run in
+        # other threads
+        log.debug('Writing %s to disk', filename)
+        with open(os.path.join(self.data_dir, filename), 'wb') as f:
+            f.write(data)
+
+    # Saves the validators used for the next conditional request
+    def _save_validators(self, filename, validators):
+        with self._http_cache_lock:
+            if validators and any(validators.values()):
+                self._http_cache[filename] = validators
+            elif filename in self._http_cache:
+                del self._http_cache[filename]
+            try:
+                self._http_cache.sync()
+            except Exception as err:
+                log.debug('Failed to save http cache')
+                log.debug(err, exc_info=True)
 
     # We first attempt to download the version manifest. If that fails
     # we try to load a cached version manifest from disk. Once we have
     # the data in memory we'll verify it's signature.
     def _get_update_manifest(self):
         log.debug('Loading version file...')
+        self._load_update_manifest(self._get_manifest_from_http())
 
-        data = self._get_manifest_from_http()
+    # Loads & verifies the downloaded manifest. Falls back to the
+    # manifest cached on disk if the download failed.
+    def _load_update_manifest(self, data):
         if data is None:
             data = self._get_manifest_from_disk()
 
@@ -539,6 +675,30 @@ class Client(object):
                 log.debug('Creating directory: %s', d)
                 os.makedirs(d)
 
+    @staticmethod
+    def _create_download_cache(path, max_size):
+        if not path:
+            return None
+        if path is True:
+            path = os.path.join(appdirs.user_cache_dir(settings.APP_NAME,
+                                                       settings.APP_AUTHOR),
+                                settings.DOWNLOAD_CACHE_FOLDER)
+        return _DownloadCache(path, max_size)
+
+    @staticmethod
+    def _gzip_decompress_buffer(data):
+        # Decompresses straight from the download buffer. Unlike
+        # gzip_decompress the compressed data isn't copied first.
+        if data is None:
+            raise IOError('No data to decompress')
+        # zlib on Python 2 only takes old style buffers
+        if six.PY2 and isinstance(data, memoryview):
+            data = data.tobytes()
+        try:
+            return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+        except zlib.error as err:
+            raise IOError(str(err))
+
     @staticmethod
     def _sanitize_update_url(urls):
         sanitized_urls = []
@@ -550,5 +710,9 @@ class Client(object):
                 sanitized_urls.append(u + '/')
             else:
                 sanitized_urls.append(u)
-        # Removing duplicates
-        return list(set(sanitized_urls))
+        # Removing duplicates while keeping the configured order
+        deduped_urls = []
+        for u in sanitized_urls:
+            if u not in deduped_urls:
+                deduped_urls.append(u)
+        return deduped_urls
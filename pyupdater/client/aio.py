@@ -0,0 +1,143 @@
+# ------------------------------------------------------------------------------
+# Copyright (c) 2015-2017 Digital Sapphire
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the
+# following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF
+# ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+# TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR
+# ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE
+# OR OTHER DEALINGS IN THE SOFTWARE.
+# ------------------------------------------------------------------------------
+# asyncio support for the client. Requires Python 3.5+
+#
+# Network transfers keep using FileDownloader, with its resume, failover
+# & segment support, inside the loops executor. The event loop itself is
+# never blocked.
+import asyncio
+import logging
+
+from pyupdater.client import Client
+from pyupdater.client.updates import AppUpdate, LibUpdate
+
+log = logging.getLogger(__name__)
+
+
+class _AsyncUpdateMixin(object):
+
+    async def download(self):
+        """Downloads update
+
+        ######Returns (bool):
+
+            True - Download successful
+
+            False - Download failed
+
+            None - A download is already in progress
+        """
+        if self._is_downloading is True:
+            return None
+        self._is_downloading = True
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self._download)
+
+    async def is_downloaded(self):
+        """Used to check if update has been downloaded.
+
+        ######Returns (bool):
+
+            True - File is already downloaded.
+
+            False - File has not been downloaded.
+        """
+        if self._is_downloading is True:
+            return False
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self._is_downloaded)
+
+    async def extract(self):
+        """Will extract the update from its archive to the update folder.
+
+        ######Returns:
+
+            (bool) True - Extract successful. False - Extract failed.
+        """
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, super().extract)
+
+
+class AsyncLibUpdate(_AsyncUpdateMixin, LibUpdate):
+    """Awaitable LibUpdate. Returned by AsyncClient.update_check"""
+    pass
+
+
+class AsyncAppUpdate(_AsyncUpdateMixin, AppUpdate):
+    """Awaitable AppUpdate. Returned by AsyncClient.update_check"""
+    pass
+
+
+class AsyncClient(Client):
+    """A Client for asyncio applications. Takes the same arguments as
+    Client. Since __init__ cannot be awaited, refresh must be
+    called explicitly.
+
+    ######Example:
+
+        client = AsyncClient(ClientConfig())
+        await client.refresh()
+        update = await client.update_check(APP_NAME, APP_VERSION)
+        if update is not None and await update.download():
+            update.extract_restart()
+    """
+
+    _app_update_class = AsyncAppUpdate
+    _lib_update_class = AsyncLibUpdate
+
+    def __init__(self, obj, **kwargs):
+        if kwargs.pop('refresh', None) is True:
+            log.debug('Ignoring refresh. Call "await client.refresh()"')
+        super().__init__(obj, **kwargs)
+
+    async def refresh(self):
+        """Will download and verify the version manifest. The key file
+        & version manifest are downloaded concurrently."""
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self._rank_mirrors)
+        key_data, manifest_data = await asyncio.gather(
+            loop.run_in_executor(None, self._get_key_data),
+            loop.run_in_executor(None, self._get_manifest_from_http))
+
+        # The manifest can only be verified once we have the key
+        self._load_signing_key(key_data)
+        await loop.run_in_executor(None, self._load_update_manifest,
+                                   manifest_data)
+
+    async def update_check(self, name, version, channel='stable',
+                           strict=True):
+        """Checks for available updates. See Client.update_check
+
+        ######Returns:
+
+        (updateobject):
+
+            AsyncAppUpdate - Used to update current binary
+
+            AsyncLibUpdate - Used to update external assets
+
+            None - No Updates available
+        """
+        return self._update_check(name, version, channel, strict)
@@ -0,0 +1,191 @@
+# ------------------------------------------------------------------------------
+# Copyright (c) 2015-2017 Digital Sapphire
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the
+# following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF
+# ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+# TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR
+# ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE
+# OR OTHER DEALINGS IN THE SOFTWARE.
+# ------------------------------------------------------------------------------
+from __future__ import unicode_literals
+
+import hashlib
+import logging
+import os
+import shutil
+import threading
+
+log = logging.getLogger(__name__)
+
+
+class DownloadCache(object):
+    """Verified downloads keyed by their sha256 hash. Meant to be shared
+    by every app on the machine, so an asset used by many apps is only
+    downloaded once. Entries are checked against their hash every time
+    they are used. Least recently used entries are removed once the
+    cache grows past max_size.
+
+    ######Args:
+
+    path (str): Folder to keep the cache in
+
+    ######Kwargs:
+
+    max_size (int): Max bytes kept in the cache. None for unlimited
+    """
+
+    def __init__(self, path, max_size=None):
+        self.path = path
+        self.max_size = max_size
+        self._lock = threading.Lock()
+
+    def get(self, hexdigest, dest):
+        """Places the cached file with the given hash at dest. A hardlink
+        is used when possible.
+
+        ######Args:
+
+        hexdigest (str): sha256 hash of the file
+
+        dest (str): Path to place the file at
+
+        ######Returns (bool): True if the file was in the cache
+        """
+        path = self._entry_path(hexdigest)
+        if not os.path.exists(path):
+            return False
+        try:
+            DownloadCache._link_or_copy(path, dest)
+        except (IOError, OSError) as err:
+            log.debug(err, exc_info=True)
+            return False
+
+        if DownloadCache._hash_file(dest) != hexdigest:
+            log.debug('Cached %s is corrupt', hexdigest)
+            for p in (dest, path):
+                DownloadCache._remove(p)
+            return False
+
+        # Marking as recently used
+        try:
+            os.utime(path, None)
+        except OSError as err:
+            log.debug(err, exc_info=True)
+        log.debug('Found %s in download cache', hexdigest)
+        return True
+
+    def put(self, hexdigest, src=None, data=None):
+        """Adds a verified file to the cache. Other processes only ever
+        see complete entries.
+
+        ######Args:
+
+        hexdigest (str): sha256 hash of the file
+
+        ######Kwargs:
+
+        src (str): Path of the file to add
+
+        data (bytes): Contents of the file to add. Used if src is None
+        """
+        path = self._entry_path(hexdigest)
+        if os.path.exists(path):
+            return
+        temp_path = '{}.{}.{}.tmp'.format(path, os.getpid(),
+                                          threading.current_thread().ident)
+        try:
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            if src is not None:
+                DownloadCache._link_or_copy(src, temp_path)
+            else:
+                with open(temp_path, 'wb') as f:
+                    f.write(data)
+            try:
+                os.rename(temp_path, path)
+            except OSError:
+                # Windows doesn't replace files. Another process
+                # added the same file first.
+                if not os.path.exists(path):
+                    raise
+        except (IOError, OSError) as err:
+            log.debug('Failed to add %s to download cache', hexdigest)
+            log.debug(err, exc_info=True)
+            return
+        finally:
+            DownloadCache._remove(temp_path)
+        log.debug('Added %s to download cache', hexdigest)
+        self._evict()
+
+    def _evict(self):
+        # Removes least recently used entries until under max_size
+        if self.max_size is None:
+            return
+        with self._lock:
+            entries = []
+            total = 0
+            for root, _, files in os.walk(self.path):
+                for f in files:
+                    if f.endswith('.tmp'):
+                        continue
+                    p = os.path.join(root, f)
+                    try:
+                        stat = os.stat(p)
+                    except OSError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, p))
+                    total += stat.st_size
+
+            for _, size, p in sorted(entries):
+                if total <= self.max_size:
+                    break
+                log.debug('Evicting %s from download cache', p)
+                DownloadCache._remove(p)
+                total -= size
+
+    def _entry_path(self, hexdigest):
+        # Spreading entries over sub folders keeps folders small
+        return os.path.join(self.path, hexdigest[:2], hexdigest)
+
+    @staticmethod
+    def _link_or_copy(src, dest):
+        DownloadCache._remove(dest)
+        try:
+            os.link(src, dest)
+        except (AttributeError, OSError):
+            # No hardlinks on this platform or across file systems
+            shutil.copyfile(src, dest)
+
+    @staticmethod
+    def _hash_file(path):
+        hash_ = hashlib.sha256()
+        with open(path, 'rb') as f:
+            while 1:
+                block = f.read(1024 * 1024)
+                if len(block) == 0:
+                    break
+                hash_.update(block)
+        return hash_.hexdigest()
+
+    @staticmethod
+    def _remove(path):
+        try:
+            if os.path.exists(path):
+                os.remove(path)
+        except OSError as err:
+            log.debug(err, exc_info=True)
@@ -0,0 +1,160 @@
+# ------------------------------------------------------------------------------
+# Copyright (c) 2015-2017 Digital Sapphire
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the
+# following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF
+# ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+# TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR
+# ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE
+# OR OTHER DEALINGS IN THE SOFTWARE.
+# ------------------------------------------------------------------------------
+from __future__ import unicode_literals
+
+import io
+import logging
+import math
+import os
+import threading
+import time
+
+import bsdiff4
+from bsdiff4.format import write_patch
+
+from pyupdater import settings
+from pyupdater.utils import JSONStore
+
+log = logging.getLogger(__name__)
+
+
+class CostModel(object):
+    """Estimates the wall time of downloads & patches from the speeds of
+    earlier updates. The speeds are saved in the data dir.
+
+    ######Args:
+
+    data_dir (str): Folder to save the speeds in
+    """
+
+    # Weight of the newest sample in the moving averages
+    ALPHA = 0.3
+
+    # Downloads smaller than this mostly measure latency
+    MIN_SAMPLE_SIZE = 64 * 1024
+
+    # Bytes patched to calibrate the apply rate
+    CALIBRATION_SIZE = 1024 * 1024
+
+    def __init__(self, data_dir):
+        self.path = os.path.join(data_dir, settings.COST_FILE_FILENAME)
+        self._lock = threading.Lock()
+        self.stats = JSONStore(self.path)
+
+    @property
+    def download_rate(self):
+        """Bytes per second of downloads. None if nothing was measured."""
+        return self.stats.get('download_rate')
+
+    @property
+    def apply_rate(self):
+        """Bytes of output per second of applying patches. Calibrated
+        with a small patch if nothing was measured."""
+        rate = self.stats.get('apply_rate')
+        if rate is None:
+            rate = self._calibrate()
+            self._record('apply_rate', rate)
+            self.save()
+        return rate
+
+    def record_download(self, size, throughput):
+        """Adds a download to the moving average
+
+        ######Args:
+
+        size (int): Bytes downloaded
+
+        throughput (float): Bytes per second of the download
+        """
+        if size < self.MIN_SAMPLE_SIZE or not throughput:
+            return
+        self._record('download_rate', throughput)
+
+    def record_apply(self, size, seconds):
+        """Adds a patch application to the moving average
+
+        ######Args:
+
+        size (int): Bytes the patch produced
+
+        seconds (float): Time spent applying the patch
+        """
+        if size < self.MIN_SAMPLE_SIZE or seconds <= 0:
+            return
+        self._record('apply_rate', size / seconds)
+
+    def estimate(self, download_size, apply_size=0):
+        """Returns the seconds to download & apply. None if the download
+        rate isn't known yet.
+
+        ######Args:
+
+        download_size (int): Bytes to download
+
+        ######Kwargs:
+
+        apply_size (int): Bytes produced by applying patches
+        """
+        if self.download_rate is None:
+            return None
+        seconds = float(download_size) / self.download_rate
+        if apply_size > 0:
+            seconds += float(apply_size) / self.apply_rate
+        return seconds
+
+    def key(self):
+        """Rates rounded to powers of 2. Plans made with the same key
+        pick the same patches."""
+        rates = (self.download_rate, self.stats.get('apply_rate'))
+        return tuple(int(math.log(r, 2)) if r else None for r in rates)
+
+    def save(self):
+        """Writes the speeds to the data dir"""
+        with self._lock:
+            try:
+                self.stats.sync(force=True)
+            except Exception as err:
+                log.debug('Failed to save download & patch speeds')
+                log.debug(err, exc_info=True)
+
+    def _record(self, name, rate):
+        with self._lock:
+            old = self.stats.get(name)
+            if old is not None:
+                rate = old + self.ALPHA * (rate - old)
+            self.stats[name] = rate
+
+    def _calibrate(self):
+        # Diff blocks of real patches are mostly zeros
+        size = self.CALIBRATION_SIZE
+        diff = bytearray(size)
+        diff[::97] = b'\x01' * len(diff[::97])
+        patch = io.BytesIO()
+        write_patch(patch, size, [(size, 0, 0)], bytes(diff), b'')
+        start = time.time()
+        bsdiff4.patch(os.urandom(size), patch.getvalue())
+        seconds = max(time.time() - start, 0.001)
+        log.debug('Patches apply at %.0f bytes per second', size / seconds)
+        return size / seconds
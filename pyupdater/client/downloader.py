@@ -25,14 +25,24 @@
 from __future__ import unicode_literals
 
 import hashlib
+import json
 import logging
+import mmap
 import os
+import random
+import shutil
+import socket
+import threading
 import time
 
 import certifi
 import six
+from six.moves import queue
+from six.moves.urllib.parse import urlparse
+from six.moves.urllib.request import url2pathname
 import urllib3
 
+from pyupdater.client.progress import ProgressReporter
 from pyupdater.compat import url_quote
 from pyupdater.utils.exceptions import FileDownloaderError
 log = logging.getLogger(__name__)
@@ -68,6 +78,351 @@ def get_http_pool(secure=True):
 # End ToDo
 
 
+def create_http_pool(secure=True, headers=None, maxsize=10):
+    """Creates a connection pool meant to be shared by many downloads.
+    Connections are kept alive between requests to the same host, so
+    only the first download pays for the TCP & TLS handshake.
+
+    Kwargs:
+
+        secure (bool): Verify https connections
+
+        headers (dict): A urllib3.util.make_headers compatible dictionary
+
+        maxsize (int): Connections to keep open per host
+
+    Returns:
+
+        (urllib3.PoolManager)
+    """
+    if secure:
+        http = urllib3.PoolManager(cert_reqs=str('CERT_REQUIRED'),
+                                   ca_certs=certifi.where(),
+                                   maxsize=maxsize)
+    else:
+        http = urllib3.PoolManager(maxsize=maxsize)
+
+    if headers:
+        http.headers.update(urllib3.util.make_headers(**headers))
+    return http
+
+
+class RateLimiter(object):
+    """Token bucket limiting the combined speed of all downloads it is
+    shared with. The rate can be changed at any time, even while
+    downloads are waiting on the bucket.
+
+    ######Kwargs:
+
+    rate (int): Max bytes per second. None for unlimited
+
+    burst (int): Max bytes read at once. Defaults to one second of data
+    """
+
+    # Smallest read allowed while throttled
+    MIN_BURST = 1024
+
+    def __init__(self, rate=None, burst=None):
+        self._cond = threading.Condition()
+        self._tokens = 0.0
+        self._last = time.time()
+        self.rate = None
+        self.burst = None
+        self.set_rate(rate, burst)
+
+    def set_rate(self, rate, burst=None):
+        """Changes the download speed limit. Downloads waiting on the old
+        rate continue with the new one right away.
+
+        ######Args:
+
+        rate (int): Max bytes per second. None or 0 for unlimited
+
+        ######Kwargs:
+
+        burst (int): Max bytes read at once. Defaults to one second of data
+        """
+        with self._cond:
+            self._refill()
+            if not rate:
+                self.rate = None
+                self.burst = None
+            else:
+                self.rate = float(rate)
+                self.burst = max(int(burst or rate), self.MIN_BURST)
+                self._tokens = min(self._tokens, self.burst)
+            log.debug('Download rate limit: %s', self.rate)
+            self._cond.notify_all()
+
+    def block_size(self, block_size):
+        """Returns the largest read allowed, up to block_size"""
+        burst = self.burst
+        if burst is None:
+            return block_size
+        return min(block_size, burst)
+
+    def consume(self, amount):
+        """Blocks until amount bytes may be downloaded"""
+        with self._cond:
+            while self.rate is not None:
+                self._refill()
+                if self._tokens >= min(amount, self.burst):
+                    # Reads larger than the bucket go in to debt,
+                    # which the next read has to wait for
+                    self._tokens -= amount
+                    return
+                self._cond.wait((min(amount, self.burst) - self._tokens) /
+                                self.rate)
+
+    def _refill(self):
+        now = time.time()
+        if self.rate is not None:
+            self._tokens = min(self.burst, self._tokens +
+                               (now - self._last) * self.rate)
+        self._last = now
+
+
+def get_local_folder(url):
+    """Returns the folder of a local update source. Local sources are
+    file:// urls & plain directory paths, like a mounted share or USB
+    drive.
+
+    Args:
+
+        url (str): Update url
+
+    Returns:
+
+        (str): Path of the folder or None for remote urls
+    """
+    if url.startswith('file://'):
+        return url2pathname(urlparse(url).path)
+    if '://' in url:
+        return None
+    return url
+
+
+def _copy_file(src, dst):
+    # Copies a file without passing its data through user space when
+    # possible. A hard link is made on the same file system.
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+        return
+    except (AttributeError, OSError) as err:
+        log.debug('Cannot link %s: %s', src, err)
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            size = os.fstat(fsrc.fileno()).st_size
+            if _kernel_copy(fsrc, fdst, size) is False:
+                fsrc.seek(0)
+                fdst.seek(0)
+                fdst.truncate()
+                shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+
+
+def _break_link(path):
+    # Gives a hard linked file its own data before it's changed
+    if os.stat(path).st_nlink < 2:
+        return
+    tmp = path + '.tmp'
+    shutil.copyfile(path, tmp)
+    os.remove(path)
+    os.rename(tmp, path)
+
+
+def _kernel_copy(fsrc, fdst, size):
+    # Copies inside the kernel with copy_file_range or sendfile.
+    # Returns False if neither works for these files.
+    for name in ('copy_file_range', 'sendfile'):
+        func = getattr(os, name, None)
+        if func is None:
+            continue
+        offset = 0
+        try:
+            while offset < size:
+                if name == 'copy_file_range':
+                    sent = func(fsrc.fileno(), fdst.fileno(), size - offset,
+                                offset, offset)
+                else:
+                    sent = func(fdst.fileno(), fsrc.fileno(), offset,
+                                size - offset)
+                if sent == 0:
+                    break
+                offset += sent
+        except OSError as err:
+            log.debug('%s failed: %s', name, err)
+            continue
+        if offset == size:
+            return True
+    return False
+
+
+def _preallocate(f, size):
+    # Reserves the disk space of a download up front, which keeps large
+    # files from being fragmented. Also changes the size of the file.
+    if not hasattr(os, 'posix_fallocate') or not size:
+        return False
+    try:
+        os.posix_fallocate(f.fileno(), 0, size)
+    except OSError as err:
+        # Not supported by every file system
+        log.debug(err, exc_info=True)
+        return False
+    return True
+
+
+def _write_at(f, data, offset):
+    # Writes data at offset without moving the file position
+    if not hasattr(os, 'pwrite'):
+        f.seek(offset)
+        f.write(data)
+        return
+    data = memoryview(data)
+    while len(data) > 0:
+        written = os.pwrite(f.fileno(), data, offset)
+        data = data[written:]
+        offset += written
+
+
+class _BlockPipeline(object):
+    # Hashes & stores downloaded blocks on worker threads while the
+    # calling thread reads the next block. Hashing & file writes release
+    # the GIL, so the work runs on more than one core. Blocks are read in
+    # to a fixed pool of buffers which are reused once hashed & stored.
+
+    def __init__(self, hash_, store, buffers=8, buffer_size=256 * 1024):
+        self._pool = queue.Queue()
+        for _ in range(buffers):
+            self._pool.put(bytearray(buffer_size))
+        self._lock = threading.Lock()
+        # Workers still using a buffer, by buffer id
+        self._users = {}
+        # First exception raised by a worker
+        self.error = None
+        self._queues = []
+        self._threads = []
+
+        def update_hash(view, offset):
+            hash_.update(view)
+
+        for func in (update_hash, store):
+            q = queue.Queue()
+            t = threading.Thread(target=self._work, args=(q, func))
+            t.daemon = True
+            t.start()
+            self._queues.append(q)
+            self._threads.append(t)
+
+    def get_buffer(self):
+        # Blocks until a buffer is free
+        while 1:
+            self._raise_error()
+            try:
+                return self._pool.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+    def put_back(self, buf):
+        # Returns an unused buffer to the pool
+        self._pool.put(buf)
+
+    def submit(self, buf, length, offset):
+        self._raise_error()
+        with self._lock:
+            self._users[id(buf)] = len(self._queues)
+        for q in self._queues:
+            q.put((buf, length, offset))
+
+    def close(self):
+        # Waits for all submitted blocks to be hashed & stored
+        for q in self._queues:
+            q.put(None)
+        for t in self._threads:
+            t.join()
+        self._raise_error()
+
+    def _work(self, q, func):
+        while 1:
+            item = q.get()
+            if item is None:
+                break
+            buf, length, offset = item
+            try:
+                if self.error is None:
+                    func(memoryview(buf)[:length], offset)
+            except Exception as err:
+                log.debug(err, exc_info=True)
+                self.error = err
+            finally:
+                self._release(buf)
+
+    def _release(self, buf):
+        with self._lock:
+            self._users[id(buf)] -= 1
+            done = self._users[id(buf)] == 0
+            if done:
+                del self._users[id(buf)]
+        if done:
+            self._pool.put(buf)
+
+    def _raise_error(self):
+        if self.error is not None:
+            raise self.error
+
+
+class _ChunkVerifier(object):
+    # Checks a download against the hashes of its fixed size chunks.
+    # Used like a hash object, fed in order from the first byte of chunk
+    # start on. Bad chunks are remembered so only they get downloaded
+    # again.
+
+    def __init__(self, chunk_size, hashes, start=0):
+        self.chunk_size = chunk_size
+        self.hashes = hashes
+        # Chunk currently being hashed
+        self.index = start
+        # Chunks before this one passed verification
+        self.verified = start
+        self.bad = []
+        self._hash = hashlib.sha256()
+        self._filled = 0
+
+    def update(self, data):
+        data = memoryview(data)
+        while len(data) > 0:
+            take = min(len(data), self.chunk_size - self._filled)
+            self._hash.update(data[:take])
+            self._filled += take
+            data = data[take:]
+            if self._filled == self.chunk_size:
+                self._end_chunk()
+
+    def check(self, index, hexdigest):
+        return index < len(self.hashes) and self.hashes[index] == hexdigest
+
+    def finish(self, end=None):
+        # Returns the chunks before end which still need a good copy.
+        # None if more data was received than the hashes cover.
+        if self._filled > 0:
+            self._end_chunk()
+        if end is None:
+            end = len(self.hashes)
+        if self.index > end:
+            return None
+        return self.bad + list(range(self.index, end))
+
+    def _end_chunk(self):
+        if self.check(self.index, self._hash.hexdigest()) is False:
+            self.bad.append(self.index)
+        elif self.verified == self.index:
+            self.verified += 1
+        self.index += 1
+        self._hash = hashlib.sha256()
+        self._filled = 0
+
+
 class FileDownloader(object):
     """The FileDownloader object downloads files to memory and
     verifies their hash.  If hash is verified data is either
@@ -77,7 +432,9 @@ class FileDownloader(object):
 
     filename (str): The name of file to download
 
-    urls (list): List of urls to use for file download
+    urls (list): List of urls to use for file download. Local update
+    sources, file:// urls & plain directory paths, are tried before
+    remote urls.
 
     hexdigest (str): The hash of the file to download
 
@@ -93,8 +450,69 @@ class FileDownloader(object):
 
         False: Do not verify https connection
 
+    resume (bool):
+
+        True: Continue a previous partial download of this file
+
+        False: Always start the download from the beginning
+
+    segments (int): Number of concurrent connections used to download
+    the file. Requires server support for byte ranges.
+
+    http_pool (urllib3.PoolManager): Shared connection pool. A new pool
+    is created if not provided.
+
+    mirror_retries (int): Times a mirror may fail mid download before it's
+    skipped
+
+    rate_limiter (RateLimiter): Limits download speed. Usually shared by
+    all downloads of a client session.
+
+    validators (dict): ETag & Last-Modified of a copy of the file we
+    already have. If the server reports the file hasn't changed since,
+    nothing is downloaded & not_modified is set to True.
+
+    pipeline (bool): Hash & store the download on worker threads while
+    the next block is read. Helps on links faster than a single core can
+    hash & write.
+
+    cache (DownloadCache): Verified downloads shared between apps. Checked
+    before downloading. Requires hexdigest.
+
+    chunk_size (int): Bytes in each chunk of chunk_hashes
+
+    chunk_hashes (list): sha256 of every chunk_size bytes of the file.
+    Chunks are verified as they arrive & only bad chunks are downloaded
+    again. Replaces the check against hexdigest.
+
+    folder (str): Folder the download & its temporary files are written
+    to. Defaults to the working directory.
+
+    cancel_event (threading.Event): Stops the download once set.
+    Downloads raise FileDownloaderError when cancelled.
+
+    progress_interval (float): Min seconds between progress events
+
+    progress_step (float): Percent downloaded that triggers a progress
+    event before progress_interval has passed
+
+    mirrors (MirrorSelector): Receives the time to first byte of every
+    response & every failed or dropped connection. Keeps the mirror
+    ranking current between probes.
+
     """
 
+    # Errors raised when a connection drops during a download
+    STREAM_ERRORS = (urllib3.exceptions.HTTPError, socket.error)
+
+    # Largest block read at once
+    MAX_BLOCK_SIZE = 4194304
+
+    # Seconds to wait before the first failover attempt. Doubles for
+    # every following attempt up to BACKOFF_MAX.
+    BACKOFF_BASE = 0.5
+    BACKOFF_MAX = 8.0
+
     def __init__(self, *args, **kwargs):
         # We'll append the filename to one of the provided urls
         # to create the download link
@@ -111,6 +529,11 @@ class FileDownloader(object):
         # string to the urls parameter
         if isinstance(self.urls, list) is False:
             raise FileDownloaderError('Must pass list of urls', expected=True)
+        # Folders of local update sources. Only remote urls are left
+        # in urls.
+        self.local_folders = [get_local_folder(u) for u in self.urls
+                              if get_local_folder(u) is not None]
+        self.urls = [u for u in self.urls if get_local_folder(u) is None]
 
         try:
             self.hexdigest = args[2]
@@ -125,6 +548,9 @@ class FileDownloader(object):
 
         # Progress hooks to be called
         self.progress_hooks = kwargs.get('progress_hooks', [])
+        # How often progress hooks are called
+        self.progress_interval = kwargs.get('progress_interval', 0.1)
+        self.progress_step = kwargs.get('progress_step', 1.0)
 
         # Initial block size for each read
         self.block_size = 4096 * 4
@@ -133,34 +559,83 @@ class FileDownloader(object):
         self.file_binary_type = 'memory'
         # Max size of download to memory, larger file will be stored to file
         self.download_max_size = 16 * 1024 * 1024
-        # Hold all binary data once file has been downloaded
-        self.file_binary_data = []
+        # Hold all binary data once file has been downloaded. Preallocated
+        # to the size of the file & filled in place.
+        self.file_binary_data = bytearray()
+        # Buffer handed out by download_verify_buffer
+        self._buffer = None
+        # Folder the download is written to
+        self.folder = kwargs.get('folder', '')
+        # Set to stop the download
+        self.cancel_event = kwargs.get('cancel_event')
         # Temporary file to hold large download data
-        self.file_binary_path = self.filename + '.part'
+        self.file_binary_path = os.path.join(self.folder,
+                                             self.filename + '.part')
+        # Validators saved with the temporary file. Used to make sure the
+        # remote file hasn't changed before resuming a download.
+        self.file_binary_meta_path = self.file_binary_path + '.json'
+
+        # Continue downloading from the end of a previous .part file
+        self.resume = kwargs.get('resume', False)
+
+        # Number of byte ranges to download concurrently
+        self.segments = kwargs.get('segments') or 1
+        # Smallest byte range worth its own connection
+        self.min_segment_size = 1024 * 1024
+
+        # Hash & store blocks on worker threads
+        self.pipeline = kwargs.get('pipeline', False)
+
+        # Mid download failures allowed per mirror
+        self.mirror_retries = kwargs.get('mirror_retries', 3)
+
+        # Throttles reads when set
+        self.rate_limiter = kwargs.get('rate_limiter')
+
+        # Machine wide cache of verified downloads
+        self.cache = kwargs.get('cache')
+
+        # Hashes of fixed size chunks of the file
+        self.chunk_size = kwargs.get('chunk_size')
+        self.chunk_hashes = kwargs.get('chunk_hashes')
+
+        # Validators sent to make the request conditional
+        self.cache_validators = kwargs.get('validators')
+        # True if the server answered the conditional request with a 304
+        self.not_modified = False
+        # Validators of the downloaded file. Used for conditional requests
+        # the next time the file is needed.
+        self.validators = {}
+
+        # Mirror of the current response
+        self._current_url = None
+
+        # Mirror ranking updated with the results of our requests
+        self.mirrors = kwargs.get('mirrors')
 
         # Total length of data to download.
         self.content_length = None
 
+        # Bytes per second of the download. None if the file didn't come
+        # from the network.
+        self.throughput = None
+        # Bytes read from the network by this download. Doesn't include
+        # the resumed part of the file.
+        self.bytes_received = 0
+        self._received_lock = threading.Lock()
+
         # Extra headers
         self.headers = kwargs.get('urllb3_headers')
 
-        if self.verify is True:
-            self.http_pool = self._get_http_pool()
-        else:
-            self.http_pool = self._get_http_pool(secure=False)
+        # Connection pool shared with other downloads
+        self.http_pool = kwargs.get('http_pool')
+        if self.http_pool is None:
+            self.http_pool = self._get_http_pool(secure=self.verify is True)
 
     def _get_http_pool(self, secure=True):
-        if secure:
-            _http = urllib3.PoolManager(cert_reqs=str('CERT_REQUIRED'),
-                                        ca_certs=certifi.where())
-        else:
-            _http = urllib3.PoolManager()
-
-        if self.headers:
-            _headers = urllib3.util.make_headers(**self.headers)
-            _http.headers.update(_headers)
-        print(_http.headers)
-        return _http
+        # Keep a connection around for each segment
+        return create_http_pool(secure, self.headers,
+                                maxsize=max(self.segments, 1))
 
     def download_verify_write(self):
         """
@@ -178,6 +653,9 @@ class FileDownloader(object):
 
         # Downloading data internally
         check = self._download_to_storage(check_hash=True)
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            # Another update may have written the file already
+            raise FileDownloaderError('Download cancelled', expected=True)
         # If no hash is passed just write the file
         if check is True or check is None:
             self._write_to_file()
@@ -204,7 +682,7 @@ class FileDownloader(object):
         if check is True or check is None:
             if self.file_binary_type == 'memory':
                 if self.file_binary_data:
-                    return b''.join(self.file_binary_data)
+                    return bytes(self.file_binary_data)
                 else:
                     return None
             else:
@@ -214,11 +692,53 @@ class FileDownloader(object):
         else:
             return None
 
+    def download_verify_buffer(self):
+        """
+        Downloads file, checks against provided hash & returns the data
+        without copying it. Large files are memory mapped from disk.
+        Call release once done with the buffer.
+
+        Returns:
+
+            (buffer):
+
+                memoryview or read-only mmap - If hashes match or no hash
+                was given during initialization.
+
+                None - If any verification didn't pass
+        """
+        check = self._download_to_storage(check_hash=True)
+        if check is not True and check is not None:
+            return None
+
+        if self.file_binary_type == 'memory':
+            self._buffer = memoryview(self.file_binary_data)
+        else:
+            with open(self.file_binary_path, 'rb') as f:
+                if os.fstat(f.fileno()).st_size == 0:
+                    # Empty files cannot be mapped
+                    self._buffer = memoryview(b'')
+                else:
+                    self._buffer = mmap.mmap(f.fileno(), 0,
+                                             access=mmap.ACCESS_READ)
+        return self._buffer
+
+    def release(self):
+        """Frees the buffer returned by download_verify_buffer & removes
+        the temporary file backing it."""
+        if isinstance(self._buffer, mmap.mmap):
+            self._buffer.close()
+        self._buffer = None
+        self.file_binary_data = bytearray()
+        if self.file_binary_type == 'file':
+            self._remove_part_file()
+
     @staticmethod
     def _best_block_size(elapsed_time, _bytes):
         # Returns best block size for current Internet connection speed
         new_min = max(_bytes / 2.0, 1.0)
-        new_max = min(max(_bytes * 2.0, 1.0), 4194304)  # Do not surpass 4 MB
+        # Do not surpass 4 MB
+        new_max = min(max(_bytes * 2.0, 1.0), FileDownloader.MAX_BLOCK_SIZE)
         if elapsed_time < 0.001:
             return int(new_max)
         rate = _bytes / elapsed_time
@@ -229,11 +749,141 @@ class FileDownloader(object):
         return int(rate)
 
     def _download_to_storage(self, check_hash=True):
-        data = self._create_response()
+        if self._get_from_cache() is True:
+            return True
+        check = self._get_from_local()
+        if check is False:
+            start = time.time()
+            check = self._download_from_network(check_hash)
+            elapsed = time.time() - start
+            if check is not False and self.bytes_received and elapsed > 0:
+                self.throughput = self.bytes_received / elapsed
+            if self.mirrors is not None:
+                self.mirrors.save()
+        if check is True:
+            self._add_to_cache()
+        return check
+
+    def _get_from_local(self):
+        # Copies the file from the first local update source with a
+        # good copy. False if no local source has one.
+        for folder in self.local_folders:
+            path = os.path.join(folder, self.filename)
+            if not os.path.isfile(path):
+                continue
+            log.debug('Copying %s from %s', self.filename, folder)
+            try:
+                check = self._copy_from_local(path)
+            except (IOError, OSError) as err:
+                log.debug(err, exc_info=True)
+                continue
+            if check is not False:
+                return check
+            log.debug('Copy from %s failed verification', folder)
+        return False
+
+    def _copy_from_local(self, path):
+        self.content_length = os.path.getsize(path)
+        progress = self._create_progress_reporter()
+        hash_ = self._new_hash()
+        if self.content_length <= self.download_max_size:
+            self.file_binary_type = 'memory'
+            self.file_binary_data = bytearray(self.content_length)
+            view = memoryview(self.file_binary_data)
+            with open(path, 'rb') as f:
+                received = 0
+                while received < self.content_length:
+                    read = f.readinto(view[received:])
+                    if not read:
+                        break
+                    received += read
+            hash_.update(view)
+        else:
+            self.file_binary_type = 'file'
+            # Meta data of an older partial download
+            if os.path.exists(self.file_binary_meta_path):
+                os.remove(self.file_binary_meta_path)
+            _copy_file(path, self.file_binary_path)
+            # Hashing the copy, which is what gets used
+            with open(self.file_binary_path, 'rb') as f:
+                while 1:
+                    block = f.read(1024 * 1024)
+                    if len(block) == 0:
+                        break
+                    hash_.update(block)
+        progress.finish(self.content_length)
+        progress.flush()
+        return self._check_download(hash_)
+
+    def _get_from_cache(self):
+        # Places a cached copy of the file where a finished
+        # download would be
+        if self.cache is None or self.hexdigest is None:
+            return False
+        if self.cache.get(self.hexdigest, self.file_binary_path) is False:
+            return False
+        self.file_binary_type = 'file'
+        self.content_length = os.path.getsize(self.file_binary_path)
+        # Meta data of an older partial download
+        if os.path.exists(self.file_binary_meta_path):
+            os.remove(self.file_binary_meta_path)
+        progress = self._create_progress_reporter()
+        progress.finish(self.content_length)
+        progress.flush()
+        return True
+
+    def _add_to_cache(self):
+        if self.cache is None:
+            return
+        if self.file_binary_type == 'memory':
+            self.cache.put(self.hexdigest, data=self.file_binary_data)
+        else:
+            self.cache.put(self.hexdigest, src=self.file_binary_path)
+
+    def _download_from_network(self, check_hash=True):
+        # Bytes already on disk from a previous attempt. The hash object
+        # has been updated with those bytes.
+        resume_from, hash_ = self._get_resume_state()
+
+        if resume_from > 0:
+            meta = self._read_part_meta() or {}
+            validator = meta.get('etag') or meta.get('last_modified')
+            data = self._create_response(byte_range=(resume_from, None),
+                                         validator=validator)
+        elif self.segments > 1:
+            # Asking for the first byte tells us if the server supports
+            # ranges & the full size of the file
+            data = self._create_response(byte_range=(0, 0))
+        else:
+            data = self._create_response()
 
         if data is None:
             return None
-        hash_ = hashlib.sha256()
+
+        if data.status == 304:
+            log.debug('%s not modified since last download', self.filename)
+            FileDownloader._discard(data)
+            self.not_modified = True
+            return False
+
+        self.validators = {'etag': data.headers.get('ETag'),
+                           'last_modified': data.headers.get('Last-Modified')}
+
+        if self.segments > 1 and resume_from == 0 and data.status == 206:
+            return self._download_segmented(data, check_hash)
+
+        if resume_from > 0 and not self._can_resume(data, resume_from):
+            log.debug('Server did not honor range request. Starting over')
+            self._remove_part_file()
+            resume_from = 0
+            hash_ = self._new_hash()
+            # A 200 response already holds the full file. Anything else
+            # needs a fresh request.
+            if data.status != 200:
+                FileDownloader._discard(data)
+                data = self._create_response()
+                if data is None:
+                    return None
 
         # Getting length of file to show progress
         self.content_length = FileDownloader._get_content_length(data)
@@ -241,7 +891,7 @@ class FileDownloader(object):
             log.debug('Content-Length not in headers')
             log.debug('Callbacks will not show time left '
                       'or percent downloaded.')
-        if (self.content_length is None or
+        if (resume_from > 0 or self.content_length is None or
                 self.content_length > self.download_max_size):
             log.debug('Using file as storage since the file is too large')
             self.file_binary_type = 'file'
@@ -249,180 +899,637 @@ class FileDownloader(object):
             self.file_binary_type = 'memory'
 
         # Setting start point to show progress
-        received_data = 0
+        received_data = resume_from
+        progress = self._create_progress_reporter(start=resume_from)
 
-        start_download = time.time()
-        block = data.read(1)
-        received_data += len(block)
         if self.file_binary_type == 'memory':
-            self.file_binary_data = [block]
+            self.file_binary_data = bytearray(self.content_length)
+            binary_file = None
         else:
-            binary_file = open(self.file_binary_path, 'wb')
-            binary_file.write(block)
-        hash_.update(block)
-        while 1:
-            # Grabbing start time for use with best block size
-            start_block = time.time()
+            if resume_from > 0:
+                log.debug('Resuming download at byte %s', resume_from)
+                binary_file = open(self.file_binary_path, 'r+b')
+            else:
+                binary_file = open(self.file_binary_path, 'wb')
+                if self.resume is True:
+                    self._write_part_meta(data)
+            # Resumes start at the size of the .part file. A preallocated
+            # file left by a crash would look complete.
+            if self.resume is False or self.hexdigest is None:
+                _preallocate(binary_file, self.content_length)
+            # Reused for every read. Large enough for the biggest block.
+            read_buffer = memoryview(bytearray(self.MAX_BLOCK_SIZE))
+
+        def store(block, offset):
+            if binary_file is None:
+                # Filling the preallocated buffer in place
+                self.file_binary_data[offset:offset + len(block)] = block
+            else:
+                _write_at(binary_file, block, offset)
+
+        pipeline = None
+        if self.pipeline is True:
+            pipeline = _BlockPipeline(hash_, store)
 
-            # Get data from connection
-            block = data.read(self.block_size)
+        # Failed reads per mirror
+        failures = {}
+        try:
+            while 1:
+                # Grabbing start time for use with best block size
+                start_block = time.time()
+
+                # Get data from connection
+                buf = None
+                try:
+                    if pipeline is None:
+                        size = self._limit_block_size(self.block_size)
+                        if binary_file is None:
+                            # Reading straight in to the preallocated buffer
+                            view = memoryview(self.file_binary_data)[
+                                received_data:received_data + size]
+                        else:
+                            view = read_buffer[:size]
+                        block = view[:data.readinto(view)]
+                    else:
+                        # Reading in to a free buffer of the pipeline
+                        buf = pipeline.get_buffer()
+                        view = memoryview(buf)[:self._limit_block_size(
+                            len(buf))]
+                        block = view[:data.readinto(view)]
+                    if (len(block) == 0 and self.content_length is not None
+                            and received_data < self.content_length):
+                        raise urllib3.exceptions.ProtocolError(
+                            'Connection closed early')
+                except FileDownloader.STREAM_ERRORS as err:
+                    if buf is not None:
+                        pipeline.put_back(buf)
+                    log.debug('Download interrupted: %s', err)
+                    failures[self._current_url] = failures.get(
+                        self._current_url, 0) + 1
+                    FileDownloader._discard(data)
+                    data, self._current_url = self._failover(
+                        failures, self._current_url, received_data)
+                    if data is None:
+                        # Keeping what we have for a later resume
+                        log.debug('All mirrors failed')
+                        return False
+                    continue
+
+                # Grabbing end time for use with best block size
+                end_block = time.time()
+
+                if len(block) == 0:
+                    # No more data, get out of this never ending loop!
+                    if buf is not None:
+                        pipeline.put_back(buf)
+                    break
+
+                # Waiting here keeps the time spent throttled out of
+                # the block size calculation
+                self._throttle(len(block))
+
+                if pipeline is None:
+                    # Calculating the best block size for the
+                    # current connection speed
+                    self.block_size = self._best_block_size(end_block -
+                                                            start_block,
+                                                            len(block))
+                    log.debug('Block size: %s', self.block_size)
+                    if binary_file is not None:
+                        _write_at(binary_file, block, received_data)
+                    hash_.update(block)
+                else:
+                    # Hashed & stored while the next block is read
+                    pipeline.submit(buf, len(block), received_data)
 
-            # Grabbing end time for use with best block size
-            end_block = time.time()
+                # Total data we've received so far
+                received_data += len(block)
 
-            if len(block) == 0:
-                # No more data, get out of this never ending loop!
-                if self.file_binary_type == 'file':
+                # Progress hooks are only called every progress_interval
+                progress.update(received_data)
+        finally:
+            try:
+                # Waiting for the workers so everything received is on disk
+                if pipeline is not None:
+                    pipeline.close()
+            finally:
+                # Whatever made it to disk can be resumed later. Removing
+                # any space preallocated for the rest.
+                if binary_file is not None:
+                    binary_file.truncate(received_data)
                     binary_file.close()
-                break
+                    if isinstance(hash_, _ChunkVerifier):
+                        # Resuming won't need to hash these chunks again
+                        self._update_part_meta(chunks_verified=hash_.verified)
 
-            # Calculating the best block size for the
-            # current connection speed
-            self.block_size = self._best_block_size(end_block - start_block,
-                                                    len(block))
-            log.debug('Block size: %s', self.block_size)
+        progress.finish(received_data)
+        progress.flush()
+        log.debug('Download Complete')
+
+        if check_hash:
+            return self._check_download(hash_)
+
+    def _check_download(self, hash_):
+        if isinstance(hash_, _ChunkVerifier):
+            return self._check_chunks(hash_.finish())
+        return self._check_hash(hash_.hexdigest())
+
+    def _uses_chunks(self):
+        return bool(self.chunk_size) and bool(self.chunk_hashes)
+
+    def _new_hash(self, start=0):
+        # Chunk hashes replace the hash of the whole file when available
+        if self._uses_chunks():
+            return _ChunkVerifier(self.chunk_size, self.chunk_hashes, start)
+        return hashlib.sha256()
+
+    def _check_chunks(self, bad):
+        # Downloads good copies of bad chunks
+        if bad is None:
+            log.debug('Received more data than the chunk hashes cover')
+        elif len(bad) > 0:
+            log.debug('%s chunks failed verification', len(bad))
+            for index in bad:
+                if self._refetch_chunk(index) is False:
+                    log.debug('Cannot get a good copy of chunk %s', index)
+                    bad = None
+                    break
+        if bad is None:
+            if self.file_binary_type == 'file':
+                self._remove_part_file()
+            return False
+        log.debug('File chunks verified')
+        return True
+
+    def _refetch_chunk(self, index):
+        # Tries each mirror for a good copy of a chunk
+        start = index * self.chunk_size
+        end = start + self.chunk_size - 1
+        for url in self.urls:
+            data, _ = self._open(byte_range=(start, end), urls=[url])
+            if data is None:
+                continue
+            if data.status != 206:
+                log.debug('%s does not support byte ranges', url)
+                FileDownloader._discard(data)
+                continue
+            try:
+                chunk = data.read()
+            except FileDownloader.STREAM_ERRORS as err:
+                log.debug('Chunk download interrupted: %s', err)
+                self._report_failure(url)
+                FileDownloader._discard(data)
+                continue
+            data.release_conn()
+            self._throttle(len(chunk))
+            if hashlib.sha256(chunk).hexdigest() != self.chunk_hashes[index]:
+                log.debug('Bad copy of chunk %s from %s', index, url)
+                continue
             if self.file_binary_type == 'memory':
-                self.file_binary_data.append(block)
+                self.file_binary_data[start:start + len(chunk)] = chunk
             else:
-                binary_file.write(block)
-            hash_.update(block)
-
-            # Total data we've received so far
-            
-            received_data += len(block)
-            
-            # If content length is None we will return a static percent
-            # -.-%
-            percent = FileDownloader._calc_progress_percent(received_data,
-                                                            self.content_length)
-
-            # If content length is None we will return a static time remaining
-            # --:--
-            time_left = FileDownloader._calc_eta(start_download, time.time(),
-                                                 self.content_length,
-                                                 received_data)
-
-            status = {'total': self.content_length,
-                      'downloaded': received_data,
-                      'status': 'downloading',
-                      'percent_complete': percent,
-                      'time': time_left}
-
-            # Call all progress hooks with status data
-            self._call_progress_hooks(status)
-
-        status = {'total': self.content_length,
-                  'downloaded': received_data,
-                  'status': 'finished',
-                  'percent_complete': percent,
-                  'time': '00:00'}
-        self._call_progress_hooks(status)
+                # The copy of a local source may share its data
+                _break_link(self.file_binary_path)
+                with open(self.file_binary_path, 'r+b') as f:
+                    _write_at(f, chunk, start)
+            return True
+        return False
+
+    def _check_hash(self, file_hash):
+        # Checks hash of downloaded file
+        if self.hexdigest is None:
+            # No hash provided to check.
+            # So just return any data received
+            log.debug('No hash to verify')
+            return None
+        if self.file_binary_data is None:
+            # Exit quickly if we got nothing to compare
+            # Also I'm sure we'll get an exception trying to
+            # pass None to get hash :)
+            log.debug('Cannot verify file hash - No Data')
+            return False
+        log.debug('Checking file hash')
+        log.debug('Update hash: %s', self.hexdigest)
+
+        if file_hash == self.hexdigest:
+            log.debug('File hash verified')
+            return True
+        log.debug('Cannot verify file hash')
+        # Don't resume from corrupt data on the next attempt
+        if self.file_binary_type == 'file':
+            self._remove_part_file()
+        return False
+
+    def _download_segmented(self, probe, check_hash=True):
+        # Downloads byte ranges of the file on concurrent connections
+        # directly into their place in a preallocated file.
+        self.content_length = FileDownloader._get_content_length(probe)
+        etag = probe.headers.get('ETag')
+        probe.read()
+        probe.release_conn()
+        if self.content_length is None:
+            log.debug('Unknown file size. Cannot use segments')
+            return self._download_single(check_hash)
+
+        segments = min(self.segments,
+                       max(self.content_length // self.min_segment_size, 1))
+        segment_size = -(-self.content_length // segments)
+        if self._uses_chunks():
+            # Every segment verifies whole chunks
+            segment_size = -(-segment_size // self.chunk_size) * \
+                self.chunk_size
+        ranges = [(start, min(start + segment_size, self.content_length) - 1)
+                  for start in range(0, self.content_length, segment_size)]
+        log.debug('Downloading %s in %s segments', self.filename, len(ranges))
+
+        self.file_binary_type = 'file'
+        with open(self.file_binary_path, 'wb') as f:
+            if not _preallocate(f, self.content_length):
+                f.truncate(self.content_length)
+
+        # Shared between segment threads
+        state = {'received': 0, 'failed': False, 'no_range': False,
+                 'bad_chunks': []}
+        lock = threading.Lock()
+        threads = []
+        for r in ranges:
+            t = threading.Thread(target=self._download_segment,
+                                 args=(r, etag, state, lock))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+
+        # Progress is reported from this thread only
+        progress = self._create_progress_reporter()
+        for t in threads:
+            while t.is_alive():
+                t.join(self.progress_interval)
+                progress.update(state['received'])
+
+        if state['no_range'] is True:
+            log.debug('Server ignored range request. Using single stream')
+            self._remove_part_file()
+            return self._download_single(check_hash)
+
+        if state['failed'] is True:
+            log.debug('Segmented download failed')
+            self._remove_part_file()
+            if self.cancel_event is not None and self.cancel_event.is_set():
+                raise FileDownloaderError('Download cancelled', expected=True)
+            return False
+
+        progress.finish(state['received'])
+        progress.flush()
         log.debug('Download Complete')
 
         if check_hash:
-            # Checks hash of downloaded file
-            if self.hexdigest is None:
-                # No hash provided to check.
-                # So just return any data received
-                log.debug('No hash to verify')
-                return None
-            if self.file_binary_data is None:
-                # Exit quickly if we got nothing to compare
-                # Also I'm sure we'll get an exception trying to
-                # pass None to get hash :)
-                log.debug('Cannot verify file hash - No Data')
-                return False
-            log.debug('Checking file hash')
-            log.debug('Update hash: %s', self.hexdigest)
-
-            file_hash = hash_.hexdigest()
-            if file_hash == self.hexdigest:
-                log.debug('File hash verified')
-                return True
-            log.debug('Cannot verify file hash')
+            if self._uses_chunks():
+                # Verified by the segments as they arrived
+                return self._check_chunks(state['bad_chunks'])
+            hash_ = hashlib.sha256()
+            with open(self.file_binary_path, 'rb') as f:
+                while 1:
+                    block = f.read(1024 * 1024)
+                    if len(block) == 0:
+                        break
+                    hash_.update(block)
+            return self._check_hash(hash_.hexdigest())
+
+    def _download_segment(self, byte_range, etag, state, lock):
+        # Worker for _download_segmented
+        start, end = byte_range
+        try:
+            data, url = self._open(byte_range=byte_range, validator=etag)
+            if data is None:
+                state['failed'] = True
+                return
+            if FileDownloader._starts_at(data, start) is False:
+                # Got the full file instead of our range
+                state['no_range'] = True
+                FileDownloader._discard(data)
+                return
+            # Failed reads per mirror
+            failures = {}
+            verifier = None
+            if self._uses_chunks():
+                verifier = self._new_hash(start // self.chunk_size)
+            # Reused for every read of this segment
+            read_buffer = memoryview(bytearray(1024 * 64))
+            with open(self.file_binary_path, 'r+b') as f:
+                offset = start
+                while offset <= end and state['failed'] is False:
+                    try:
+                        view = read_buffer[:self._limit_block_size(
+                            min(end - offset + 1, len(read_buffer)))]
+                        block = view[:data.readinto(view)]
+                        if len(block) == 0:
+                            raise urllib3.exceptions.ProtocolError(
+                                'Connection closed early')
+                        self._throttle(len(block))
+                    except FileDownloader.STREAM_ERRORS as err:
+                        log.debug('Segment interrupted: %s', err)
+                        failures[url] = failures.get(url, 0) + 1
+                        FileDownloader._discard(data)
+                        data, url = self._failover(failures, url, offset,
+                                                   end)
+                        if data is None:
+                            break
+                        continue
+                    _write_at(f, block, offset)
+                    if verifier is not None:
+                        verifier.update(block)
+                    offset += len(block)
+                    with lock:
+                        state['received'] += len(block)
+            if data is not None:
+                data.release_conn()
+            if offset <= end:
+                log.debug('Segment %s-%s is incomplete', start, end)
+                state['failed'] = True
+            elif verifier is not None:
+                bad = verifier.finish(-(-(end + 1) // self.chunk_size))
+                with lock:
+                    state['bad_chunks'].extend(bad)
+        except Exception as err:
+            log.debug(err, exc_info=True)
+            state['failed'] = True
+
+    def _download_single(self, check_hash=True):
+        # Single stream download without any range requests
+        segments = self.segments
+        self.segments = 1
+        try:
+            return self._download_from_network(check_hash)
+        finally:
+            self.segments = segments
+
+    def _get_resume_state(self):
+        # Returns the offset to resume from & a hash object
+        # updated with the data already on disk
+        hash_ = self._new_hash()
+        if self.resume is False or self.hexdigest is None:
+            return 0, hash_
+
+        if not os.path.exists(self.file_binary_path):
+            return 0, hash_
+
+        meta = self._read_part_meta()
+        if meta is None or meta.get('hexdigest') != self.hexdigest:
+            log.debug('Partial download is for another file')
+            self._remove_part_file()
+            return 0, hash_
+
+        if self._uses_chunks() and 'chunks_verified' in meta:
+            # Continuing after the last verified chunk. The rest of the
+            # partial download is downloaded again.
+            verified = min(meta['chunks_verified'],
+                           os.path.getsize(self.file_binary_path) //
+                           self.chunk_size)
+            offset = verified * self.chunk_size
+            with open(self.file_binary_path, 'r+b') as f:
+                f.truncate(offset)
+            log.debug('Found %s verified bytes of partial download', offset)
+            return offset, self._new_hash(verified)
+
+        log.debug('Hashing partial download')
+        offset = 0
+        with open(self.file_binary_path, 'rb') as f:
+            while 1:
+                block = f.read(1024 * 1024)
+                if len(block) == 0:
+                    break
+                hash_.update(block)
+                offset += len(block)
+        log.debug('Found %s bytes of partial download', offset)
+        return offset, hash_
+
+    def _can_resume(self, data, start):
+        # Checks that the partial response continues our .part file
+        if FileDownloader._starts_at(data, start) is False:
             return False
+        etag = data.headers.get('ETag')
+        saved_etag = (self._read_part_meta() or {}).get('etag')
+        if etag is not None and saved_etag is not None and etag != saved_etag:
+            log.debug('ETag changed since partial download')
+            return False
+        return True
 
-    # Calling all progress hooks
-    def _call_progress_hooks(self, data):
-        log.debug(data)
-        for ph in self.progress_hooks:
-            try:
-                ph(data)
-            except Exception as err:
-                log.debug('Exception in callback: %s', ph.__name__)
-                log.debug(err, exc_info=True)
+    def _read_part_meta(self):
+        if not os.path.exists(self.file_binary_meta_path):
+            return None
+        try:
+            with open(self.file_binary_meta_path, 'r') as f:
+                return json.loads(f.read())
+        except Exception as err:
+            log.debug(err, exc_info=True)
+            return None
+
+    def _write_part_meta(self, data):
+        # Saving validators to make sure we are resuming the same file
+        meta = {'hexdigest': self.hexdigest,
+                'etag': data.headers.get('ETag'),
+                'last_modified': data.headers.get('Last-Modified')}
+        with open(self.file_binary_meta_path, 'w') as f:
+            f.write(json.dumps(meta))
+
+    def _update_part_meta(self, **kwargs):
+        meta = self._read_part_meta()
+        if meta is None:
+            return
+        meta.update(kwargs)
+        with open(self.file_binary_meta_path, 'w') as f:
+            f.write(json.dumps(meta))
+
+    def _remove_part_file(self):
+        for p in (self.file_binary_path, self.file_binary_meta_path):
+            if os.path.exists(p):
+                os.remove(p)
+
+    def _limit_block_size(self, block_size):
+        if self.rate_limiter is None:
+            return block_size
+        return self.rate_limiter.block_size(block_size)
+
+    def _throttle(self, amount):
+        # Called for every block received
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            raise FileDownloaderError('Download cancelled', expected=True)
+        with self._received_lock:
+            self.bytes_received += amount
+        if self.rate_limiter is not None:
+            self.rate_limiter.consume(amount)
+
+    # Progress hooks are called through a reporter which limits how
+    # often they are called
+    def _create_progress_reporter(self, start=0):
+        return ProgressReporter(self.progress_hooks,
+                                total=self.content_length, start=start,
+                                interval=self.progress_interval,
+                                step=self.progress_step)
 
     # Creating response object to start download
     # Attempting to do some error correction for aws s3 urls
-    def _create_response(self):
+    def _create_response(self, byte_range=None, validator=None):
+        data, self._current_url = self._open(byte_range, validator)
+        return data
+
+    # Tries each url in order. Returns the response & the url used.
+    def _open(self, byte_range=None, validator=None, urls=None):
         data = None
+        file_url = None
         max_download_retries = self.max_download_retries
-        for url in self.urls:
+
+        # Passing headers to urlopen replaces the pool headers
+        headers = self.http_pool.headers.copy()
+        if byte_range is not None:
+            start, end = byte_range
+            headers['Range'] = 'bytes={}-{}'.format(start,
+                                                    '' if end is None
+                                                    else end)
+            # Server will send the full file if it has changed
+            if validator is not None:
+                headers['If-Range'] = validator
+        elif self.cache_validators:
+            # Server will only send the file if it has changed
+            if self.cache_validators.get('etag'):
+                headers['If-None-Match'] = self.cache_validators['etag']
+            if self.cache_validators.get('last_modified'):
+                headers['If-Modified-Since'] = \
+                    self.cache_validators['last_modified']
+
+        for url in urls or self.urls:
 
             # Create url for resource
             file_url = url + url_quote(self.filename)
             log.debug('Url for request: %s', file_url)
+            start = time.time()
             try:
                 data = self.http_pool.urlopen('GET', file_url,
+                                              headers=headers,
                                               preload_content=False,
                                               retries=max_download_retries)
             except urllib3.exceptions.SSLError:
                 log.debug('SSL cert not verified')
+                self._report_failure(url)
                 continue
             except urllib3.exceptions.MaxRetryError:
                 log.debug('MaxRetryError')
+                self._report_failure(url)
                 continue
             except Exception as e:
                 # Catch whatever else comes up and log it
                 # to help fix other http related issues
                 log.debug(str(e), exc_info=True)
+                self._report_failure(url)
             else:
+                # A 404 or 416 is a miss of this file, not a bad mirror
+                if data.status >= 500:
+                    self._report_failure(url)
+                elif data.status < 400:
+                    self._report_success(url, time.time() - start)
                 break
 
         if data is not None:
             log.debug('Resource URL: %s', file_url)
-        else:
-            log.debug('Could not create resource URL.')
-        return data
+            return data, url
+        log.debug('Could not create resource URL.')
+        return None, None
+
+    def _report_success(self, url, ttfb):
+        if self.mirrors is not None:
+            self.mirrors.record_success(url, ttfb)
+
+    def _report_failure(self, url):
+        if self.mirrors is not None:
+            self.mirrors.record_failure(url)
+
+    def _failover(self, failures, failed_url, offset, end=None):
+        # Continues a broken download from offset on the next mirror
+        # that still has retries left. Waits with exponential backoff
+        # & jitter between attempts.
+        self._report_failure(failed_url)
+        attempt = 0
+        while 1:
+            candidates = [u for u in self.urls
+                          if failures.get(u, 0) < self.mirror_retries]
+            if len(candidates) == 0:
+                return None, None
+
+            # Start with the mirror after the one that failed
+            if failed_url in self.urls:
+                index = self.urls.index(failed_url) + 1
+                ordered = self.urls[index:] + self.urls[:index]
+                candidates = [u for u in ordered if u in candidates]
+            url = candidates[0]
+
+            delay = min(self.BACKOFF_MAX, self.BACKOFF_BASE * 2 ** attempt)
+            time.sleep(random.uniform(0, delay))
+            attempt += 1
+
+            log.debug('Continuing download at byte %s from %s', offset, url)
+            data, _ = self._open(byte_range=(offset, end), urls=[url])
+            if data is not None:
+                if FileDownloader._starts_at(data, offset):
+                    return data, url
+                log.debug('%s cannot continue the download', url)
+                FileDownloader._discard(data)
+            failures[url] = failures.get(url, 0) + 1
+            failed_url = url
 
     def _write_to_file(self):
-        # Writes download data to disk
+        # Writes download data to disk. The file is only replaced once
+        # complete, so others reading it never see a partial file.
+        path = os.path.join(self.folder, self.filename)
         if self.file_binary_type == 'memory':
-            with open(self.filename, 'wb') as f:
-                for block in self.file_binary_data:
-                    f.write(block)
-        else:
-            if os.path.exists(self.filename):
-                os.unlink(self.filename)
-            os.rename(self.file_binary_path, self.filename)
+            with open(self.file_binary_path, 'wb') as f:
+                f.write(self.file_binary_data)
+        if os.path.exists(path):
+            os.unlink(path)
+        os.rename(self.file_binary_path, path)
+        if os.path.exists(self.file_binary_meta_path):
+            os.remove(self.file_binary_meta_path)
+
+    @staticmethod
+    def _discard(data):
+        # Closes a response with unread data so its connection
+        # isn't reused by the pool
+        data.close()
+        data.release_conn()
 
     @staticmethod
     def _get_content_length(data):
-        content_length = data.headers.get("Content-Length")
-        if content_length is not None:
-            content_length = int(content_length)
+        # A partial response holds the length of the full file
+        # in its Content-Range header
+        content_range = data.headers.get("Content-Range")
+        if content_range is not None:
+            total = content_range.rsplit('/', 1)[-1]
+            content_length = None if total == '*' else int(total)
+        else:
+            content_length = data.headers.get("Content-Length")
+            if content_length is not None:
+                content_length = int(content_length)
         log.debug('Got content length of: %s', content_length)
         return content_length
 
     @staticmethod
-    def _calc_eta(start, now, total, current):
-        # Calculates remaining time of download
-        if total is None:
-            return '--:--'
-        dif = now - start
-        if current == 0 or dif < 0.001:  # One millisecond
-            return '--:--'
-        rate = float(current) / dif
-        eta = int((float(total) - float(current)) / rate)
-        (eta_mins, eta_secs) = divmod(eta, 60)
-        if eta_mins > 99:
-            return '--:--'
-        return '%02d:%02d' % (eta_mins, eta_secs)
+    def _starts_at(data, offset):
+        # True if the response holds the file from offset on. Error
+        # pages never do.
+        if data.status == 200:
+            return offset == 0
+        if data.status == 206:
+            return FileDownloader._get_range_start(data) == offset
+        return False
 
     @staticmethod
-    def _calc_progress_percent(received, total):
-        if total is None:
-            return '-.-%'
-        percent = float(received) / total * 100
-        percent = '%.1f' % percent
-        return percent
+    def _get_range_start(data):
+        # Returns the first byte position of a partial response
+        if data.status != 206:
+            return 0
+        content_range = data.headers.get("Content-Range", '')
+        try:
+            # bytes 100-999/1000
+            return int(content_range.split()[1].split('-')[0])
+        except (IndexError, ValueError):
+            log.debug('Bad Content-Range: %s', content_range)
+            return 0
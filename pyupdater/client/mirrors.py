@@ -0,0 +1,204 @@
+# ------------------------------------------------------------------------------
+# Copyright (c) 2015-2017 Digital Sapphire
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the
+# following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF
+# ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+# TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR
+# ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE
+# OR OTHER DEALINGS IN THE SOFTWARE.
+# ------------------------------------------------------------------------------
+from __future__ import unicode_literals
+
+import logging
+import os
+import threading
+import time
+
+import urllib3
+
+from pyupdater import settings
+from pyupdater.client.downloader import get_local_folder
+from pyupdater.compat import url_quote
+from pyupdater.utils import JSONStore
+
+log = logging.getLogger(__name__)
+
+
+class MirrorSelector(object):
+    """Ranks update mirrors by time to first byte & recent failures.
+    The ranking is saved in the data dir so later sessions start with
+    the fastest healthy mirror.
+
+    ######Args:
+
+    urls (list): Update urls in the configured order
+
+    data_dir (str): Folder to save the ranking in
+
+    http_pool (urllib3.PoolManager): Connection pool used for probes
+
+    ######Kwargs:
+
+    probe_filename (str): Small file every mirror hosts. Used for probes
+
+    probe_timeout (float): Seconds to wait for a mirror to answer
+
+    probe_interval (int): Seconds before a saved ranking is probed again
+    """
+
+    # Weight of the newest sample in the moving averages
+    ALPHA = 0.3
+
+    # Seconds added to a mirrors score for a 100% failure rate
+    FAILURE_PENALTY = 5.0
+
+    # Cooldown after a failure. Doubles with every consecutive failure.
+    COOLDOWN = 60
+    MAX_COOLDOWN = 60 * 60
+
+    def __init__(self, urls, data_dir, http_pool, **kwargs):
+        self.urls = list(urls)
+        self.http_pool = http_pool
+        self.probe_filename = kwargs.get('probe_filename',
+                                         settings.KEY_FILE_FILENAME)
+        self.probe_timeout = kwargs.get('probe_timeout', 2.0)
+        self.probe_interval = kwargs.get('probe_interval', 60 * 60)
+        self.path = os.path.join(data_dir, settings.MIRROR_FILE_FILENAME)
+        self._lock = threading.Lock()
+        self.stats = JSONStore(self.path)
+
+    def get_urls(self):
+        """Returns the update urls ordered fastest healthy mirror first.
+        Mirrors in cooldown are kept as a last resort after the healthy
+        mirrors.
+
+        ######Returns (list)
+        """
+        now = time.time()
+        remote = self._remote_urls()
+        healthy = [u for u in remote if not self._in_cooldown(u, now)]
+        cooling = [u for u in remote if u not in healthy]
+        # Local sources are always used first
+        local = [u for u in self.urls if u not in remote]
+        # Stable sort keeps the configured order for unranked mirrors
+        return (local + sorted(healthy, key=self._score) +
+                sorted(cooling, key=self._score))
+
+    def needs_probe(self):
+        """Returns True if a mirror has no recent measurement"""
+        now = time.time()
+        for u in self._remote_urls():
+            last = self.stats.get(u, {}).get('last_probe', 0)
+            if now - last > self.probe_interval:
+                return True
+        return False
+
+    def probe(self):
+        """Measures every mirror concurrently & saves the ranking"""
+        remote = self._remote_urls()
+        log.debug('Probing %s mirrors', len(remote))
+        threads = []
+        for u in remote:
+            t = threading.Thread(target=self._probe, args=(u,))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+        self.save()
+
+    def record_success(self, url, ttfb):
+        """Adds a successful request to the mirrors history
+
+        ######Args:
+
+        url (str): Mirror url
+
+        ttfb (float): Seconds until the first byte was received
+        """
+        with self._lock:
+            stat = self.stats.setdefault(url, {})
+            old = stat.get('ttfb')
+            stat['ttfb'] = ttfb if old is None else self._avg(old, ttfb)
+            stat['fail_rate'] = self._avg(stat.get('fail_rate', 0.0), 0.0)
+            stat['failures'] = 0
+            stat['cooldown_until'] = 0
+
+    def record_failure(self, url):
+        """Adds a failed request to the mirrors history & puts the mirror
+        in cooldown
+
+        ######Args:
+
+        url (str): Mirror url
+        """
+        with self._lock:
+            stat = self.stats.setdefault(url, {})
+            stat['fail_rate'] = self._avg(stat.get('fail_rate', 0.0), 1.0)
+            stat['failures'] = stat.get('failures', 0) + 1
+            cooldown = min(self.COOLDOWN * 2 ** (stat['failures'] - 1),
+                           self.MAX_COOLDOWN)
+            stat['cooldown_until'] = time.time() + cooldown
+            log.debug('Mirror %s in cooldown for %s seconds', url, cooldown)
+
+    def _probe(self, url):
+        start = time.time()
+        try:
+            r = self.http_pool.urlopen('HEAD',
+                                       url + url_quote(self.probe_filename),
+                                       retries=False,
+                                       timeout=self.probe_timeout)
+            r.release_conn()
+            if r.status >= 400:
+                raise ValueError('Status {}'.format(r.status))
+        except (urllib3.exceptions.HTTPError, ValueError) as err:
+            log.debug('Mirror probe failed: %s', url)
+            log.debug(err, exc_info=True)
+            self.record_failure(url)
+        else:
+            ttfb = time.time() - start
+            log.debug('Mirror %s answered in %.3f seconds', url, ttfb)
+            self.record_success(url, ttfb)
+        with self._lock:
+            self.stats.setdefault(url, {})['last_probe'] = time.time()
+
+    def _remote_urls(self):
+        # Local update sources aren't probed or ranked
+        return [u for u in self.urls if get_local_folder(u) is None]
+
+    def _score(self, url):
+        stat = self.stats.get(url, {})
+        ttfb = stat.get('ttfb')
+        if ttfb is None:
+            return float('inf')
+        return ttfb + stat.get('fail_rate', 0.0) * self.FAILURE_PENALTY
+
+    def _in_cooldown(self, url, now):
+        return self.stats.get(url, {}).get('cooldown_until', 0) > now
+
+    def _avg(self, old, new):
+        return old + self.ALPHA * (new - old)
+
+    def save(self):
+        """Writes the ranking to the data dir"""
+        with self._lock:
+            try:
+                self.stats.sync(force=True)
+            except Exception as err:
+                log.debug('Failed to save mirror ranking')
+                log.debug(err, exc_info=True)
@@ -24,18 +24,29 @@
 # ------------------------------------------------------------------------------
 from __future__ import unicode_literals, print_function
 
+import hashlib
+import io
 import logging
+import mmap
 import os
+import threading
+import time
 
 import bsdiff4
+from bsdiff4.format import read_patch
 
-from dsdev_utils.crypto import get_package_hashes
 from dsdev_utils.helpers import EasyAccessDict, Version
-from dsdev_utils.paths import ChDir, remove_any
+from dsdev_utils.paths import remove_any
 from dsdev_utils.system import get_system
 
-from pyupdater.client.downloader import FileDownloader
+from pyupdater.client.costs import CostModel
+from pyupdater.client.downloader import create_http_pool, FileDownloader
+from pyupdater.client.planner import get_manifest_hash, PatchPlanner
+from pyupdater.client.progress import ProgressReporter
+from pyupdater.client.sizes import SizeProbe
 from pyupdater import settings
+from pyupdater.utils.diff_engines import (Bsdiff4Engine, DEFAULT_ENGINE,
+                                          get_engine, open_block)
 from pyupdater.utils.exceptions import PatcherError
 
 log = logging.getLogger(__name__)
@@ -43,6 +54,18 @@ log = logging.getLogger(__name__)
 _PLATFORM = get_system()
 
 
+def _get_file_hash(path):
+    # sha256 of a file without reading all of it in to memory
+    hash_ = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while 1:
+            block = f.read(1024 * 1024)
+            if len(block) == 0:
+                break
+            hash_.update(block)
+    return hash_.hexdigest()
+
+
 class Patcher(object):
     """Downloads, verifies, and patches binaries
 
@@ -69,8 +92,41 @@ class Patcher(object):
         max_download_retries (int): Number of times to retry a download
 
         urllib3_headers (dict): Headers to be used with http request
+
+        http_pool (urllib3.PoolManager): Connection pool shared with the
+        client
+
+        rate_limiter (RateLimiter): Download speed limit shared with the
+        client
+
+        mirrors (MirrorSelector): Mirror ranking shared with the client.
+        Updated with the results of patch downloads.
+
+        download_cache (DownloadCache): Verified downloads shared with
+        other apps
+
+        data_dir (str): Folder for the sizes of downloads missing from the
+        version manifest & the measured download & patch speeds
+
+        patch_downloads (int): Patches downloaded concurrently. Patches
+        are applied while the ones after them download.
+
+        cancel_event (threading.Event): Stops the patch update once set.
+        start returns False when cancelled.
+
+    Archives larger than IN_MEMORY_MAX_SIZE are patched from disk one
+    patch at a time, so memory use doesn't grow with the archive size.
+
+    Each patch is applied with the diff engine & patch format named in
+    the version manifest. bsdiff4 format 1 when none is named.
     """
 
+    # Largest archive patched in memory
+    IN_MEMORY_MAX_SIZE = 16 * 1024 * 1024
+
+    # Bytes of the base archive patched at once when patching from disk
+    BLOCK_SIZE = 1024 * 1024
+
     def __init__(self, **kwargs):
         self.name = kwargs.get('name')
         self.json_data = kwargs.get('json_data')
@@ -82,19 +138,50 @@ class Patcher(object):
         self.verify = kwargs.get('verify', True)
         self.max_download_retries = kwargs.get('max_download_retries')
         self.urllib3_headers = kwargs.get('urllib3_headers')
+        self.http_pool = kwargs.get('http_pool')
+        self.rate_limiter = kwargs.get('rate_limiter')
+        self.mirrors = kwargs.get('mirrors')
+        self.download_cache = kwargs.get('download_cache')
+        # Holds the sizes of downloads missing from the manifest
+        self.data_dir = kwargs.get('data_dir')
+        self.patch_downloads = max(kwargs.get('patch_downloads') or 4, 1)
+
+        # Speeds of earlier downloads & patches. Used to pick the faster
+        # of a patch & full update.
+        self.cost_model = None
+        if self.data_dir is not None:
+            self.cost_model = CostModel(self.data_dir)
+
+        # Set to stop the patch update
+        self.cancel_event = kwargs.get('cancel_event')
+
+        # Estimated seconds of the planned patch update. None if unknown.
+        self.expected_time = None
+
+        # Percent of the planned patches applied
+        self.progress = 0
 
         # Progress hooks to be called
         self.progress_hooks = kwargs.get('progress_hooks', [])
+        # Calls the progress hooks on a background thread
+        self._progress_reporter = ProgressReporter(self.progress_hooks)
 
         # List of dicts with urls, filename & hash of each patch
         self.patch_data = []
 
-        # List of binary blobs of patch data
+        # List of buffers of patch data. Large patches are memory mapped.
         self.patch_binary_data = []
 
-        # binary blob of original archive to patch
+        # Downloaders holding the patch buffers
+        self._patch_downloaders = []
+
+        # binary blob of original archive to patch. None when patching
+        # from disk.
         self.og_binary = None
 
+        # Result of the patches applied from disk
+        self._patched_filename = None
+
         # ToDo: Update tests with linux archives.
         # Used for testing.
         self.platform = kwargs.get('platform', _PLATFORM)
@@ -124,44 +211,53 @@ class Patcher(object):
             log.debug('Cannot find all patches...')
             return False
 
-        # Download and verify patches in 1 go
-        download_check = self._download_verify_patches()
-        if download_check is False:
-            log.debug('Patch check failed...')
+        # Download, verify & apply patches in 1 go
+        try:
+            if self._download_apply_patches() is False:
+                log.debug('Patch check failed...')
+                self._remove_patched_file()
+                return False
+        except PatcherError:
+            log.debug('Failed to apply patches')
+            self._remove_patched_file()
             return False
 
         try:
-            self._apply_patches_in_memory()
-        except PatcherError:
-            log.debug('Failed to apply patches in memory')
+            self._write_update_to_disk()
+        except PatcherError as err:
+            log.debug(err, exc_info=True)
+            self._remove_patched_file()
             return False
-        else:
-            try:
-                self._write_update_to_disk()
-            except PatcherError as err:
-                log.debug(err, exc_info=True)
-                return False
         # Looks like all is well
         return True
 
+    def _remove_patched_file(self):
+        # Result of patches applied from disk before a failure
+        if self._patched_filename is not None:
+            remove_any(self._patched_filename)
+            self._patched_filename = None
+
     def _verify_installed_binary(self):
         # Verifies latest downloaded archive against known hash
         log.debug('Checking for current installed binary to patch')
         status = True
 
-        with ChDir(self.update_folder):
-            if not os.path.exists(self.current_filename):
-                log.debug('Cannot find archive to patch')
+        # Full paths keep this safe to run next to other downloads
+        path = os.path.join(self.update_folder, self.current_filename)
+        if not os.path.exists(path):
+            log.debug('Cannot find archive to patch')
+            status = False
+        else:
+            installed_file_hash = _get_file_hash(path)
+            if self.current_file_hash != installed_file_hash:
+                log.debug('Binary hash mismatch')
                 status = False
+            elif os.path.getsize(path) > self.IN_MEMORY_MAX_SIZE:
+                log.debug('Archive will be patched from disk')
             else:
-                installed_file_hash = get_package_hashes(self.current_filename)
-                if self.current_file_hash != installed_file_hash:
-                    log.debug('Binary hash mismatch')
-                    status = False
-                else:
-                    # Read binary into memory to begin patching
-                    with open(self.current_filename, 'rb') as f:
-                        self.og_binary = f.read()
+                # Read binary into memory to begin patching
+                with open(path, 'rb') as f:
+                    self.og_binary = f.read()
 
         if status:
             log.debug('Binary found and verified')
@@ -171,170 +267,327 @@ class Patcher(object):
     # that is greater then the current version to the list
     # of needed patches.
     def _get_patch_info(self):
-        # Taking the list of needed patches and extracting the
-        # patch data from it. If any loop fails, will return False
-        # and start full binary update.
+        # Plans the patches with the fewest bytes from the installed
+        # version to latest. If no patches are smaller than the full
+        # update, will return False and start full binary update.
         log.debug('Getting patch meta-data')
-        required_patches = self._get_required_patches(self.name)
+        version_key = '{}*{}'.format(settings.UPDATES_KEY, self.name)
+        versions = self.star_access_update_data.get(version_key)
+        if not versions:
+            log.debug('No updates found in updates dict')
+            return False
 
-        if len(required_patches) == 0:
+        latest_info = self._get_info(self.name, self.latest_version,
+                                     option='file')
+        latest_file_size = Patcher._get_size(latest_info.get('file_size'))
+        # Version manifests made before we added sizes don't have them.
+        # Asking the update server for the missing sizes.
+        if latest_file_size is None and latest_info.get('filename'):
+            sizes = self._probe_sizes([(latest_info['filename'],
+                                        latest_info['file_hash'])])
+            latest_file_size = sizes.get(latest_info['file_hash'])
+
+        planner = PatchPlanner(versions, self.platform)
+        plan = planner.plan(self.current_version,
+                            Version(self.latest_version), latest_file_size,
+                            get_sizes=self._probe_sizes,
+                            manifest_hash=get_manifest_hash(self.json_data),
+                            cost_model=self.cost_model)
+        if len(plan) == 0:
             log.debug('No patches to process')
             return False
 
-        # If we can't get the file size for all patches & the latest
-        # full update we fall back to the old patch update limit of 4
-        # We will only patch update if the total size of all needed
-        # patches are less than the size of a full update
-        fall_back = False
-        total_patch_size = 0
+        if self.cost_model is not None:
+            self.expected_time = self.cost_model.estimate(
+                sum(p['patch_size'] or 0 for p in plan),
+                sum(p['file_size'] or latest_file_size or 0 for p in plan))
 
-        # Loop through all required patches and get file name, hash
-        # and file size.
-        for p in required_patches:
+        for p in plan:
             info = {}
-            platform_key = '{}*{}*{}*{}'.format(settings.UPDATES_KEY,
-                                                self.name, str(p),
-                                                self.platform)
-            platform_info = self.star_access_update_data.get(platform_key)
-
-            try:
-                info['patch_name'] = platform_info['patch_name']
-                info['patch_urls'] = self.update_urls
-                info['patch_hash'] = platform_info['patch_hash']
-                patch_size = platform_info.get('patch_size')
-
-                if patch_size is None:
-                    # Since we are missing the patch size we cannot
-                    # compare the total size of all patches to the size
-                    # of a full update. Used for backwards compatibility
-                    # before we added patch size to version manifest.
-                    fall_back = True
-                else:
-                    try:
-                        total_patch_size += int(patch_size)
-                    except Exception as err:
-                        log.debug(err, exc_info=True)
-                        fall_back = True
-                self.patch_data.append(info)
-            except Exception as err:  # pragma: no cover
-                # Missing some required patch data
-                log.debug(err, exc_info=True)
-                return False
-
-        latest_info = self._get_info(self.name, self.latest_version,
-                                     option='file')
-        latest_file_size = latest_info.get('file_size')
-        if latest_file_size is None:
-            # Since we are missing the full update size we cannot
-            # compare the total size of all patches to the full update.
-            fall_back = True
-
-        if fall_back is True:
-            if len(required_patches) > 4:
-                return False
-            else:
-                return True
-        else:
-            return Patcher._calc_diff(total_patch_size, latest_file_size)
+            info['patch_name'] = p['patch_name']
+            info['patch_urls'] = self.update_urls
+            info['patch_hash'] = p['patch_hash']
+            info['patch_size'] = p['patch_size']
+            info['patch_engine'] = p['patch_engine']
+            info['patch_format'] = p['patch_format']
+            self.patch_data.append(info)
+        return True
 
     @staticmethod
-    def _calc_diff(patch_size, file_size):
-        if patch_size < file_size:
-            return True
-        else:
-            return False
-
-    def _get_required_patches(self, name):
-        # Gathers patch name, hash & URL
-        needed_patches = []
+    def _get_size(size):
+        # Sizes in the manifest may be missing or malformed
+        if size is None:
+            return None
         try:
-            # Get list of Version objects initialized with keys
-            # from update manifest
-            version_key = '{}*{}'.format(settings.UPDATES_KEY, name)
-            version_info = self.star_access_update_data(version_key)
-            versions = map(Version, version_info.keys())
-        except KeyError:  # pragma: no cover
-            log.debug('No updates found in updates dict')
-            # Will cause error to be thrown in _get_patch_info
-            # which will cause patch update to return False
-            versions = [1]
-
-        # Only stable packages have patch info
-        versions = [v for v in versions if v.channel == 'stable']
-
-        log.debug('Getting required patches')
-        for i in versions:
-            if i > self.current_version:
-                needed_patches.append(i)
-
-        # Used to guarantee patches are only added once
-        needed_patches = list(set(needed_patches))
-
-        # Ensuring we apply patches in correct order
-        return sorted(needed_patches)
-
-    def _download_verify_patches(self):
-        # Downloads & verifies all patches
-        log.debug('Downloading patches')
-        downloaded = 0
-        percent = 0
+            return int(size)
+        except Exception as err:
+            log.debug(err, exc_info=True)
+            return None
+
+    def _probe_sizes(self, files):
+        if self.data_dir is None or len(self.update_urls) == 0:
+            return {}
+        http_pool = self.http_pool
+        if http_pool is None:
+            http_pool = create_http_pool(self.verify is True,
+                                         self.urllib3_headers)
+        probe = SizeProbe(self.update_urls, self.data_dir, http_pool)
+        return probe.get_sizes(files)
+
+    def _download_apply_patches(self):
+        # Downloads patches on up to patch_downloads threads & applies
+        # each one as soon as it & every patch before it are ready.
+        # Patches are downloaded in the order they're applied.
+        log.debug('Downloading & applying patches')
         total = len(self.patch_data)
+        self.patch_binary_data = [None] * total
+        self._patch_downloaders = [None] * total
+        state = {'next': 0, 'downloaded': 0, 'failed': False}
+        cond = threading.Condition()
+        threads = []
+        for _ in range(min(self.patch_downloads, total)):
+            t = threading.Thread(target=self._download_patches,
+                                 args=(state, cond))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+
+        # Progress is reported from this thread only
+        reported = 0
+        try:
+            for i in range(total):
+                while 1:
+                    with cond:
+                        while (state['downloaded'] == reported and
+                                self.patch_binary_data[i] is None and
+                                state['failed'] is False):
+                            self._check_cancelled()
+                            cond.wait(0.1)
+                        downloaded = state['downloaded']
+                        ready = self.patch_binary_data[i] is not None
+                        failed = state['failed']
+                    while reported < downloaded:
+                        reported += 1
+                        self._report_patch_download(reported, total,
+                                                    'downloading')
+                        if reported == total:
+                            self._report_patch_download(reported, total,
+                                                        'finished')
+                    if ready:
+                        break
+                    if failed:
+                        # Since patches are applied sequentially
+                        # we cannot continue successfully
+                        self._report_patch_download(
+                            reported, total, 'failed to download all patches')
+                        return False
+                self._apply_next_patch(i)
+        finally:
+            with cond:
+                # Stops the downloads of patches we won't need
+                state['failed'] = state['failed'] or reported < total
+            for t in threads:
+                t.join()
+            self._release_patches()
+            if self.cost_model is not None:
+                self.cost_model.save()
+            self._progress_reporter.flush()
+        return True
 
-        for p in self.patch_data:
-            # Initialize downloader
+    def _download_patches(self, state, cond):
+        # Download thread. Takes the next patch until all are taken or
+        # one of them failed.
+        while 1:
+            with cond:
+                if state['failed'] is True or state['next'] >= len(
+                        self.patch_data):
+                    return
+                index = state['next']
+                state['next'] += 1
+            p = self.patch_data[index]
             fd = FileDownloader(p['patch_name'], p['patch_urls'],
                                 hexdigest=p['patch_hash'], verify=self.verify,
                                 max_download_retries=self.max_download_retries,
-                                urllb3_headers=self.urllib3_headers)
-
-            # Attempt to download resource
-            data = fd.download_verify_return()
-            percent = int((float(downloaded + 1) / float(total)) * 100)
-            percent = '{0:.1f}'.format(percent)
-            if data is not None:
-                self.patch_binary_data.append(data)
-                downloaded += 1
-                status = {'total': total,
-                          'downloaded': downloaded,
-                          'percent_complete': percent,
-                          'status': 'downloading'}
-                self._call_progress_hooks(status)
-            else:
-                # Since patches are applied sequentially
-                # we cannot continue successfully
-                status = {'total': total,
-                          'downloaded': downloaded,
-                          'percent_complete': percent,
-                          'status': 'failed to download all patches'}
-                self._call_progress_hooks(status)
-                return False
+                                urllb3_headers=self.urllib3_headers,
+                                http_pool=self.http_pool,
+                                rate_limiter=self.rate_limiter,
+                                mirrors=self.mirrors,
+                                cache=self.download_cache,
+                                folder=self.update_folder,
+                                cancel_event=self.cancel_event)
+            if self.og_binary is None:
+                # Patching from disk. Keeping all patches on disk too.
+                fd.download_max_size = 0
+
+            # Large patches are kept on disk in the update folder
+            data = None
+            try:
+                data = fd.download_verify_buffer()
+            except Exception as err:
+                log.debug(err, exc_info=True)
+            if data is not None and self.cost_model is not None:
+                self.cost_model.record_download(fd.bytes_received,
+                                                fd.throughput)
+            with cond:
+                if data is None:
+                    state['failed'] = True
+                else:
+                    self._patch_downloaders[index] = fd
+                    self.patch_binary_data[index] = data
+                    state['downloaded'] += 1
+                cond.notify_all()
 
+    def _report_patch_download(self, downloaded, total, status):
+        percent = int((float(downloaded) / float(total)) * 100)
         status = {'total': total,
                   'downloaded': downloaded,
-                  'percent_complete': percent,
-                  'status': 'finished'}
-        self._call_progress_hooks(status)
+                  'percent_complete': '{0:.1f}'.format(percent),
+                  'status': status}
+        self._progress_reporter.report(status)
+
+    def _apply_next_patch(self, index):
+        # Applies a patch to the result of the patches before it. The
+        # patch is released once applied.
+        self._check_cancelled()
+        patch = self.patch_binary_data[index]
+        engine = self.patch_data[index]['patch_engine']
+        start = time.time()
+        try:
+            if self.og_binary is None:
+                self._apply_next_patch_file(index, patch)
+                size = os.path.getsize(self._patched_filename)
+            elif engine == DEFAULT_ENGINE and \
+                    self.patch_data[index]['patch_format'] == 1:
+                self.og_binary = Patcher._apply_patch(self.og_binary, patch)
+                size = len(self.og_binary)
+            else:
+                self.og_binary = get_engine(engine).patch(self.og_binary,
+                                                          patch)
+                size = len(self.og_binary)
+            log.debug('Applied patch successfully')
+        except Exception as err:
+            log.debug(err, exc_info=True)
+            raise PatcherError('Patch failed to apply')
+        finally:
+            del patch
+            self.patch_binary_data[index] = None
+            self._patch_downloaders[index].release()
+            self._patch_downloaders[index] = None
+        if self.cost_model is not None:
+            self.cost_model.record_apply(size, time.time() - start)
+        self.progress = int(float(index + 1) / len(self.patch_data) * 100)
+
+    def _apply_next_patch_file(self, index, patch):
+        # Each patch applied from disk writes a temporary file & the one
+        # before it is removed.
+        src = self._patched_filename
+        if src is None:
+            src = os.path.join(self.update_folder, self.current_filename)
+        dst = os.path.join(self.update_folder, '{}.patching{}'.format(
+            self.current_filename, index))
+        engine = self.patch_data[index]['patch_engine']
+        try:
+            if engine == DEFAULT_ENGINE:
+                self._apply_patch_file(src, patch, dst)
+            else:
+                get_engine(engine).patch_file(src, patch, dst)
+        except Exception:
+            remove_any(dst)
+            raise
+        finally:
+            if src != os.path.join(self.update_folder, self.current_filename):
+                remove_any(src)
+        self._patched_filename = dst
+
+    def _apply_patch_file(self, src_path, patch, dst_path):
+        # Applies a bsdiff4 patch buffer of format 1 or 2 to src_path &
+        # writes the result to dst_path. The base is memory mapped & the
+        # patch decompressed as it's applied, so only BLOCK_SIZE bytes of
+        # each are held in memory.
+        try:
+            codec, len_control, len_diff, len_dst, start = \
+                Bsdiff4Engine.read_header(patch)
+            control = open_block(codec, patch, start, start + len_control)
+            start += len_control
+            diff = open_block(codec, patch, start, start + len_diff)
+            extra = open_block(codec, patch, start + len_diff, len(patch))
+        except ValueError as err:
+            raise PatcherError(str(err))
+
+        with open(src_path, 'rb') as fsrc:
+            src_size = os.fstat(fsrc.fileno()).st_size
+            src = b''
+            if src_size > 0:
+                src = mmap.mmap(fsrc.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                with open(dst_path, 'wb') as fdst:
+                    old_pos = new_pos = 0
+                    while new_pos < len_dst:
+                        self._check_cancelled()
+                        entry = control.read(24)
+                        if len(entry) < 24:
+                            raise PatcherError('Corrupt patch control block')
+                        add, copy, seek = [
+                            bsdiff4.core.decode_int64(entry[i:i + 8])
+                            for i in (0, 8, 16)]
+                        if new_pos + add + copy > len_dst:
+                            raise PatcherError('Corrupt patch')
+                        # Adding the diff block to the base
+                        for offset in range(0, add, self.BLOCK_SIZE):
+                            size = min(add - offset, self.BLOCK_SIZE)
+                            base = Patcher._read_base(src, src_size,
+                                                      old_pos + offset, size)
+                            data = diff.read(size)
+                            if len(data) < size:
+                                raise PatcherError('Corrupt patch diff block')
+                            fdst.write(bsdiff4.core.patch(
+                                base, size, [(size, 0, 0)], data, b''))
+                        # Copying new data from the extra block
+                        for offset in range(0, copy, self.BLOCK_SIZE):
+                            size = min(copy - offset, self.BLOCK_SIZE)
+                            data = extra.read(size)
+                            if len(data) < size:
+                                raise PatcherError('Corrupt patch extra block')
+                            fdst.write(data)
+                        new_pos += add + copy
+                        old_pos += add + seek
+            finally:
+                if src_size > 0:
+                    src.close()
 
-        return True
+    @staticmethod
+    def _read_base(src, src_size, start, size):
+        # Bytes of the base from start. Bytes outside of the base are
+        # zeros, which bsdiff adds nothing for.
+        lo = min(max(start, 0), src_size)
+        hi = max(min(start + size, src_size), lo)
+        if lo == hi:
+            return b'\0' * size
+        return (b'\0' * (lo - start) + src[lo:hi] +
+                b'\0' * (start + size - hi))
 
-    def _call_progress_hooks(self, data):
-        for ph in self.progress_hooks:
-            try:
-                ph(data)
-            except Exception as err:
-                log.debug('Exception in callback: %s', ph.__name__)
-                log.debug(err, exc_info=True)
+    @staticmethod
+    def _apply_patch(src, patch):
+        # Memory mapped patches are read like a file, so only the
+        # decompressed sections are held in memory
+        if isinstance(patch, mmap.mmap):
+            patch.seek(0)
+            patch_file = patch
+        else:
+            patch_file = io.BytesIO(patch)
+        return bsdiff4.core.patch(src, *read_patch(patch_file))
 
-    def _apply_patches_in_memory(self):
-        # Applies a sequence of patches in memory
-        log.debug('Applying patches')
-        for i in self.patch_binary_data:
-            try:
-                self.og_binary = bsdiff4.patch(self.og_binary, i)
-                log.debug('Applied patch successfully')
-            except Exception as err:
-                log.debug(err, exc_info=True)
-                raise PatcherError('Patch failed to apply')
+    def _check_cancelled(self):
+        if self.cancel_event is not None and self.cancel_event.is_set():
+            raise PatcherError('Patch update cancelled')
+
+    def _release_patches(self):
+        # Closes patch buffers & removes their temporary files
+        self.patch_binary_data = []
+        for fd in self._patch_downloaders:
+            if fd is not None:
+                fd.release()
+        self._patch_downloaders = []
 
     def _write_update_to_disk(self):  # pragma: no cover
         # Writes updated binary to disk
@@ -349,31 +602,42 @@ class Patcher(object):
         if filename is None:
             raise PatcherError('Filename missing in version file')
 
-        with ChDir(self.update_folder):
-            try:
-                with open(filename, 'wb') as f:
+        self._check_cancelled()
+        # The update is verified before it replaces anything at filename
+        path = os.path.join(self.update_folder, filename)
+        patched = self._patched_filename
+        try:
+            if self.og_binary is not None:
+                patched = path + '.patched'
+                with open(patched, 'wb') as f:
                     f.write(self.og_binary)
-                log.debug('Wrote update file')
-            except IOError:
-                # Removes file if it got created
-                if os.path.exists(filename):
-                    remove_any(filename)
-                log.debug('Failed to open file for writing')
-                raise PatcherError('Failed to open file for writing')
-            else:
-                file_info = self._get_info(self.name,
-                                           self.latest_version, option='file')
-
-                new_file_hash = file_info['file_hash']
-                log.debug('checking file hash match')
-                if new_file_hash != get_package_hashes(filename):
-                    log.debug('Version file hash: %s', new_file_hash)
-                    log.debug('Actual file hash: %s',
-                              get_package_hashes(filename))
-                    log.debug('File hash does not match')
-                    remove_any(filename)
-                    raise PatcherError('Bad hash on patched file',
-                                       expected=True)
+        except (IOError, OSError):
+            # Removes file if it got created
+            remove_any(patched)
+            log.debug('Failed to open file for writing')
+            raise PatcherError('Failed to open file for writing')
+
+        file_info = self._get_info(self.name, self.latest_version,
+                                   option='file')
+        new_file_hash = file_info['file_hash']
+        log.debug('checking file hash match')
+        file_hash = _get_file_hash(patched)
+        if new_file_hash != file_hash:
+            log.debug('Version file hash: %s', new_file_hash)
+            log.debug('Actual file hash: %s', file_hash)
+            log.debug('File hash does not match')
+            remove_any(patched)
+            raise PatcherError('Bad hash on patched file', expected=True)
+
+        try:
+            if os.path.exists(path):
+                remove_any(path)
+            os.rename(patched, path)
+            log.debug('Wrote update file')
+        except (IOError, OSError):
+            remove_any(patched)
+            log.debug('Failed to move update in to place')
+            raise PatcherError('Failed to open file for writing')
 
     def _get_info(self, name, version, option='file'):
         if option == 'file':
@@ -0,0 +1,310 @@
+# ------------------------------------------------------------------------------
+# Copyright (c) 2015-2017 Digital Sapphire
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the
+# following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF
+# ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+# TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR
+# ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE
+# OR OTHER DEALINGS IN THE SOFTWARE.
+# ------------------------------------------------------------------------------
+from __future__ import unicode_literals
+
+import hashlib
+import heapq
+import json
+import logging
+import threading
+
+from dsdev_utils.helpers import Version
+
+from pyupdater.utils.diff_engines import DEFAULT_ENGINE, is_supported
+
+log = logging.getLogger(__name__)
+
+
+def get_manifest_hash(json_data):
+    """Returns a hash of the version manifest. Plans are cached by it.
+
+    ######Args:
+
+    json_data (dict): The version manifest
+
+    ######Returns (str): sha256 of the manifest
+    """
+    data = json.dumps(json_data, sort_keys=True).encode('utf-8')
+    return hashlib.sha256(data).hexdigest()
+
+
+class PatchPlanner(object):
+    """Picks the smallest download that updates an archive to the
+    latest version. Every published patch is an edge from its base
+    version to its target version, weighted by its size in bytes.
+    The full archive is an edge from the installed version to latest.
+
+    Patches in the version manifest are made from the stable version
+    before them. Skip patches from older bases are listed under their
+    base version in the "patches" key of the target version.
+
+    Patches made with a diff engine, patch format or codec that isn't
+    supported here are skipped.
+
+    ######Args:
+
+    versions (dict): Version manifest entries of the app
+
+    platform (str): Platform of the archives
+    """
+
+    # Most patches applied when their sizes are unknown
+    MAX_UNSIZED_PATCHES = 4
+
+    # Plans of the most recent manifest
+    _cache = {}
+    _cache_hash = None
+    _cache_lock = threading.Lock()
+
+    def __init__(self, versions, platform):
+        self.versions = versions or {}
+        self.platform = platform
+
+    def get_patches(self):
+        """Returns every patch published for the platform
+
+        ######Returns (list): Patch info dicts with base & target versions.
+        Only patches supported here.
+        """
+        stable = []
+        for k, v in self.versions.items():
+            try:
+                version = Version(k)
+            except Exception as err:
+                log.debug(err, exc_info=True)
+                continue
+            info = v.get(self.platform)
+            # Only stable packages have patch info
+            if version.channel == 'stable' and info is not None:
+                stable.append((version, info))
+        stable.sort(key=lambda x: x[0])
+
+        patches = []
+        for i, (version, info) in enumerate(stable):
+            if i > 0 and info.get('patch_name') and info.get('patch_hash'):
+                patches.append(PatchPlanner._make_patch(stable[i - 1][0],
+                                                        version, info, info))
+            skip_patches = info.get('patches') or {}
+            for base, patch in skip_patches.items():
+                if not patch.get('patch_name') or not patch.get('patch_hash'):
+                    continue
+                try:
+                    base = Version(base)
+                except Exception as err:
+                    log.debug(err, exc_info=True)
+                    continue
+                patches.append(PatchPlanner._make_patch(base, version, patch,
+                                                        info))
+        return [p for p in patches if is_supported(
+            p['patch_engine'], p['patch_format'], p['patch_codec'])]
+
+    def plan(self, current, latest, full_size, get_sizes=None,
+             manifest_hash=None, cost_model=None):
+        """Returns the patches with the fewest total bytes to update from
+        current to latest.
+
+        ######Args:
+
+        current (Version): Installed version
+
+        latest (Version): Version to update to
+
+        full_size (int): Size of the full archive of latest. None if
+        unknown.
+
+        ######Kwargs:
+
+        get_sizes (callable): Called with (filename, hash) tuples of
+        patches missing their size. Returns a dict of hash to size.
+
+        manifest_hash (str): Hash of the version manifest. Plans of the
+        same manifest are cached.
+
+        cost_model (CostModel): Measured download & patch speeds. Once
+        the download speed is known, the plan with the shortest estimated
+        time is picked instead of the one with the fewest bytes.
+
+        ######Returns (list): Patch info dicts in the order to apply them.
+        Empty if the full archive is faster or no path of patches
+        exists.
+        """
+        key = (self.platform, str(current), str(latest), full_size)
+        if cost_model is not None:
+            key += cost_model.key()
+        if manifest_hash is not None:
+            with PatchPlanner._cache_lock:
+                if PatchPlanner._cache_hash == manifest_hash:
+                    plan = PatchPlanner._cache.get(key)
+                    if plan is not None:
+                        log.debug('Using cached patch plan')
+                        return [dict(p) for p in plan]
+
+        # Only patches between current & latest can be part of a plan
+        patches = [p for p in self.get_patches()
+                   if Version(p['base']) >= current and
+                   Version(p['target']) <= latest]
+        # Version manifests made before we added sizes don't have them
+        missing = [(p['patch_name'], p['patch_hash'])
+                   for p in patches if p['patch_size'] is None]
+        if len(missing) > 0 and get_sizes is not None:
+            sizes = get_sizes(missing)
+            for p in patches:
+                if p['patch_size'] is None:
+                    p['patch_size'] = sizes.get(p['patch_hash'])
+
+        plan = []
+        if full_size is not None and cost_model is not None and \
+                cost_model.download_rate is not None:
+            # Applying a patch costs about as much as writing its output
+            plan = PatchPlanner.shortest_path(
+                patches, current, latest, cost_model.estimate(full_size),
+                weight=lambda p: cost_model.estimate(
+                    p['patch_size'], p['file_size'] or full_size))
+        elif full_size is not None:
+            plan = PatchPlanner.shortest_path(patches, current, latest,
+                                              full_size)
+        unsized = [p for p in patches if p['patch_size'] is None]
+        fallback = len(plan) == 0 and (full_size is None or len(unsized) > 0)
+        if fallback and full_size is not None:
+            # A sized path that costs more than the full update was
+            # compared. Only missing paths fall back.
+            fallback = len(PatchPlanner.shortest_path(
+                patches, current, latest, None)) == 0
+        if fallback:
+            # Without all sizes we cannot compare the total size of
+            # patches to the full update. Taking the fewest patches up
+            # to the old patch update limit.
+            hops = [dict(p, patch_size=1) for p in patches]
+            plan = PatchPlanner.shortest_path(hops, current, latest, None)
+            if len(plan) > self.MAX_UNSIZED_PATCHES:
+                plan = []
+            sizes = dict((p['patch_hash'], p['patch_size']) for p in patches)
+            for p in plan:
+                p['patch_size'] = sizes[p['patch_hash']]
+
+        # Plans made without all sizes may change once they're known
+        if manifest_hash is not None and full_size is not None and \
+                len(unsized) == 0:
+            with PatchPlanner._cache_lock:
+                if PatchPlanner._cache_hash != manifest_hash:
+                    PatchPlanner._cache = {}
+                    PatchPlanner._cache_hash = manifest_hash
+                PatchPlanner._cache[key] = [dict(p) for p in plan]
+        return plan
+
+    @staticmethod
+    def shortest_path(patches, current, latest, full_cost, weight=None):
+        """Dijkstra over the patches. Patches without a size are skipped.
+
+        ######Args:
+
+        patches (list): Patch info dicts from get_patches
+
+        current (Version): Installed version
+
+        latest (Version): Version to update to
+
+        full_cost (float): Cost of the full update. None if unknown.
+
+        ######Kwargs:
+
+        weight (callable): Returns the cost of a patch. Defaults to its
+        size in bytes.
+
+        ######Returns (list): Patch info dicts in the order to apply them.
+        Empty if the full update costs less or no path exists.
+        """
+        if weight is None:
+            weight = PatchPlanner._patch_size
+        start, end = str(current), str(latest)
+        edges = {}
+        for p in patches:
+            if p['patch_size'] is None:
+                continue
+            edges.setdefault(p['base'], []).append(p)
+
+        costs = {start: 0}
+        previous = {}
+        # Counter keeps the heap from comparing patch dicts
+        heap = [(0, 0, start)]
+        count = 1
+        while len(heap) > 0:
+            cost, _, node = heapq.heappop(heap)
+            if cost > costs.get(node, cost):
+                continue
+            if node == end:
+                break
+            for p in edges.get(node, []):
+                new_cost = cost + weight(p)
+                if new_cost < costs.get(p['target'], new_cost + 1):
+                    costs[p['target']] = new_cost
+                    previous[p['target']] = p
+                    heapq.heappush(heap, (new_cost, count, p['target']))
+                    count += 1
+
+        if end not in costs:
+            log.debug('No patches from %s to %s', start, end)
+            return []
+
+        if full_cost is not None and costs[end] >= full_cost:
+            log.debug('Full update costs less than patches')
+            return []
+
+        plan = []
+        node = end
+        while node != start:
+            plan.append(previous[node])
+            node = previous[node]['base']
+        plan.reverse()
+        log.debug('Patch plan: cost of %s in %s patches', costs[end],
+                  len(plan))
+        return plan
+
+    @staticmethod
+    def _patch_size(patch):
+        return patch['patch_size']
+
+    @staticmethod
+    def _make_patch(base, target, info, target_info):
+        return {'base': str(base),
+                'target': str(target),
+                'patch_name': info['patch_name'],
+                'patch_hash': info['patch_hash'],
+                'patch_size': PatchPlanner._get_size(info.get('patch_size')),
+                'file_size': PatchPlanner._get_size(
+                    target_info.get('file_size')),
+                'patch_engine': info.get('patch_engine') or DEFAULT_ENGINE,
+                'patch_format': info.get('patch_format') or 1,
+                'patch_codec': info.get('patch_codec')}
+
+    @staticmethod
+    def _get_size(size):
+        if size is None:
+            return None
+        try:
+            return int(size)
+        except Exception as err:
+            log.debug(err, exc_info=True)
+            return None
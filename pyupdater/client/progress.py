@@ -0,0 +1,218 @@
+# ------------------------------------------------------------------------------
+# Copyright (c) 2015-2017 Digital Sapphire
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the
+# following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF
+# ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+# TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR
+# ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE
+# OR OTHER DEALINGS IN THE SOFTWARE.
+# ------------------------------------------------------------------------------
+from __future__ import unicode_literals
+
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+class ProgressReporter(object):
+    """Coalesces the progress of a download & hands it to the progress
+    hooks on a background thread, so slow hooks never hold up the
+    download. Only the newest status is kept while hooks are busy.
+    Each reporter has its own thread, so a blocking hook only delays
+    its own events.
+
+    ######Args:
+
+    hooks (list): Progress callbacks
+
+    ######Kwargs:
+
+    total (int): Size of the download. None if unknown
+
+    start (int): Bytes downloaded before this session. Used when resuming
+
+    interval (float): Min seconds between progress events
+
+    step (float): Percent downloaded that triggers an event before
+    interval has passed. None to only use interval.
+    """
+
+    # Seconds flush waits for busy hooks by default
+    FLUSH_TIMEOUT = 5.0
+
+    def __init__(self, hooks, total=None, start=0, interval=0.1, step=1.0):
+        self.hooks = list(hooks or [])
+        self.total = total
+        self.start = start
+        self.interval = interval
+        self.step = step
+
+        self._start_time = time.time()
+        # Time & bytes of the last event. First update always reports.
+        self._last_time = 0.0
+        self._last_downloaded = start
+
+        self._lock = threading.Lock()
+        # Newest status not yet handed to the hooks
+        self._pending = None
+        # Statuses from report. Delivered in order, never coalesced.
+        self._reports = []
+        self._delivered = threading.Event()
+        self._delivered.set()
+        # Calls the hooks. Exits once nothing is pending.
+        self._thread = None
+
+    def update(self, downloaded):
+        """Reports bytes downloaded so far if enough time or data has
+        passed since the last event.
+
+        ######Args:
+
+        downloaded (int): Total bytes downloaded, including start
+        """
+        if len(self.hooks) == 0:
+            return
+        now = time.time()
+        if now - self._last_time < self.interval:
+            if self.total is None or self.step is None:
+                return
+            # Percent since the last event, without dividing
+            if ((downloaded - self._last_downloaded) * 100.0 <
+                    self.step * self.total):
+                return
+        self._last_time = now
+        self._last_downloaded = downloaded
+        self._post(self._status(downloaded, now, 'downloading'))
+
+    def finish(self, downloaded, status='finished'):
+        """Reports the end of the download. Always delivered.
+
+        ######Args:
+
+        downloaded (int): Total bytes downloaded
+
+        ######Kwargs:
+
+        status (str): Status of the final event
+        """
+        if len(self.hooks) == 0:
+            return
+        data = self._status(downloaded, time.time(), status)
+        data['eta'] = 0
+        data['time'] = '00:00'
+        self._post(data)
+
+    def report(self, status):
+        """Hands a prebuilt status to the hooks. Unlike progress events
+        these are never coalesced.
+
+        ######Args:
+
+        status (dict): Passed to the hooks as is
+        """
+        if len(self.hooks) == 0:
+            return
+        with self._lock:
+            self._reports.append(status)
+        self._post(None)
+
+    def flush(self, timeout=FLUSH_TIMEOUT):
+        """Waits until the hooks have been called with the newest status
+
+        ######Kwargs:
+
+        timeout (float): Max seconds to wait. None waits forever
+
+        ######Returns (bool): True if all events were delivered
+        """
+        if self._delivered.wait(timeout) is True:
+            return True
+        log.debug('Progress hooks busy for over %s seconds', timeout)
+        return False
+
+    def _status(self, downloaded, now, status):
+        elapsed = now - self._start_time
+        rate = None
+        if elapsed >= 0.001 and downloaded > self.start:
+            rate = (downloaded - self.start) / elapsed
+
+        percent = None
+        eta = None
+        if self.total is not None:
+            percent = downloaded * 100.0 / self.total if self.total else 100.0
+            if rate is not None:
+                eta = max(self.total - downloaded, 0) / rate
+
+        return {'total': self.total,
+                'downloaded': downloaded,
+                'status': status,
+                'percent': percent,
+                'rate': rate,
+                'eta': eta,
+                'elapsed': elapsed,
+                # Preformatted fields used by older hooks
+                'percent_complete': ProgressReporter._format_percent(percent),
+                'time': ProgressReporter._format_eta(eta)}
+
+    def _post(self, status):
+        with self._lock:
+            if status is not None:
+                self._pending = status
+            self._delivered.clear()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _run(self):
+        while 1:
+            with self._lock:
+                statuses = self._reports
+                if self._pending is not None:
+                    statuses.append(self._pending)
+                self._reports = []
+                self._pending = None
+                if len(statuses) == 0:
+                    self._thread = None
+                    self._delivered.set()
+                    return
+            for status in statuses:
+                log.debug(status)
+                for ph in self.hooks:
+                    try:
+                        ph(status)
+                    except Exception as err:
+                        log.debug('Exception in callback: %s', ph.__name__)
+                        log.debug(err, exc_info=True)
+
+    @staticmethod
+    def _format_percent(percent):
+        if percent is None:
+            return '-.-%'
+        return '%.1f' % percent
+
+    @staticmethod
+    def _format_eta(eta):
+        if eta is None:
+            return '--:--'
+        (eta_mins, eta_secs) = divmod(int(eta), 60)
+        if eta_mins > 99:
+            return '--:--'
+        return '%02d:%02d' % (eta_mins, eta_secs)
@@ -0,0 +1,158 @@
+# ------------------------------------------------------------------------------
+# Copyright (c) 2015-2017 Digital Sapphire
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the
+# following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF
+# ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+# TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR
+# ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE
+# OR OTHER DEALINGS IN THE SOFTWARE.
+# ------------------------------------------------------------------------------
+from __future__ import unicode_literals
+
+import logging
+import os
+import threading
+
+import urllib3
+
+from pyupdater import settings
+from pyupdater.client.downloader import get_local_folder
+from pyupdater.compat import url_quote
+from pyupdater.utils import JSONStore
+
+log = logging.getLogger(__name__)
+
+
+class SizeProbe(object):
+    """Gets the size of files missing from the version manifest with
+    concurrent HEAD requests. Sizes are saved by file hash in the data
+    dir, so every file is only probed once.
+
+    ######Args:
+
+    urls (list): Update urls in the order to try them
+
+    data_dir (str): Folder to save the sizes in
+
+    http_pool (urllib3.PoolManager): Connection pool used for probes
+
+    ######Kwargs:
+
+    timeout (float): Seconds to wait for a mirror to answer
+
+    max_probes (int): Files probed at once. Defaults to the connections
+    the pool keeps per host.
+    """
+
+    def __init__(self, urls, data_dir, http_pool, **kwargs):
+        self.urls = list(urls)
+        self.http_pool = http_pool
+        self.timeout = kwargs.get('timeout', 5.0)
+        max_probes = kwargs.get('max_probes')
+        if max_probes is None:
+            pool_kw = getattr(http_pool, 'connection_pool_kw', {})
+            max_probes = pool_kw.get('maxsize')
+        self.max_probes = max(max_probes or 1, 1)
+        self.path = os.path.join(data_dir, settings.SIZE_FILE_FILENAME)
+        self._lock = threading.Lock()
+        self.sizes = JSONStore(self.path)
+
+    def get_sizes(self, files):
+        """Returns the size of each file. Files not in the saved sizes
+        are probed concurrently.
+
+        ######Args:
+
+        files (list): (filename, file hash) tuples
+
+        ######Returns (dict): File hash to size in bytes. None if no
+        mirror reported the size.
+        """
+        sizes = {}
+        missing = []
+        for filename, file_hash in files:
+            size = self.sizes.get(file_hash)
+            if size is not None:
+                sizes[file_hash] = size
+            else:
+                missing.append((filename, file_hash))
+
+        # Up to max_probes threads take files until all are probed
+        threads = []
+        for _ in range(min(self.max_probes, len(missing))):
+            t = threading.Thread(target=self._probe_files,
+                                 args=(missing, sizes))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+        for t in threads:
+            t.join()
+        if len(threads) > 0:
+            self.save()
+        return sizes
+
+    def _probe_files(self, files, sizes):
+        while 1:
+            with self._lock:
+                if len(files) == 0:
+                    return
+                filename, file_hash = files.pop(0)
+            self._probe(filename, file_hash, sizes)
+
+    def _probe(self, filename, file_hash, sizes):
+        size = None
+        for url in self.urls:
+            folder = get_local_folder(url)
+            if folder is not None:
+                path = os.path.join(folder, filename)
+                if os.path.isfile(path):
+                    size = os.path.getsize(path)
+                    break
+                continue
+            try:
+                r = self.http_pool.urlopen('HEAD', url + url_quote(filename),
+                                           retries=False,
+                                           timeout=self.timeout)
+                r.release_conn()
+            except urllib3.exceptions.HTTPError as err:
+                log.debug('Size probe failed: %s', url)
+                log.debug(err, exc_info=True)
+                continue
+            if r.status != 200:
+                log.debug('%s answered size probe with %s', url, r.status)
+                continue
+            try:
+                size = int(r.headers.get('Content-Length'))
+            except (TypeError, ValueError):
+                log.debug('No size for %s from %s', filename, url)
+                continue
+            break
+        log.debug('Size of %s: %s', filename, size)
+        with self._lock:
+            sizes[file_hash] = size
+            if size is not None:
+                self.sizes[file_hash] = size
+
+    def save(self):
+        """Writes the sizes to the data dir"""
+        with self._lock:
+            try:
+                self.sizes.sync(force=True)
+            except Exception as err:
+                log.debug('Failed to save download sizes')
+                log.debug(err, exc_info=True)
@@ -31,6 +31,7 @@ import subprocess
 import sys
 import tarfile
 import threading
+import time
 import zipfile
 
 from dsdev_utils.helpers import Version
@@ -38,10 +39,11 @@ from dsdev_utils.paths import ChDir, get_mac_dot_app_dir, remove_any
 from dsdev_utils.system import get_system
 
 from pyupdater import settings
+from pyupdater.client.costs import CostModel
 from pyupdater.client.downloader import FileDownloader, get_hash
 from pyupdater.client.patcher import Patcher
 from pyupdater.package_handler.package import remove_previous_versions
-from pyupdater.utils.exceptions import ClientError
+from pyupdater.utils.exceptions import ClientError, FileDownloaderError
 
 
 log = logging.getLogger(__name__)
@@ -317,9 +319,39 @@ class LibUpdate(object):
         # Extra headers to pass to urllib3
         self.urllib3_headers = data.get('urllib3_headers')
 
+        # Connection pool shared with the client
+        self.http_pool = data.get('http_pool')
+
+        # Download speed limit shared with the client
+        self.rate_limiter = data.get('rate_limiter')
+
+        # Mirror ranking updated by our downloads
+        self.mirrors = data.get('mirrors')
+
         # The amount of times to retry a url before giving up
         self.max_download_retries = data.get('max_download_retries')
 
+        # Concurrent connections used to download the full update
+        self.download_segments = data.get('download_segments')
+
+        # Hash & write the full update on worker threads
+        self.download_pipeline = data.get('download_pipeline', False)
+
+        # Start the full download next to a patch update that falls
+        # behind. The first verified update wins.
+        self.hedged_updates = data.get('hedged_updates', False)
+        # Percent of patches applied expected by that share of the
+        # estimated patch update time
+        self.hedge_milestone = data.get('hedge_milestone', 50)
+        # Seconds a patch update is expected to take without an estimate
+        self.hedge_timeout = data.get('hedge_timeout', 30)
+
+        # Min seconds between download progress events
+        self.progress_interval = data.get('progress_interval', 0.1)
+
+        # Verified downloads shared with other apps
+        self.download_cache = data.get('download_cache')
+
         # The latest version available
         self.latest = _get_highest_version(self.name, self.platform,
                                            self.channel, self.easy_data,
@@ -368,14 +400,19 @@ class LibUpdate(object):
             return False
         return self._is_downloaded()
 
-    def download(self, async=False):
+    def download(self, background=False, **kwargs):
         """Downloads update
 
         ######Args:
 
-            async (bool): Perform download in background thread
+            background (bool): Perform download in background thread
         """
-        if async is True:
+        # ToDo: Remove in v3.0
+        # "async" is a reserved keyword since python 3.7
+        if kwargs.get('async') is True:
+            background = True
+        # End ToDo
+        if background is True:
             if self._is_downloading is False:
                 self._is_downloading = True
                 threading.Thread(target=self._download).start()
@@ -434,7 +471,11 @@ class LibUpdate(object):
             else:
                 log.debug('Starting patch download')
                 patch_success = False
-                if self.channel == 'stable':
+                # None until a full download was attempted
+                update_success = None
+                if self.channel == 'stable' and self.hedged_updates is True:
+                    patch_success, update_success = self._hedged_update()
+                elif self.channel == 'stable':
                     patch_success = self._patch_update()
                 # Tested elsewhere
                 if patch_success:  # pragma: no cover
@@ -442,8 +483,9 @@ class LibUpdate(object):
                     log.debug('Patch download successful')
                 else:
                     log.debug('Patch update failed')
-                    log.debug('Starting full download')
-                    update_success = self._full_update()
+                    if update_success is None:
+                        log.debug('Starting full download')
+                        update_success = self._full_update()
                     if update_success:
                         self._download_status = True
                         log.debug('Full download successful')
@@ -497,6 +539,14 @@ class LibUpdate(object):
                                            self.platform, 'file_hash')
         return self.easy_data.get(hash_key)
 
+    def _get_chunk_info_from_manifest(self):
+        # Returns the chunk size & chunk hashes. Both are None when the
+        # repo doesn't publish chunk hashes.
+        info_key = '{}*{}*{}*{}'.format(self._updates_key, self.name,
+                                        self.latest, self.platform)
+        info = self.easy_data.get(info_key) or {}
+        return info.get('chunk_size'), info.get('chunk_hashes')
+
     # Must be called from directory where file is located
     def _verify_file_hash(self):
         if not os.path.exists(self.filename):
@@ -526,10 +576,19 @@ class LibUpdate(object):
 
     # Handles patch updates
     def _patch_update(self):  # pragma: no cover
+        p = self._create_patcher()
+        if p is None:
+            return False
+
+        # Returns True if everything went well
+        # If False, fall back to a full update
+        return p.start()
+
+    def _create_patcher(self, cancel_event=None):
         log.debug('Starting patch update')
         # The current version is not in the version manifest
         if self._current_archive_name is None:
-            return False
+            return None
 
         # Just checking to see if the zip for the current version is
         # available to patch If not we'll fall back to a full binary download
@@ -537,36 +596,116 @@ class LibUpdate(object):
                                            self._current_archive_name)):
             log.debug('%s got deleted. No base binary to start patching '
                       'form', self._current_archive_name)
-            return False
+            return None
 
         # Initilize Patch object with all required information
-        p = Patcher(current_version=self.current_version,
-                    latest_version=self.latest,
-                    update_folder=self.update_folder,
-                    **self.init_data)
-
-        # Returns True if everything went well
-        # If False, fall back to a full update
-        return p.start()
-
-    def _full_update(self):
+        return Patcher(current_version=self.current_version,
+                       latest_version=self.latest,
+                       update_folder=self.update_folder,
+                       cancel_event=cancel_event,
+                       **self.init_data)
+
+    def _hedged_update(self):
+        # Runs the patch update & starts the full download next to it if
+        # the patches haven't reached hedge_milestone in time. The first
+        # update to finish & verify wins & the other is cancelled.
+        # Returns the results of the patch & full update. The full
+        # update result is None if it wasn't started.
+        cancel = {'patch': threading.Event(), 'full': threading.Event()}
+        p = self._create_patcher(cancel_event=cancel['patch'])
+        if p is None:
+            return False, None
+
+        results = {}
+        cond = threading.Condition()
+
+        def run(name, func):
+            try:
+                result = func()
+            except Exception as err:
+                log.debug(err, exc_info=True)
+                result = False
+            with cond:
+                results[name] = result is True
+                cond.notify_all()
+
+        threads = {'patch': threading.Thread(target=run,
+                                             args=('patch', p.start))}
+        threads['patch'].daemon = True
+        threads['patch'].start()
+        start = time.time()
+
+        winner = None
+        with cond:
+            while 1:
+                for name in ('patch', 'full'):
+                    if results.get(name) is True:
+                        winner = name
+                if winner is not None or len(results) == len(threads) == 2:
+                    break
+
+                expected = p.expected_time
+                if expected is None:
+                    expected = self.hedge_timeout
+                deadline = expected * self.hedge_milestone / 100.0
+                behind = (time.time() - start >= deadline and
+                          p.progress < self.hedge_milestone)
+                if 'full' not in threads and ('patch' in results or behind):
+                    log.debug('Starting full download next to patches')
+                    threads['full'] = threading.Thread(
+                        target=run, args=('full', lambda: self._full_update(
+                            cancel_event=cancel['full'])))
+                    threads['full'].daemon = True
+                    threads['full'].start()
+                cond.wait(0.1)
+
+        for name in threads:
+            if name != winner:
+                cancel[name].set()
+        for t in threads.values():
+            t.join()
+        log.debug('Hedged update finished. Winner: %s', winner)
+        return results['patch'], results.get('full')
+
+    def _full_update(self, cancel_event=None):
         log.debug('Starting full update')
         file_hash = self._get_file_hash_from_manifest()
-
-        with ChDir(self.update_folder):
-            log.debug('Downloading update...')
-            fd = FileDownloader(self.filename, self.update_urls,
-                                hexdigest=file_hash, verify=self.verify,
-                                progress_hooks=self.progress_hooks,
-                                max_download_retries=self.max_download_retries,
-                                urllb3_headers=self.urllib3_headers)
+        chunk_size, chunk_hashes = self._get_chunk_info_from_manifest()
+
+        log.debug('Downloading update...')
+        fd = FileDownloader(self.filename, self.update_urls,
+                            hexdigest=file_hash, verify=self.verify,
+                            progress_hooks=self.progress_hooks,
+                            progress_interval=self.progress_interval,
+                            max_download_retries=self.max_download_retries,
+                            urllb3_headers=self.urllib3_headers,
+                            resume=True,
+                            segments=self.download_segments,
+                            pipeline=self.download_pipeline,
+                            http_pool=self.http_pool,
+                            rate_limiter=self.rate_limiter,
+                            mirrors=self.mirrors,
+                            cache=self.download_cache,
+                            chunk_size=chunk_size,
+                            chunk_hashes=chunk_hashes,
+                            folder=self.update_folder,
+                            cancel_event=cancel_event)
+        try:
             result = fd.download_verify_write()
-            if result:
-                log.debug('Download Complete')
-                return True
-            else:  # pragma: no cover
-                log.debug('Failed To Download Latest Version')
-                return False
+        except FileDownloaderError as err:
+            # Cancelled. A partial download is kept for a later resume.
+            log.debug(err, exc_info=True)
+            result = False
+        if result:
+            log.debug('Download Complete')
+            # Download speed used to pick between patch & full updates
+            costs = CostModel(self.data_dir)
+            costs.record_download(fd.bytes_received, fd.throughput)
+            costs.save()
+            return True
+        else:  # pragma: no cover
+            log.debug('Failed To Download Latest Version')
+            return False
 
     def cleanup(self):
         """Cleans up old update archives for this app or asset"""
@@ -32,19 +32,19 @@ import os
 import shutil
 import sys
 
-try:  # pragma: no cover
-    import bsdiff4
-except ImportError:  # pragma: no cover
-    bsdiff4 = None
 from dsdev_utils.crypto import get_package_hashes as gph
-from dsdev_utils.helpers import EasyAccessDict
+from dsdev_utils.exceptions import VersionError
+from dsdev_utils.helpers import EasyAccessDict, Version
 from dsdev_utils.paths import ChDir
 
 from pyupdater import settings
 from pyupdater.package_handler.package import (remove_previous_versions,
                                                Package, Patch)
-from pyupdater.utils import (get_size_in_bytes as in_bytes,
+from pyupdater.utils import (get_chunk_hashes,
+                             get_size_in_bytes as in_bytes,
                              remove_dot_files)
+from pyupdater.utils.diff_engines import (DEFAULT_ENGINE, get_codec_names,
+                                          get_engine)
 from pyupdater.utils.exceptions import PackageHandlerError
 from pyupdater.utils.storage import Storage
 
@@ -74,8 +74,20 @@ class PackageHandler(object):
         if config:
             # Support for creating patches
             self.patch_support = config.get('UPDATE_PATCHES', True) is True
+            # Bytes per published chunk hash. 0 disables chunk hashes
+            self.chunk_size = config.get('UPDATE_CHUNK_SIZE', 0) or 0
+            # Number of previous stable releases patches are made from
+            self.patch_bases = config.get('UPDATE_PATCH_BASES', 1) or 1
+            # Rules picking the diff engine of each archive
+            self.patch_engines = config.get('UPDATE_PATCH_ENGINES') or []
+            # Block codec of bsdiff4 patches. None for patch format 1.
+            self.patch_codec = config.get('UPDATE_PATCH_CODEC')
         else:
             self.patch_support = False
+            self.chunk_size = 0
+            self.patch_bases = 1
+            self.patch_engines = []
+            self.patch_codec = None
 
         # References the pyu-data folder in the root of repo
         self.data_dir = os.path.join(os.getcwd(), settings.USER_DATA_FOLDER)
@@ -115,7 +127,7 @@ class PackageHandler(object):
         # to create patches.
         pkg_manifest, patch_manifest = self._get_package_list(report_errors)
         patches = PackageHandler._make_patches(patch_manifest)
-        PackageHandler._cleanup(patch_manifest)
+        PackageHandler._cleanup(patch_manifest, self.patch_bases)
         pkg_manifest = self._add_patches_to_packages(pkg_manifest,
                                                      patches)
         # PEP8
@@ -194,6 +206,10 @@ class PackageHandler(object):
                 # Add package hash
                 package.file_hash = gph(package.filename)
                 package.file_size = in_bytes(package.filename)
+                if self.chunk_size > 0:
+                    package.chunk_size = self.chunk_size
+                    package.chunk_hashes = get_chunk_hashes(package.filename,
+                                                            self.chunk_size)
                 self.version_data = PackageHandler._update_file_list(self.version_data,
                                                                   package)
 
@@ -210,6 +226,11 @@ class PackageHandler(object):
                     # Will check if source file for patch exists
                     # if so will return the path and number of patch
                     # to create. If missing source file None returned
+                    engine, codec = self._get_patch_engine(package)
+                    if engine is None:
+                        log.warning('No diff engine available. Cannot '
+                                    'create patches')
+                        continue
                     path = self._check_make_patch(self.version_data,
                                                   package.name,
                                                   package.platform,
@@ -224,9 +245,22 @@ class PackageHandler(object):
                                           patch_name=os.path.join(self.new_dir,
                                                                   patch_name),
                                           patch_num=patch_number,
-                                          package=package.filename)
+                                          package=package.filename,
+                                          engine=engine,
+                                          codec=codec)
                         # ready for patching
                         patch_manifest.append(patch_info)
+
+                        # Skip patches from older releases straight to
+                        # this one
+                        bases = self._get_skip_patch_bases(self.version_data,
+                                                           package.name,
+                                                           package.platform)
+                        for version, src in bases:
+                            skip_info = dict(patch_info, src=src, base=version)
+                            skip_info['patch_name'] = '{}-{}'.format(
+                                patch_info['patch_name'], version)
+                            patch_manifest.append(skip_info)
                     else:
                         log.warning('No source file to patch from')
 
@@ -263,15 +297,21 @@ class PackageHandler(object):
         return data
 
     @staticmethod
-    def _cleanup(patch_manifest):
-        # Remove old archives that were previously used to create patches
+    def _cleanup(patch_manifest, patch_bases=1):
+        # Remove old archives that were previously used to create patches.
+        # Keeps the archives needed as patch bases for the next release,
+        # which is the one being processed & patch_bases - 1 before it.
         if len(patch_manifest) < 1:
             return
         log.info('Cleaning up files directory')
         for p in patch_manifest:
+            # Skip patches are made from older archives than the chain
+            if p.get('base') is not None:
+                continue
             filename = os.path.basename(p['src'])
             directory = os.path.dirname(p['src'])
-            remove_previous_versions(directory, filename)
+            remove_previous_versions(directory, filename,
+                                     keep=max(patch_bases - 2, 0))
 
     @staticmethod
     def _make_patches(patch_manifest):
@@ -308,8 +348,6 @@ class PackageHandler(object):
                 for pm in package_manifest:
                     #
                     if p.dst_filename == pm.filename:
-                        pm.patch_info['patch_name'] = \
-                            os.path.basename(p.patch_name)
                         # Don't try to get hash on a ghost file
                         if not os.path.exists(p.patch_name):
                             p_name = ''
@@ -317,8 +355,18 @@ class PackageHandler(object):
                         else:
                             p_name = gph(p.patch_name)
                             p_size = in_bytes(p.patch_name)
-                        pm.patch_info['patch_hash'] = p_name
-                        pm.patch_info['patch_size'] = p_size
+                        info = pm.patch_info
+                        if p.base is not None:
+                            # Skip patches are listed by base version
+                            info = pm.patch_info.setdefault('patches', {})
+                            info = info.setdefault(p.base, {})
+                        info['patch_name'] = os.path.basename(p.patch_name)
+                        info['patch_hash'] = p_name
+                        info['patch_size'] = p_size
+                        info['patch_engine'] = p.engine
+                        if p.codec is not None:
+                            info['patch_format'] = 2
+                            info['patch_codec'] = p.codec
                         # No need to keep searching
                         # We have the info we need for this patch
                         break
@@ -356,6 +404,9 @@ class PackageHandler(object):
         patch_name = package_info.patch_info.get('patch_name')
         patch_hash = package_info.patch_info.get('patch_hash')
         patch_size = package_info.patch_info.get('patch_size')
+        patch_engine = package_info.patch_info.get('patch_engine')
+        patch_format = package_info.patch_info.get('patch_format')
+        patch_codec = package_info.patch_info.get('patch_codec')
 
         # Converting info to version file format
         info = {
@@ -364,11 +415,27 @@ class PackageHandler(object):
             'filename': package_info.filename
             }
 
+        # Adding chunk hashes if available
+        if package_info.chunk_hashes:
+            info['chunk_size'] = package_info.chunk_size
+            info['chunk_hashes'] = package_info.chunk_hashes
+
         # Adding patch info if available
         if patch_name and patch_hash:
             info['patch_name'] = patch_name
             info['patch_hash'] = patch_hash
             info['patch_size'] = patch_size
+            info['patch_engine'] = patch_engine
+            if patch_format is not None:
+                info['patch_format'] = patch_format
+                info['patch_codec'] = patch_codec
+
+        # Adding skip patches from older releases if available
+        patches = dict((k, v) for k, v in
+                       package_info.patch_info.get('patches', {}).items()
+                       if v.get('patch_name') and v.get('patch_hash'))
+        if patches:
+            info['patches'] = patches
 
         return info
 
@@ -426,9 +493,13 @@ class PackageHandler(object):
             return
         log.info('Moving packages to deploy folder')
         for p in package_manifest:
-            patch = p.patch_info.get('patch_name')
+            patches = [p.patch_info.get('patch_name')]
+            patches += [v.get('patch_name') for v in
+                        p.patch_info.get('patches', {}).values()]
             with ChDir(self.new_dir):
-                if patch:
+                for patch in patches:
+                    if not patch:
+                        continue
                     if os.path.exists(os.path.join(self.deploy_dir, patch)):
                         os.remove(os.path.join(self.deploy_dir, patch))
                     log.debug('Moving %s to %s', patch, self.deploy_dir)
@@ -448,10 +519,6 @@ class PackageHandler(object):
         # make patch updates. Also calculates patch number
         log.debug(json.dumps(json_data['latest'], indent=2))
         log.info('Checking if patch creation is possible')
-        if bsdiff4 is None:
-            log.warning('Bsdiff is missing. Cannot create patches')
-            return None
-
         if os.path.exists(self.files_dir):
             with ChDir(self.files_dir):
                 files = os.listdir(os.getcwd())
@@ -506,6 +573,65 @@ class PackageHandler(object):
             return src_file_path, num
         return None
 
+    def _get_patch_engine(self, package):
+        # The first rule matching the archive with an installed engine
+        # wins. Rules are dicts with an "engine" name & optional
+        # "min_size" in bytes, "extensions" of the archive & "codec".
+        for rule in self.patch_engines:
+            if package.file_size < rule.get('min_size', 0):
+                continue
+            extensions = rule.get('extensions')
+            if extensions and not package.filename.endswith(
+                    tuple(extensions)):
+                continue
+            if get_engine(rule.get('engine')) is None:
+                log.warning('Diff engine %s is not installed',
+                            rule.get('engine'))
+                continue
+            return (rule.get('engine'),
+                    self._get_patch_codec(rule.get('codec',
+                                                   self.patch_codec)))
+        if get_engine(DEFAULT_ENGINE) is not None:
+            return DEFAULT_ENGINE, self._get_patch_codec(self.patch_codec)
+        return None, None
+
+    @staticmethod
+    def _get_patch_codec(codec):
+        # Codecs that aren't installed fall back to patch format 1
+        if codec is None or codec == 'auto' or codec in get_codec_names():
+            return codec
+        log.warning('Patch codec %s is not installed', codec)
+        return None
+
+    def _get_skip_patch_bases(self, json_data, name, platform):
+        # Archives of older stable releases kept in the files dir. The
+        # latest stable release is the base of the regular patch.
+        if self.patch_bases < 2:
+            return []
+        try:
+            versions = json_data[settings.UPDATES_KEY][name]
+            latest = Version(json_data['latest'][name]['stable'][platform])
+        except (KeyError, VersionError):
+            return []
+
+        bases = []
+        for v, info in versions.items():
+            try:
+                version = Version(v)
+            except VersionError:
+                continue
+            if version.channel != 'stable' or version >= latest:
+                continue
+            filename = info.get(platform, {}).get('filename')
+            if filename is None:
+                continue
+            src_file_path = os.path.join(self.files_dir, filename)
+            if os.path.exists(src_file_path):
+                bases.append((version, v, src_file_path))
+        bases.sort(key=lambda x: x[0], reverse=True)
+        log.debug('Found %s bases for skip patches', len(bases))
+        return [(v, path) for _, v, path in bases[:self.patch_bases - 1]]
+
 
 def _make_patch(patch_info):
     # Does with the name implies. Used with multiprocessing
@@ -524,8 +650,10 @@ def _make_patch(patch_info):
         log.debug('Patch source path: %s', src_path)
         log.debug('Patch destination path: %s', dst_path)
         if patch.ready is True:
-            log.info('Creating patch... %s', os.path.basename(patch_name))
-            bsdiff4.file_diff(src_path, patch.dst_path, patch.patch_name)
+            log.info('Creating %s patch... %s', patch.engine,
+                     os.path.basename(patch_name))
+            patch.codec = get_engine(patch.engine).diff(
+                src_path, patch.dst_path, patch.patch_name, codec=patch.codec)
             base_name = os.path.basename(patch_name)
             log.info('Done creating patch... %s', base_name)
         else:
@@ -31,6 +31,7 @@ from dsdev_utils.exceptions import VersionError
 from dsdev_utils.helpers import Version
 from dsdev_utils.paths import ChDir, remove_any
 
+from pyupdater.utils.diff_engines import DEFAULT_ENGINE
 from pyupdater.utils.exceptions import PackageHandlerError, UtilsError
 
 log = logging.getLogger(__name__)
@@ -59,8 +60,13 @@ def parse_platform(name):
     return platform_name
 
 
-def remove_previous_versions(directory, filename):
-    """Removes previous version of named file"""
+def remove_previous_versions(directory, filename, keep=0):
+    """Removes previous version of named file
+
+    Kwargs:
+
+        keep (int): Number of the newest previous versions to keep
+    """
     if filename is None:
         log.debug('Cleanup Failed - Filename is None')
         return
@@ -92,6 +98,7 @@ def remove_previous_versions(directory, filename):
     log.debug('Current version: %s', str(current_version))
     assert package_info.name is not None
     log.debug('Name to search for: %s', package_info.name)
+    old_versions = []
     with ChDir(directory):
         temp = os.listdir(os.getcwd())
         for t in temp:
@@ -115,13 +122,17 @@ def remove_previous_versions(directory, filename):
             log.debug('Found version: %s', str(old_version))
 
             if old_version < current_version:
-                old_path = os.path.join(directory, t)
-                log.debug('Removing old update: %s', old_path)
-                remove_any(old_path)
+                old_versions.append((old_version, t))
             else:
                 log.debug('Old version: %s', old_version)
                 log.debug('Current version: %s', current_version)
 
+    old_versions.sort(key=lambda x: x[0], reverse=True)
+    for _, t in old_versions[keep:]:
+        old_path = os.path.join(directory, t)
+        log.debug('Removing old update: %s', old_path)
+        remove_any(old_path)
+
 
 # ToDo: Remove in version 3.0
 def cleanup_old_archives(filename=None, directory=None):
@@ -142,6 +153,12 @@ class Patch(object):
         self.dst_path = patch_info.get('dst')
         self.patch_name = patch_info.get('patch_name')
         self.dst_filename = patch_info.get('package')
+        # Version the patch is made from. None for the previous release
+        self.base = patch_info.get('base')
+        # Diff engine the patch is made with
+        self.engine = patch_info.get('engine', DEFAULT_ENGINE)
+        # Block codec of patch format 2. None for format 1.
+        self.codec = patch_info.get('codec')
         self.ready = self._check_attrs()
 
     def _check_attrs(self):
@@ -177,6 +194,10 @@ class Package(object):
         self.filename = os.path.basename(filename)
         self.file_hash = None
         self.file_size = None
+        # Size & sha256 of fixed size chunks of the file. None
+        # unless chunk hashes are enabled.
+        self.chunk_size = None
+        self.chunk_hashes = None
         self.platform = None
         self.info = dict(status=False, reason='')
         self.patch_info = {}
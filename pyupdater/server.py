@@ -0,0 +1,471 @@
+# ------------------------------------------------------------------------------
+# Copyright (c) 2015-2017 Digital Sapphire
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the
+# following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF
+# ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+# TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR
+# ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE
+# OR OTHER DEALINGS IN THE SOFTWARE.
+# ------------------------------------------------------------------------------
+from __future__ import unicode_literals
+
+import gzip
+import hashlib
+import json
+import logging
+import os
+import re
+import socket
+import threading
+import time
+
+import six
+from six.moves import BaseHTTPServer, socketserver
+from six.moves.urllib.parse import unquote
+import urllib3
+
+from pyupdater import settings
+from pyupdater.client.downloader import create_http_pool
+from pyupdater.compat import url_quote
+
+log = logging.getLogger(__name__)
+
+# bytes=start-end, bytes=start- or bytes=-suffix
+_RANGE_RE = re.compile(r'^bytes=(\d+-\d*|-\d+)$')
+
+
+class UpdateServer(object):
+    """Serves a folder of updates, usually pyu-data/deploy, over HTTP.
+    Connections are kept alive, byte ranges are supported & files are
+    sent with sendfile when available. ETags are the sha256 hashes from
+    the version manifest.
+
+    With origin urls set, the server is a caching proxy. Missing files
+    are downloaded from the origin, verified against the origin's version
+    manifest & kept in root. Files missing from the manifest cannot be
+    verified & are checked with the origin again after manifest_ttl.
+    HEAD requests for files not in root are answered with the headers
+    of the origin.
+
+    ######Args:
+
+    root (str): Folder to serve
+
+    ######Kwargs:
+
+    host (str): Address to listen on. Defaults to all addresses
+
+    port (int): Port to listen on. 0 picks a free port
+
+    origin (list): Update urls of the origin to proxy. root is created
+    if missing.
+
+    manifest_ttl (int): Seconds the version & key files, & other files
+    missing from the version manifest, from the origin are served before
+    checking the origin for changes
+    """
+
+    # Files from the origin that change between releases
+    MANIFESTS = (settings.VERSION_FILE_FILENAME, settings.KEY_FILE_FILENAME)
+
+    def __init__(self, root, **kwargs):
+        self.root = os.path.abspath(root)
+        self.origin = [u if u.endswith('/') else u + '/'
+                       for u in kwargs.get('origin') or []]
+        self.manifest_ttl = kwargs.get('manifest_ttl', 60)
+        self.http_pool = None
+        if len(self.origin) > 0:
+            self.http_pool = create_http_pool()
+            # A proxy can start with an empty cache
+            if not os.path.isdir(self.root):
+                os.makedirs(self.root)
+
+        # filename: sha256 from the version manifest
+        self._hashes = {}
+        self._manifest_mtime = None
+        # path: (size, mtime, sha256) of files not in the manifest
+        self._file_hashes = {}
+        # Files in root that match their hash in the manifest
+        self._verified = set()
+        # ETags of files from the origin
+        self._validators = {}
+        # Only one thread fetches a file from the origin
+        self._locks = {}
+        self._lock = threading.Lock()
+
+        self._httpd = _ThreadingHTTPServer((kwargs.get('host', ''),
+                                            kwargs.get('port', 8000)),
+                                           _UpdateRequestHandler)
+        self._httpd.update_server = self
+        self._thread = None
+
+    @property
+    def url(self):
+        """Update url of the server"""
+        host, port = self._httpd.server_address[:2]
+        if host in ('', '0.0.0.0'):
+            host = '127.0.0.1'
+        return 'http://{}:{}/'.format(host, port)
+
+    def serve_forever(self):
+        """Handles requests until stop is called"""
+        log.info('Serving %s at %s', self.root, self.url)
+        if self.origin:
+            log.info('Proxying %s', ', '.join(self.origin))
+        self._httpd.serve_forever()
+
+    def start(self):
+        """Handles requests on a background thread"""
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stops the server & closes its socket"""
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def get_file(self, filename):
+        """Returns the path of a file to serve. None if not found.
+
+        ######Args:
+
+        filename (str): Name of the requested file
+        """
+        path = os.path.join(self.root, filename)
+        if len(self.origin) == 0:
+            return path if os.path.isfile(path) else None
+
+        with self._get_lock(filename):
+            if not self._is_fresh(filename, path):
+                self._fetch(filename, path)
+        return path if os.path.isfile(path) else None
+
+    def is_cached(self, filename):
+        """Returns True if a file can be served without asking the origin
+
+        ######Args:
+
+        filename (str): Name of the requested file
+        """
+        path = os.path.join(self.root, filename)
+        if len(self.origin) == 0:
+            return os.path.isfile(path)
+        with self._get_lock(filename):
+            return self._is_fresh(filename, path)
+
+    def get_origin_headers(self, filename):
+        """Returns the headers to answer a HEAD request with. Taken from
+        the origin without downloading the file. None if no origin has
+        the file.
+
+        ######Args:
+
+        filename (str): Name of the requested file
+        """
+        for url in self.origin:
+            try:
+                r = self.http_pool.urlopen('HEAD', url + url_quote(filename),
+                                           retries=False)
+            except urllib3.exceptions.HTTPError as err:
+                log.debug('Origin %s failed: %s', url, err)
+                continue
+            if r.status != 200:
+                log.debug('Origin %s answered %s', url, r.status)
+                continue
+            headers = {'Content-Type': 'application/octet-stream',
+                       'Accept-Ranges': 'bytes'}
+            for name in ('Content-Length', 'ETag', 'Last-Modified'):
+                if r.headers.get(name) is not None:
+                    headers[name] = r.headers[name]
+            file_hash = self._get_manifest_hashes().get(filename)
+            if file_hash is not None:
+                headers['ETag'] = '"{}"'.format(file_hash)
+            return headers
+        log.debug('No origin has %s', filename)
+        return None
+
+    def get_hash(self, filename, path):
+        """Returns the sha256 of a file. Taken from the version manifest
+        when listed, otherwise hashed & kept until the file changes.
+
+        ######Args:
+
+        filename (str): Name of the file
+
+        path (str): Path of the file
+        """
+        file_hash = self._get_manifest_hashes().get(filename)
+        if file_hash is not None:
+            return file_hash
+        return self._hash_file(path)
+
+    def _hash_file(self, path):
+        # Hashes are kept until the file changes
+        stat = os.stat(path)
+        cached = self._file_hashes.get(path)
+        if cached is not None and cached[:2] == (stat.st_size,
+                                                 stat.st_mtime):
+            return cached[2]
+        hash_ = hashlib.sha256()
+        with open(path, 'rb') as f:
+            while 1:
+                block = f.read(1024 * 1024)
+                if len(block) == 0:
+                    break
+                hash_.update(block)
+        file_hash = hash_.hexdigest()
+        self._file_hashes[path] = (stat.st_size, stat.st_mtime, file_hash)
+        return file_hash
+
+    def _get_manifest_hashes(self):
+        # Reloads the hashes whenever the version manifest changes
+        path = os.path.join(self.root, settings.VERSION_FILE_FILENAME)
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            return {}
+        if mtime == self._manifest_mtime:
+            return self._hashes
+        hashes = {}
+        try:
+            with gzip.open(path, 'rb') as f:
+                data = json.loads(f.read().decode('utf-8'))
+            for versions in data.get(settings.UPDATES_KEY, {}).values():
+                for platforms in versions.values():
+                    for info in platforms.values():
+                        if info.get('filename') and info.get('file_hash'):
+                            hashes[info['filename']] = info['file_hash']
+                        # Skip patches are listed by base version
+                        patches = [info] + list(
+                            (info.get('patches') or {}).values())
+                        for p in patches:
+                            if p.get('patch_name') and p.get('patch_hash'):
+                                hashes[p['patch_name']] = p['patch_hash']
+        except Exception as err:
+            log.debug('Cannot read version manifest')
+            log.debug(err, exc_info=True)
+        self._hashes = hashes
+        self._manifest_mtime = mtime
+        return hashes
+
+    def _get_lock(self, filename):
+        with self._lock:
+            return self._locks.setdefault(filename, threading.Lock())
+
+    def _is_fresh(self, filename, path):
+        if not os.path.isfile(path):
+            return False
+        expected = None
+        if filename not in self.MANIFESTS:
+            expected = self._get_manifest_hashes().get(filename)
+        if expected is None:
+            # Nothing to verify our copy with
+            return time.time() - os.path.getmtime(path) < self.manifest_ttl
+        # Updates & patches never change. Copies from an earlier run are
+        # verified once.
+        if filename not in self._verified and \
+                self._hash_file(path) == expected:
+            self._verified.add(filename)
+        return filename in self._verified
+
+    def _fetch(self, filename, path):
+        # Downloads a file from the first origin url with a good copy
+        headers = self.http_pool.headers.copy()
+        if os.path.isfile(path) and self._validators.get(filename):
+            headers['If-None-Match'] = self._validators[filename]
+        expected = self._get_manifest_hashes().get(filename)
+        tmp = path + '.proxy'
+        for url in self.origin:
+            try:
+                r = self.http_pool.urlopen('GET', url + url_quote(filename),
+                                           headers=headers,
+                                           preload_content=False,
+                                           retries=False)
+            except urllib3.exceptions.HTTPError as err:
+                log.debug('Origin %s failed: %s', url, err)
+                continue
+            try:
+                if r.status == 304:
+                    log.debug('%s not modified at origin', filename)
+                    # Serving our copy for another manifest_ttl
+                    os.utime(path, None)
+                    return
+                if r.status != 200:
+                    log.debug('Origin %s answered %s', url, r.status)
+                    continue
+                hash_ = hashlib.sha256()
+                with open(tmp, 'wb') as f:
+                    for block in r.stream(1024 * 64):
+                        hash_.update(block)
+                        f.write(block)
+            except (urllib3.exceptions.HTTPError, socket.error, IOError,
+                    OSError) as err:
+                log.debug('Download from origin %s failed: %s', url, err)
+                # Unread data would break the next request on the
+                # connection
+                r.close()
+                continue
+            finally:
+                r.release_conn()
+
+            if expected is not None and hash_.hexdigest() != expected:
+                log.debug('Bad copy of %s from %s', filename, url)
+                os.remove(tmp)
+                continue
+            if os.path.exists(path):
+                os.remove(path)
+            os.rename(tmp, path)
+            if expected is not None:
+                self._verified.add(filename)
+            self._validators[filename] = r.headers.get('ETag')
+            log.debug('Got %s from origin %s', filename, url)
+            return
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        log.debug('No origin has %s', filename)
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn,
+                           BaseHTTPServer.HTTPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class _UpdateRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    # Keeps connections alive between requests
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, fmt, *args):
+        log.debug('%s - %s', self.address_string(), fmt % args)
+
+    def do_GET(self):
+        self._send_update_file()
+
+    def do_HEAD(self):
+        self._send_update_file(head=True)
+
+    def _send_update_file(self, head=False):
+        server = self.server.update_server
+        filename = unquote(self.path.split('?', 1)[0].lstrip('/'))
+        if six.PY2:
+            filename = filename.decode('utf-8')
+        # Only files in the root are served
+        path = None
+        if filename and filename == os.path.basename(filename) and \
+                filename not in (os.curdir, os.pardir):
+            if head is True and server.origin and \
+                    not server.is_cached(filename):
+                # No need to download the file for its headers
+                self._send_origin_headers(filename)
+                return
+            path = server.get_file(filename)
+        if path is None:
+            self.send_error(404, 'File not found')
+            return
+
+        etag = '"{}"'.format(server.get_hash(filename, path))
+        size = os.path.getsize(path)
+        if self._etag_matches(self.headers.get('If-None-Match'), etag):
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+
+        start, end = 0, size - 1
+        byte_range = self.headers.get('Range')
+        if_range = self.headers.get('If-Range')
+        # Malformed & multiple ranges get the full file
+        if (byte_range is not None and if_range in (None, etag) and
+                _RANGE_RE.match(byte_range.strip()) is not None):
+            byte_range = _UpdateRequestHandler._parse_range(byte_range,
+                                                            size)
+            if byte_range is None:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */{}'.format(size))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            start, end = byte_range
+            self.send_response(206)
+            self.send_header('Content-Range',
+                             'bytes {}-{}/{}'.format(start, end, size))
+        else:
+            self.send_response(200)
+
+        length = end - start + 1
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(length))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified',
+                         self.date_time_string(os.path.getmtime(path)))
+        self.end_headers()
+        if head is False and length > 0:
+            with open(path, 'rb') as f:
+                self._send_body(f, start, length)
+
+    def _send_origin_headers(self, filename):
+        headers = self.server.update_server.get_origin_headers(filename)
+        if headers is None:
+            self.send_error(404, 'File not found')
+            return
+        self.send_response(200)
+        for name, value in sorted(headers.items()):
+            self.send_header(name, value)
+        self.end_headers()
+
+    def _send_body(self, f, start, length):
+        self.wfile.flush()
+        sendfile = getattr(self.connection, 'sendfile', None)
+        if sendfile is not None:
+            # Data goes from the page cache to the socket in the kernel
+            sendfile(f, start, length)
+            return
+        f.seek(start)
+        while length > 0:
+            block = f.read(min(length, 1024 * 64))
+            if len(block) == 0:
+                break
+            self.wfile.write(block)
+            length -= len(block)
+
+    @staticmethod
+    def _etag_matches(header, etag):
+        if header is None:
+            return False
+        tags = [t.strip() for t in header.split(',')]
+        return '*' in tags or etag in tags
+
+    @staticmethod
+    def _parse_range(header, size):
+        # Returns the first & last byte of a single byte range. None if
+        # the range cannot be satisfied.
+        first, last = header.strip()[len('bytes='):].split('-')
+        if first == '':
+            # Suffix range. The last n bytes.
+            length = min(int(last), size)
+            if length == 0:
+                return None
+            return size - length, size - 1
+        first = int(first)
+        last = size - 1 if last == '' else min(int(last), size - 1)
+        if first >= size or first > last:
+            return None
+        return first, last
@@ -61,3 +61,21 @@ UPDATE_FOLDER = 'update'
 # Name of version file place in online repo
 VERSION_FILE_FILENAME = 'versions.gz'
 KEY_FILE_FILENAME = 'keys.gz'
+
+# Mirror ranking stored in the clients data dir
+MIRROR_FILE_FILENAME = 'mirrors.json'
+
+# Sizes of downloads missing from the version manifest, by file hash
+SIZE_FILE_FILENAME = 'sizes.json'
+
+# Measured download & patch speeds used to pick between patch & full updates
+COST_FILE_FILENAME = 'costs.json'
+
+# Validators of the cached version & key files. Used for conditional requests
+HTTP_CACHE_FILENAME = 'http-cache.json'
+
+# Folder in the users cache dir holding downloads shared between apps
+DOWNLOAD_CACHE_FOLDER = 'downloads'
+
+# Default max size of the shared download cache. 1 GB
+DOWNLOAD_CACHE_SIZE = 1024 * 1024 * 1024
@@ -24,6 +24,7 @@
 # ------------------------------------------------------------------------------
 from __future__ import absolute_import
 from __future__ import unicode_literals
+import hashlib
 import io
 import logging
 import json
@@ -210,6 +211,30 @@ def get_size_in_bytes(filename):
     return size
 
 
+def get_chunk_hashes(filename, chunk_size):
+    """Returns the sha256 of every chunk_size bytes of a file. The last
+    chunk may be shorter.
+
+    Args:
+
+        filename (str): Path of the file to hash
+
+        chunk_size (int): Bytes in each chunk
+
+    Returns:
+
+        (list): sha256 hashes in order of the chunks
+    """
+    hashes = []
+    with open(filename, 'rb') as f:
+        while 1:
+            chunk = f.read(chunk_size)
+            if len(chunk) == 0:
+                break
+            hashes.append(hashlib.sha256(chunk).hexdigest())
+    return hashes
+
+
 def create_asset_archive(name, version):
     """Used to make archives of file or dir. Zip on windows and tar.gz
     on all other platforms
@@ -55,6 +55,27 @@ class Config(dict):
             # Support for patch updates
             'UPDATE_PATCHES': True,
 
+            # Bytes per chunk hash published for each update. Lets
+            # clients re-download only the corrupt parts of an update.
+            # 0 disables chunk hashes.
+            'UPDATE_CHUNK_SIZE': 0,
+
+            # Number of previous releases patches are made from. Clients
+            # several releases behind get one patch instead of a chain.
+            'UPDATE_PATCH_BASES': 1,
+
+            # Diff engines to make patches with. The first rule matching
+            # an archive is used. bsdiff4 when none match. Example:
+            # [{'engine': 'zstd', 'min_size': 100 * 1024 * 1024},
+            #  {'engine': 'bsdiff4', 'codec': 'zlib', 'min_size': 10 ** 7},
+            #  {'engine': 'xdelta', 'extensions': ['.zip']}]
+            'UPDATE_PATCH_ENGINES': [],
+
+            # Block codec of bsdiff4 patches: raw, zlib, bz2, lzma, zstd or
+            # auto. Patches with a codec use patch format 2, which older
+            # clients can't apply. None keeps format 1.
+            'UPDATE_PATCH_CODEC': None,
+
             # Max retries for downloads
             'MAX_DOWNLOAD_RETRIES': 3,
         }
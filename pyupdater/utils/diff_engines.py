@@ -0,0 +1,678 @@
+# ------------------------------------------------------------------------------
+# Copyright (c) 2015-2017 Digital Sapphire
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the
+# following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF
+# ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+# TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR
+# ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE
+# OR OTHER DEALINGS IN THE SOFTWARE.
+# ------------------------------------------------------------------------------
+from __future__ import unicode_literals
+
+import bz2
+import io
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+try:  # pragma: no cover
+    import bsdiff4
+    from bsdiff4.format import MAGIC as BSDIFF4_MAGIC
+except ImportError:  # pragma: no cover
+    bsdiff4 = None
+try:  # pragma: no cover
+    import lzma
+except ImportError:  # pragma: no cover
+    lzma = None
+try:  # pragma: no cover
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+log = logging.getLogger(__name__)
+
+# Engine of patches without a "patch_engine" in the version manifest
+DEFAULT_ENGINE = 'bsdiff4'
+
+# Entry point group of diff engines installed by other packages
+ENGINE_NAMESPACE = 'pyupdater.diff_engines'
+
+# Codecs of the blocks of bsdiff4 patch format 2
+CODECS = ('raw', 'zlib', 'bz2', 'lzma', 'zstd')
+
+_engines = {}
+_engines_lock = threading.Lock()
+_plugins_loaded = False
+
+
+def register_engine(engine):
+    """Adds a diff engine to the registry. Replaces a registered engine
+    with the same name.
+
+    ######Args:
+
+    engine (DiffEngine): Engine to register
+    """
+    with _engines_lock:
+        _engines[engine.name] = engine
+
+
+def get_engine(name):
+    """Returns the diff engine registered under name
+
+    ######Args:
+
+    name (str): Name of the engine. None for the default engine.
+
+    ######Returns (DiffEngine): None if the engine is unknown or its
+    module isn't installed
+    """
+    if name is None:
+        name = DEFAULT_ENGINE
+    engine = _engines.get(name)
+    if engine is None:
+        _load_plugins()
+        engine = _engines.get(name)
+    if engine is None or engine.available() is False:
+        log.debug('Diff engine %s is not available', name)
+        return None
+    return engine
+
+
+def get_engine_names():
+    """Returns the names of the usable diff engines
+
+    ######Returns (list): Sorted engine names
+    """
+    _load_plugins()
+    return sorted(n for n, e in _engines.items() if e.available())
+
+
+def is_supported(name, patch_format=1, codec=None):
+    """Returns True if patches of the engine, format & codec can be
+    applied here
+
+    ######Args:
+
+    name (str): Name of the engine. None for the default engine.
+
+    ######Kwargs:
+
+    patch_format (int): Patch format in the version manifest
+
+    codec (str): Block codec in the version manifest
+    """
+    engine = get_engine(name)
+    if engine is None or patch_format not in engine.formats:
+        return False
+    return codec is None or codec in get_codec_names()
+
+
+def get_codec_names():
+    """Returns the block codecs whose modules are installed
+
+    ######Returns (list): Codec names
+    """
+    missing = []
+    if lzma is None:
+        missing.append('lzma')
+    if zstandard is None:
+        missing.append('zstd')
+    return [c for c in CODECS if c not in missing]
+
+
+def compress_block(codec, data):
+    """Compresses a patch block
+
+    ######Args:
+
+    codec (str): Name of the codec
+
+    data (bytes): The block
+
+    ######Returns (bytes): The compressed block
+    """
+    if codec not in get_codec_names():
+        raise ValueError('Codec {} is not available'.format(codec))
+    if codec == 'zlib':
+        return zlib.compress(data, 9)
+    if codec == 'bz2':
+        return bz2.compress(data, 9)
+    if codec == 'lzma':
+        return lzma.compress(data)
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=19).compress(data)
+    return bytes(data)
+
+
+def open_block(codec, buf, start, end):
+    """Returns a reader of a compressed patch block. Data is
+    decompressed as it's read, so only what's read is held in memory.
+
+    ######Args:
+
+    codec (str): Name of the codec
+
+    buf (bytes): The patch. May be memory mapped.
+
+    start (int): Offset of the block
+
+    end (int): Offset of the end of the block
+
+    ######Returns (object): Reader with a read(size) method
+    """
+    if codec not in get_codec_names():
+        raise ValueError('Codec {} is not available'.format(codec))
+    if codec == 'raw':
+        return _RawBlock(buf, start, end)
+    if codec == 'zstd':
+        return _ZstdBlock(buf, start, end)
+    return _DecompressorBlock(codec, buf, start, end)
+
+
+def read_block(codec, data):
+    """Decompresses a whole patch block
+
+    ######Args:
+
+    codec (str): Name of the codec
+
+    data (bytes): The compressed block
+
+    ######Returns (bytes): The block
+    """
+    reader = open_block(codec, data, 0, len(data))
+    out = []
+    while 1:
+        chunk = reader.read(1024 * 1024)
+        if len(chunk) == 0:
+            break
+        out.append(chunk)
+    return b''.join(out)
+
+
+class _RawBlock(object):
+
+    def __init__(self, buf, start, end):
+        self._buf = buf
+        self._pos = start
+        self._end = end
+
+    def read(self, size):
+        data = bytes(self._buf[self._pos:min(self._pos + size, self._end)])
+        self._pos += len(data)
+        return data
+
+
+class _DecompressorBlock(object):
+    # zlib, bz2 & lzma blocks. Compressed data is fed in small pieces, so
+    # highly compressed blocks don't inflate all at once.
+
+    INPUT_SIZE = 1024 * 64
+
+    def __init__(self, codec, buf, start, end):
+        self._buf = buf
+        self._pos = start
+        self._end = end
+        if codec == 'zlib':
+            self._decompressor = zlib.decompressobj()
+        elif codec == 'bz2':
+            self._decompressor = bz2.BZ2Decompressor()
+        else:
+            self._decompressor = lzma.LZMADecompressor()
+        self._pending = b''
+        self._data = bytearray()
+
+    def read(self, size):
+        d = self._decompressor
+        while len(self._data) < size and getattr(d, 'eof', False) is False:
+            if len(self._pending) == 0 and getattr(d, 'needs_input', True):
+                self._pending = bytes(self._buf[self._pos:min(
+                    self._pos + self.INPUT_SIZE, self._end)])
+                self._pos += len(self._pending)
+                if len(self._pending) == 0:
+                    break
+            if hasattr(d, 'unconsumed_tail'):
+                self._data.extend(d.decompress(self._pending, 1024 * 1024))
+                self._pending = d.unconsumed_tail
+            elif hasattr(d, 'needs_input'):
+                self._data.extend(d.decompress(self._pending, 1024 * 1024))
+                self._pending = b''
+            else:
+                # Python 2 bz2 can't limit its output
+                self._data.extend(d.decompress(self._pending))
+                self._pending = b''
+        data = bytes(self._data[:size])
+        del self._data[:size]
+        return data
+
+
+class _ZstdBlock(object):
+
+    def __init__(self, buf, start, end):
+        self._reader = zstandard.ZstdDecompressor().stream_reader(
+            _RawBlock(buf, start, end))
+
+    def read(self, size):
+        out = []
+        while size > 0:
+            data = self._reader.read(size)
+            if len(data) == 0:
+                break
+            out.append(data)
+            size -= len(data)
+        return b''.join(out)
+
+
+def _load_plugins():
+    # Engines from other packages are only looked up when needed
+    global _plugins_loaded
+    with _engines_lock:
+        if _plugins_loaded is True:
+            return
+        _plugins_loaded = True
+    try:
+        from stevedore.extension import ExtensionManager
+        manager = ExtensionManager(ENGINE_NAMESPACE, invoke_on_load=True)
+    except Exception as err:
+        log.debug(err, exc_info=True)
+        return
+    for ext in manager.extensions:
+        log.debug('Loaded diff engine: %s', ext.obj.name)
+        register_engine(ext.obj)
+
+
+class DiffEngine(object):
+    """Creates & applies patches. Subclass & register an instance to add
+    an engine. The name of the engine is saved with each patch in the
+    version manifest.
+    """
+
+    # Name saved in the version manifest
+    name = None
+
+    # Patch formats the engine applies
+    formats = (1,)
+
+    def available(self):
+        """Returns False if the modules the engine needs are missing"""
+        return True
+
+    def diff(self, src_path, dst_path, patch_path, codec=None):
+        """Writes a patch that turns the file at src_path into the file
+        at dst_path
+
+        ######Args:
+
+        src_path (str): Path to the base file
+
+        dst_path (str): Path to the new file
+
+        patch_path (str): Path to write the patch to
+
+        ######Kwargs:
+
+        codec (str): Block codec of engines with patch format 2. "auto"
+        picks one. Ignored by other engines.
+
+        ######Returns (str): Codec of the patch. None for patch format 1.
+        """
+        raise NotImplementedError
+
+    def patch(self, src, patch):
+        """Applies a patch in memory
+
+        ######Args:
+
+        src (bytes): Base data
+
+        patch (bytes): Patch data. May be memory mapped.
+
+        ######Returns (bytes): The patched data
+        """
+        raise NotImplementedError
+
+    def patch_file(self, src_path, patch, dst_path):
+        """Applies a patch to the file at src_path & writes the result to
+        dst_path. Engines that can patch with less memory override this.
+
+        ######Args:
+
+        src_path (str): Path to the base file
+
+        patch (bytes): Patch data. May be memory mapped.
+
+        dst_path (str): Path to write the patched file to
+        """
+        with open(src_path, 'rb') as f:
+            src = f.read()
+        data = self.patch(src, patch)
+        with open(dst_path, 'wb') as f:
+            f.write(data)
+
+
+class Bsdiff4Engine(DiffEngine):
+    """bsdiff4 patches. Small patches, but slow to create & needs about
+    17 times the archive size in memory to do so.
+
+    Format 1 is the bsdiff4 format with bz2 blocks. Format 2 has the same
+    blocks compressed with the codec named in its header, so patches can
+    trade size for faster decompression on clients.
+    """
+
+    name = 'bsdiff4'
+
+    formats = (1, 2)
+
+    # Header of patch format 2. Followed by the codec name, padded to 8
+    # bytes & the control, diff & new file lengths like format 1.
+    MAGIC = b'PYUBSDF2'
+
+    # Download speed the "auto" codec is picked for. Bytes per second.
+    AUTO_DOWNLOAD_RATE = 1024 * 1024
+
+    def available(self):
+        return bsdiff4 is not None
+
+    def diff(self, src_path, dst_path, patch_path, codec=None):
+        if codec is None:
+            bsdiff4.file_diff(src_path, dst_path, patch_path)
+            return None
+        with open(src_path, 'rb') as f:
+            src = f.read()
+        with open(dst_path, 'rb') as f:
+            dst = f.read()
+        control, diff, extra = bsdiff4.core.diff(src, dst)
+        control = b''.join(bsdiff4.core.encode_int64(x)
+                           for c in control for x in c)
+        blocks = (control, diff, extra)
+        if codec == 'auto':
+            codec, compressed = Bsdiff4Engine._pick_codec(blocks)
+        else:
+            compressed = [compress_block(codec, b) for b in blocks]
+        with open(patch_path, 'wb') as f:
+            f.write(self.MAGIC + codec.encode('ascii').ljust(8, b'\0'))
+            for n in len(compressed[0]), len(compressed[1]), len(dst):
+                f.write(bsdiff4.core.encode_int64(n))
+            for b in compressed:
+                f.write(b)
+        return codec
+
+    def patch(self, src, patch):
+        codec, len_control, len_diff, len_dst, start = \
+            Bsdiff4Engine.read_header(patch)
+        if codec == 'bz2' and start == 32:
+            if isinstance(patch, mmap.mmap):
+                patch.seek(0)
+                patch = patch.read()
+            return bsdiff4.patch(src, bytes(patch))
+        control = read_block(codec, patch[start:start + len_control])
+        start += len_control
+        diff = read_block(codec, patch[start:start + len_diff])
+        extra = read_block(codec, patch[start + len_diff:])
+        control = [tuple(bsdiff4.core.decode_int64(control[i + j:i + j + 8])
+                         for j in (0, 8, 16))
+                   for i in range(0, len(control), 24)]
+        return bsdiff4.core.patch(bytes(src), len_dst, control, diff, extra)
+
+    @staticmethod
+    def read_header(patch):
+        """Reads the header of a format 1 or 2 patch
+
+        ######Args:
+
+        patch (bytes): The patch. May be memory mapped.
+
+        ######Returns (tuple): Codec, lengths of the control & diff blocks,
+        length of the new file & offset of the control block
+        """
+        header = bytes(patch[:40])
+        if header[:8] == BSDIFF4_MAGIC and len(header) >= 32:
+            codec, start = 'bz2', 8
+        elif header[:8] == Bsdiff4Engine.MAGIC and len(header) >= 40:
+            codec = header[8:16].rstrip(b'\0').decode('ascii', 'replace')
+            start = 16
+        else:
+            raise ValueError('Incorrect patch header')
+        lengths = [bsdiff4.core.decode_int64(header[i:i + 8])
+                   for i in range(start, start + 24, 8)]
+        return tuple([codec] + lengths + [start + 24])
+
+    @staticmethod
+    def _pick_codec(blocks):
+        # Least time to download & decompress at AUTO_DOWNLOAD_RATE
+        best = None
+        for codec in get_codec_names():
+            compressed = [compress_block(codec, b) for b in blocks]
+            start = time.time()
+            for b in compressed:
+                read_block(codec, b)
+            seconds = time.time() - start
+            size = sum(len(b) for b in compressed)
+            cost = float(size) / Bsdiff4Engine.AUTO_DOWNLOAD_RATE + seconds
+            log.debug('Codec %s: %s bytes, %.3fs to decompress', codec,
+                      size, seconds)
+            if best is None or cost < best[0]:
+                best = (cost, codec, compressed)
+        return best[1], best[2]
+
+
+class XdeltaEngine(DiffEngine):
+    """Pure Python copy & add delta in the style of xdelta. Blocks of the
+    new file found in the base are copied from it & the rest is added
+    from the patch. The instructions are zlib compressed.
+
+    Needs no compiled modules but creating patches is slow, so it suits
+    small archives.
+    """
+
+    name = 'xdelta'
+
+    MAGIC = b'PYUXDLT1'
+
+    # Bytes of the base indexed per block. Smaller blocks find more
+    # matches but use more memory.
+    BLOCK_SIZE = 32
+
+    # Bytes compared at once when extending a match
+    COMPARE_SIZE = 4096
+
+    # Bytes written at once
+    BUFFER_SIZE = 1024 * 1024
+
+    def diff(self, src_path, dst_path, patch_path, codec=None):
+        with open(src_path, 'rb') as f:
+            src = f.read()
+        with open(dst_path, 'rb') as f:
+            dst = f.read()
+        with open(patch_path, 'wb') as f:
+            f.write(self.MAGIC + struct.pack('<Q', len(dst)))
+            compressor = zlib.compressobj(9)
+            for op in self._encode(src, dst):
+                f.write(compressor.compress(op))
+            f.write(compressor.flush())
+        return None
+
+    def patch(self, src, patch):
+        out = io.BytesIO()
+        self._decode(src, patch, out)
+        return out.getvalue()
+
+    def patch_file(self, src_path, patch, dst_path):
+        # The base is memory mapped, so it isn't read into memory
+        with open(src_path, 'rb') as fsrc:
+            src_size = os.fstat(fsrc.fileno()).st_size
+            src = b''
+            if src_size > 0:
+                src = mmap.mmap(fsrc.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                with open(dst_path, 'wb') as fdst:
+                    self._decode(src, patch, fdst)
+            finally:
+                if src_size > 0:
+                    src.close()
+
+    def _encode(self, src, dst):
+        block = self.BLOCK_SIZE
+        index = {}
+        for offset in range(0, len(src) - block + 1, block):
+            index.setdefault(src[offset:offset + block], offset)
+
+        pos = start = 0
+        end = len(dst) - block
+        while pos <= end:
+            offset = index.get(dst[pos:pos + block])
+            if offset is None:
+                pos += 1
+                continue
+            # Matches often start before the indexed block
+            while pos > start and offset > 0 and \
+                    dst[pos - 1:pos] == src[offset - 1:offset]:
+                pos -= 1
+                offset -= 1
+            length = self._match_length(src, dst, offset + block,
+                                        pos + block) + block
+            if pos > start:
+                yield self._add(dst[start:pos])
+            yield b'C' + struct.pack('<QQ', offset, length)
+            pos += length
+            start = pos
+        if start < len(dst):
+            yield self._add(dst[start:])
+
+    def _match_length(self, src, dst, offset, pos):
+        length = 0
+        size = self.COMPARE_SIZE
+        while 1:
+            a = src[offset + length:offset + length + size]
+            b = dst[pos + length:pos + length + size]
+            if a == b and len(a) == size:
+                length += size
+                continue
+            for x, y in zip(bytearray(a), bytearray(b)):
+                if x != y:
+                    break
+                length += 1
+            return length
+
+    @staticmethod
+    def _add(data):
+        return b'A' + struct.pack('<Q', len(data)) + data
+
+    def _decode(self, src, patch, out):
+        header = bytes(patch[:16])
+        if len(header) < 16 or header[:8] != self.MAGIC:
+            raise ValueError('Incorrect patch header')
+        dst_size = struct.unpack('<Q', header[8:16])[0]
+        # Decompressed a piece at a time as the instructions are read
+        reader = open_block('zlib', patch, 16, len(patch))
+        written = 0
+        while 1:
+            op = reader.read(1)
+            if len(op) == 0:
+                break
+            if op == b'C':
+                args = reader.read(16)
+                if len(args) < 16:
+                    raise ValueError('Corrupt patch copy')
+                offset, length = struct.unpack('<QQ', args)
+                if offset + length > len(src):
+                    raise ValueError('Corrupt patch copy')
+                for i in range(0, length, self.BUFFER_SIZE):
+                    out.write(src[offset + i:offset + min(
+                        length, i + self.BUFFER_SIZE)])
+            elif op == b'A':
+                args = reader.read(8)
+                if len(args) < 8:
+                    raise ValueError('Corrupt patch add')
+                length = struct.unpack('<Q', args)[0]
+                remaining = length
+                while remaining > 0:
+                    data = reader.read(min(remaining, self.BUFFER_SIZE))
+                    if len(data) == 0:
+                        raise ValueError('Corrupt patch add')
+                    out.write(data)
+                    remaining -= len(data)
+            else:
+                raise ValueError('Corrupt patch instruction')
+            written += length
+        if written != dst_size:
+            raise ValueError('Corrupt patch size')
+
+
+class ZstdEngine(DiffEngine):
+    """zstd compression of the new file with the base as its dictionary,
+    like zstd --patch-from. Fast to create & apply. Needs the zstandard
+    module.
+    """
+
+    name = 'zstd'
+
+    LEVEL = 19
+
+    def available(self):
+        return zstandard is not None
+
+    def diff(self, src_path, dst_path, patch_path, codec=None):
+        with open(src_path, 'rb') as f:
+            src = f.read()
+        with open(dst_path, 'rb') as f:
+            dst = f.read()
+        # The window has to reach back over the whole base
+        window_log = max(len(src) + len(dst), 1).bit_length()
+        window_log = min(max(window_log, zstandard.WINDOWLOG_MIN),
+                         zstandard.WINDOWLOG_MAX)
+        params = zstandard.ZstdCompressionParameters.from_level(
+            self.LEVEL, window_log=window_log, enable_ldm=True)
+        compressor = zstandard.ZstdCompressor(
+            dict_data=ZstdEngine._get_dict(src), compression_params=params)
+        with open(patch_path, 'wb') as f:
+            f.write(compressor.compress(dst))
+        return None
+
+    def patch(self, src, patch):
+        return self._get_decompressor(src).decompress(patch)
+
+    def patch_file(self, src_path, patch, dst_path):
+        with open(src_path, 'rb') as f:
+            src = f.read()
+        if isinstance(patch, mmap.mmap):
+            patch.seek(0)
+        else:
+            patch = io.BytesIO(patch)
+        with open(dst_path, 'wb') as f:
+            self._get_decompressor(src).copy_stream(patch, f)
+
+    def _get_decompressor(self, src):
+        return zstandard.ZstdDecompressor(
+            dict_data=ZstdEngine._get_dict(src),
+            max_window_size=1 << zstandard.WINDOWLOG_MAX)
+
+    @staticmethod
+    def _get_dict(src):
+        return zstandard.ZstdCompressionDict(
+            bytes(src), dict_type=zstandard.DICT_TYPE_RAWCONTENT)
+
+
+register_engine(Bsdiff4Engine())
+register_engine(XdeltaEngine())
+register_engine(ZstdEngine())
@@ -37,6 +37,7 @@ extra_patch = 'bsdiff4 == 1.1.4'
 # End ToDo
 extra_s3 = 'PyUpdater-s3-Plugin >= 3.0.6'
 extra_scp = 'PyUpdater-scp-Plugin >= 3.0.5'
+extra_zstd = 'zstandard >= 0.9.0'
 
 setup(
     name='PyUpdater',
@@ -52,6 +53,7 @@ setup(
     extras_require={
         's3': extra_s3,
         'scp': extra_scp,
+        'zstd': extra_zstd,
         # ToDo: Remove in PyUpdater 3.0
         'patch': extra_patch,
         # End ToDo
@@ -22,6 +22,7 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE
 # OR OTHER DEALINGS IN THE SOFTWARE.
 # ------------------------------------------------------------------------------
+import hashlib
 import os
 import tempfile
 import threading
@@ -36,6 +37,8 @@ except ImportError:
     import SocketServer
 
 import pytest
+import six
+from six.moves.urllib.parse import unquote
 
 from pyupdater import PyUpdater
 from pyupdater.cli.options import make_parser
@@ -46,6 +49,11 @@ from pyupdater.utils.storage import Storage
 from tconfig import TConfig
 
 
+# asyncio support is python 3 only
+if six.PY2:
+    collect_ignore = ['test_aio.py']
+
+
 @pytest.fixture
 def cleandir():
     new_path = tempfile.mkdtemp()
@@ -128,3 +136,123 @@ def simpleserver():
                 self._server.alive = False
                 self._server = None
     return Server()
+
+
+class RangeRequestHandler(RequestHandler):
+    # Adds byte ranges & strong etags to the simple http handler.
+    # Settings live on the server so every server can act differently.
+
+    # Keep connections alive between requests
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def translate_path(self, path):
+        path = unquote(path.split('?', 1)[0]).lstrip('/')
+        return os.path.join(self.server.root, *path.split('/'))
+
+    def send_head(self):
+        self.server.requests.append(dict(self.headers))
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404, 'File not found')
+            return None
+
+        with open(path, 'rb') as f:
+            data = f.read()
+        etag = '"{}"'.format(hashlib.sha256(data).hexdigest())
+
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return None
+
+        start = 0
+        range_header = self.headers.get('Range')
+        if_range = self.headers.get('If-Range')
+        if (self.server.ranges is True and range_header is not None and
+                if_range in (None, etag)):
+            start, end = range_header.split('=')[1].split('-')
+            start = int(start)
+            end = int(end) if end else len(data) - 1
+            if start >= len(data):
+                self.send_error(416, 'Requested Range Not Satisfiable')
+                return None
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(
+                start, end, len(data)))
+            data = data[start:end + 1]
+        else:
+            self.send_response(200)
+
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+
+        # Acting like a connection that drops mid download
+        if self.server.drop_after is not None and self.command == 'GET':
+            data = data[:self.server.drop_after]
+            self.close_connection = True
+
+        f = tempfile.TemporaryFile()
+        f.write(data)
+        f.seek(0)
+        return f
+
+
+class RangeServer(object):
+    """Serves the current working directory on a random port"""
+
+    def __init__(self):
+        SocketServer.TCPServer.allow_reuse_address = True
+        self._httpd = SocketServer.ThreadingTCPServer(('127.0.0.1', 0),
+                                                      RangeRequestHandler)
+        self._httpd.daemon_threads = True
+        # Directory being served
+        self._httpd.root = os.getcwd()
+        # Headers of every request. Used for assertions
+        self._httpd.requests = []
+        # Set to False to act like a server without range support
+        self._httpd.ranges = True
+        # Bytes of a body sent before dropping the connection
+        self._httpd.drop_after = None
+
+        self.requests = self._httpd.requests
+        self.url = 'http://127.0.0.1:{}/'.format(
+            self._httpd.server_address[1])
+        t = threading.Thread(target=self._httpd.serve_forever)
+        t.daemon = True
+        t.start()
+
+    def __getattr__(self, name):
+        return getattr(self._httpd, name)
+
+    def __setattr__(self, name, value):
+        if name in ('root', 'ranges', 'drop_after'):
+            setattr(self._httpd, name, value)
+        else:
+            super(RangeServer, self).__setattr__(name, value)
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+@pytest.fixture
+def rangeservers():
+    # Returns a function creating servers. Used for mirror tests.
+    servers = []
+
+    def make():
+        servers.append(RangeServer())
+        return servers[-1]
+    yield make
+    for s in servers:
+        s.stop()
+
+
+@pytest.fixture
+def rangeserver(rangeservers):
+    return rangeservers()
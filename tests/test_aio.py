@@ -0,0 +1,79 @@
+# ------------------------------------------------------------------------------
+# Copyright (c) 2015-2017 Digital Sapphire
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the
+# following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF
+# ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+# TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR
+# ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE
+# OR OTHER DEALINGS IN THE SOFTWARE.
+# ------------------------------------------------------------------------------
+import asyncio
+import os
+import threading
+import time
+
+import pytest
+
+from pyupdater.client.aio import AsyncClient, AsyncLibUpdate
+from tconfig import TConfig
+
+
+@pytest.mark.usefixtures("cleandir")
+class TestAsyncClient(object):
+
+    def _client(self):
+        t_config = TConfig()
+        t_config.DATA_DIR = os.getcwd()
+        return AsyncClient(t_config, test=True)
+
+    def test_update_class(self):
+        client = self._client()
+        assert client._lib_update_class is AsyncLibUpdate
+
+    def test_refresh_concurrent(self, monkeypatch):
+        client = self._client()
+        # Both downloads must be running at the same time to get past
+        # the barrier
+        barrier = threading.Barrier(2, timeout=5)
+
+        def fake_download():
+            barrier.wait()
+            time.sleep(0.1)
+            return None
+
+        monkeypatch.setattr(client, '_get_key_data', fake_download)
+        monkeypatch.setattr(client, '_get_manifest_from_http',
+                            fake_download)
+
+        ticks = []
+
+        async def ticker():
+            # The loop keeps running while we refresh
+            while len(ticks) < 3:
+                ticks.append(time.time())
+                await asyncio.sleep(0.01)
+
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(asyncio.gather(client.refresh(),
+                                                   ticker()))
+        finally:
+            loop.close()
+        assert len(ticks) == 3
+        assert client.ready is False
@@ -0,0 +1,125 @@
+# ------------------------------------------------------------------------------
+# Copyright (c) 2015-2017 Digital Sapphire
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the
+# following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF
+# ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+# TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR
+# ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE
+# OR OTHER DEALINGS IN THE SOFTWARE.
+# ------------------------------------------------------------------------------
+from __future__ import unicode_literals
+
+import hashlib
+import os
+import time
+
+import pytest
+
+from pyupdater.client.cache import DownloadCache
+from pyupdater.client.downloader import FileDownloader
+
+
+def _write(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+    return hashlib.sha256(data).hexdigest()
+
+
+@pytest.mark.usefixtures("cleandir")
+class TestDownloadCache(object):
+
+    def test_put_get(self):
+        cache = DownloadCache('cache')
+        file_hash = _write('asset.bin', b'asset')
+        cache.put(file_hash, src='asset.bin')
+        assert cache.get(file_hash, 'copy.bin') is True
+        with open('copy.bin', 'rb') as f:
+            assert f.read() == b'asset'
+        assert cache.get('0' * 64, 'missing.bin') is False
+
+    def test_put_data(self):
+        cache = DownloadCache('cache')
+        file_hash = hashlib.sha256(b'asset').hexdigest()
+        cache.put(file_hash, data=b'asset')
+        assert cache.get(file_hash, 'copy.bin') is True
+
+    def test_corrupt(self):
+        cache = DownloadCache('cache')
+        file_hash = hashlib.sha256(b'asset').hexdigest()
+        cache.put(file_hash, data=b'tampered')
+        assert cache.get(file_hash, 'copy.bin') is False
+        assert not os.path.exists('copy.bin')
+        assert not os.path.exists(cache._entry_path(file_hash))
+
+    def test_eviction(self):
+        cache = DownloadCache('cache', max_size=10)
+        first = hashlib.sha256(b'first').hexdigest()
+        second = hashlib.sha256(b'second').hexdigest()
+        cache.put(first, data=b'first')
+        cache.put(second, data=b'second')
+        # Both don't fit. Least recently used goes first.
+        assert os.path.exists(cache._entry_path(second))
+        assert not os.path.exists(cache._entry_path(first))
+
+        cache.max_size = 11
+        cache.put(first, data=b'first')
+        old = time.time() - 60
+        os.utime(cache._entry_path(first), (old, old))
+        assert cache.get(first, 'first.bin') is True
+        third = hashlib.sha256(b'third').hexdigest()
+        cache.put(third, data=b'third')
+        assert os.path.exists(cache._entry_path(first))
+        assert not os.path.exists(cache._entry_path(second))
+
+
+@pytest.mark.usefixtures("cleandir")
+class TestCachedDownload(object):
+
+    filename = 'cached.bin'
+    data = os.urandom(1024 * 64)
+    file_hash = hashlib.sha256(data).hexdigest()
+
+    @pytest.mark.parametrize('download_max_size', [0, 1024 * 1024])
+    def test_download(self, rangeserver, download_max_size):
+        _write(self.filename, self.data)
+        cache = DownloadCache(os.path.abspath('cache'))
+        for app in ('app1', 'app2'):
+            os.mkdir(app)
+            os.chdir(app)
+            fd = FileDownloader(self.filename, [rangeserver.url],
+                                self.file_hash, cache=cache)
+            fd.download_max_size = download_max_size
+            assert fd.download_verify_write() is True
+            with open(self.filename, 'rb') as f:
+                assert f.read() == self.data
+            os.chdir(os.pardir)
+        # Second app got the file from the cache
+        assert len(rangeserver.requests) == 1
+
+    def test_buffer(self, rangeserver):
+        _write(self.filename, self.data)
+        cache = DownloadCache(os.path.abspath('cache'))
+        cache.put(self.file_hash, data=self.data)
+        os.mkdir('app')
+        os.chdir('app')
+        fd = FileDownloader(self.filename, [rangeserver.url],
+                            self.file_hash, cache=cache)
+        assert fd.download_verify_buffer()[:] == self.data
+        fd.release()
+        assert os.listdir(os.getcwd()) == []
+        assert len(rangeserver.requests) == 0
@@ -97,6 +97,10 @@ class TestCommandDispatch(object):
         assert dispatch_command(NamespaceHelper(command='collect-debug-info'),
                                 test=True) is True
 
+    def test_serve(self):
+        assert dispatch_command(NamespaceHelper(command='serve'),
+                                test=True) is True
+
     def test_upload(self):
         assert dispatch_command(NamespaceHelper(command='upload'),
                                 test=True) is True
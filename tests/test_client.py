@@ -25,6 +25,8 @@
 from __future__ import print_function
 from __future__ import unicode_literals
 
+import gzip
+import io
 import json
 import os
 import time
@@ -37,7 +39,7 @@ import six
 
 from pyupdater.client import Client
 from pyupdater.client.updates import (gen_user_friendly_version,
-                                      _get_highest_version)
+                                      _get_highest_version, LibUpdate)
 from tconfig import TConfig
 
 
@@ -166,7 +168,7 @@ class TestDownload(object):
         update = client.update_check(client.app_name, '0.0.1')
         assert update is not None
         assert update.app_name == 'Acme'
-        update.download(async=True)
+        update.download(background=True)
         count = 0
         while count < 61:
             if update.is_downloaded() is True:
@@ -183,9 +185,9 @@ class TestDownload(object):
         update = client.update_check(client.app_name, '0.0.1')
         assert update is not None
         assert update.app_name == 'Acme'
-        update.download(async=True)
+        update.download(background=True)
         count = 0
-        assert update.download(async=True) is None
+        assert update.download(background=True) is None
         assert update.download() is None
         while count < 61:
             if update.is_downloaded() is True:
@@ -217,6 +219,55 @@ class TestExtract(object):
             assert update.extract() is False
 
 
+@pytest.mark.usefixtures("cleandir")
+class TestHedgedUpdate(object):
+
+    version_data = {
+        "latest": {"Acme": {"stable": {"mac": "4.4.3.2.0"}}},
+        "updates": {"Acme": {
+            "4.4.1.2.0": {"mac": {"filename": "Acme-mac-4.4.1.zip"}},
+            "4.4.3.2.0": {"mac": {"filename": "Acme-mac-4.4.3.zip"}},
+        }},
+    }
+
+    class FailingPatcher(object):
+        expected_time = None
+        progress = 0
+
+        def start(self):
+            return False
+
+    def test_no_second_full_download(self, monkeypatch):
+        update = LibUpdate({'name': 'Acme', 'version': '4.4.1.2.0',
+                            'platform': 'mac', 'data_dir': os.getcwd(),
+                            'easy_data': EasyAccessDict(self.version_data),
+                            'hedged_updates': True})
+        calls = []
+
+        def full_update(cancel_event=None):
+            calls.append(cancel_event)
+            return False
+
+        monkeypatch.setattr(update, '_is_downloaded', lambda: False)
+        monkeypatch.setattr(update, '_create_patcher',
+                            lambda cancel_event: self.FailingPatcher())
+        monkeypatch.setattr(update, '_full_update', full_update)
+        assert update.download() is False
+        # The failed full download of the hedge isn't repeated
+        assert len(calls) == 1
+
+
+class TestGzipBuffer(object):
+
+    def test_buffers(self):
+        f = io.BytesIO()
+        with gzip.GzipFile(fileobj=f, mode='wb') as gz:
+            gz.write(b'PyUpdater')
+        data = f.getvalue()
+        for buf in (data, memoryview(data), memoryview(bytearray(data))):
+            assert Client._gzip_decompress_buffer(buf) == b'PyUpdater'
+
+
 class TestGenVersion(object):
 
     def test1(self):
@@ -297,3 +348,32 @@ class TestMissingStable(object):
         data = EasyAccessDict(self.version_data)
         assert _get_highest_version('Acme', 'mac', 'stable',
                                     data, strict=True) is None
+
+
+@pytest.mark.usefixtures("cleandir")
+class TestConditionalManifest(object):
+
+    def test_not_modified(self, rangeserver):
+        os.mkdir('repo')
+        with gzip.open(os.path.join('repo', 'versions.gz'), 'wb') as f:
+            f.write(b'{"updates": {}}')
+        rangeserver.root = os.path.abspath('repo')
+
+        t_config = TConfig()
+        t_config.DATA_DIR = os.getcwd()
+        t_config.UPDATE_URLS = [rangeserver.url]
+        client = Client(t_config, test=True)
+        data = client._get_manifest_from_http()
+        assert data == b'{"updates": {}}'
+        assert 'If-None-Match' not in rangeserver.requests[-1]
+
+        # Served from disk after a 304
+        client = Client(t_config, test=True)
+        assert client._get_manifest_from_http() == data
+        assert 'If-None-Match' in rangeserver.requests[-1]
+
+        # Unusable copy on disk is downloaded again
+        with open('versions.gz', 'wb') as f:
+            f.write(b'corrupt')
+        assert client._get_manifest_from_http() == data
+        assert 'If-None-Match' not in rangeserver.requests[-1]
@@ -24,9 +24,22 @@
 # ------------------------------------------------------------------------------
 from __future__ import unicode_literals
 
+import hashlib
+import json
+import os
+import threading
+import time
+
 import pytest
+from six.moves.urllib.request import pathname2url
 
-from pyupdater.client.downloader import FileDownloader, get_hash
+from pyupdater.client import downloader
+from pyupdater.client.downloader import (_BlockPipeline, _copy_file,
+                                         _kernel_copy, _preallocate,
+                                         _write_at, create_http_pool,
+                                         FileDownloader, get_hash,
+                                         RateLimiter)
+from pyupdater.client.mirrors import MirrorSelector
 from pyupdater.utils.exceptions import FileDownloaderError
 
 
@@ -105,6 +118,591 @@ class TestContentLength(object):
         assert fd.content_length == 2387
 
 
+@pytest.mark.usefixtures("cleandir")
+class TestResume(object):
+
+    filename = 'resume.bin'
+    data = os.urandom(1024 * 64)
+
+    def _setup_files(self, part_size, hexdigest=None):
+        with open(self.filename, 'wb') as f:
+            f.write(self.data)
+        if hexdigest is None:
+            hexdigest = hashlib.sha256(self.data).hexdigest()
+        os.mkdir('client')
+        part = os.path.join('client', self.filename + '.part')
+        with open(part, 'wb') as f:
+            f.write(self.data[:part_size])
+        with open(part + '.json', 'w') as f:
+            f.write(json.dumps({'hexdigest': hexdigest, 'etag': None,
+                                'last_modified': None}))
+        return hashlib.sha256(self.data).hexdigest()
+
+    def test_resume(self, rangeserver):
+        file_hash = self._setup_files(1000)
+        os.chdir('client')
+        fd = FileDownloader(self.filename, [rangeserver.url], file_hash,
+                            resume=True)
+        assert fd.download_verify_write() is True
+        assert rangeserver.requests[-1]['Range'] == 'bytes=1000-'
+        assert fd.content_length == len(self.data)
+        # Throughput only counts the bytes of this session
+        assert fd.bytes_received == len(self.data) - 1000
+        with open(self.filename, 'rb') as f:
+            assert f.read() == self.data
+        assert os.listdir(os.getcwd()) == [self.filename]
+
+    def test_resume_other_file(self, rangeserver):
+        file_hash = self._setup_files(1000, hexdigest='other')
+        os.chdir('client')
+        fd = FileDownloader(self.filename, [rangeserver.url], file_hash,
+                            resume=True)
+        assert fd.download_verify_write() is True
+        assert 'Range' not in rangeserver.requests[-1]
+
+    def test_resume_bad_part(self, rangeserver):
+        file_hash = self._setup_files(1000)
+        os.chdir('client')
+        with open(self.filename + '.part', 'wb') as f:
+            f.write(b'0' * 1000)
+        fd = FileDownloader(self.filename, [rangeserver.url], file_hash,
+                            resume=True)
+        assert fd.download_verify_write() is False
+        assert not os.path.exists(self.filename + '.part')
+
+    def test_interrupted_part_size(self, rangeserver):
+        # The preallocated part file is cut down to the received bytes
+        self._setup_files(0)
+        os.chdir('client')
+        os.remove(self.filename + '.part')
+        rangeserver.drop_after = 5000
+        fd = FileDownloader(self.filename, [rangeserver.url],
+                            hashlib.sha256(self.data).hexdigest(),
+                            resume=True)
+        fd.download_max_size = 0
+        assert fd.download_verify_write() is False
+        with open(self.filename + '.part', 'rb') as f:
+            part = f.read()
+        assert 0 < len(part) < len(self.data)
+        assert part == self.data[:len(part)]
+
+    def test_part_size_during_download(self, rangeserver, monkeypatch):
+        # A crash mid download leaves only the received bytes in the
+        # part file, so the next run resumes at the right offset
+        self._setup_files(0)
+        os.chdir('client')
+        os.remove(self.filename + '.part')
+        sizes = []
+        write_at = downloader._write_at
+
+        def check_write_at(f, data, offset):
+            sizes.append((os.fstat(f.fileno()).st_size, offset))
+            write_at(f, data, offset)
+
+        monkeypatch.setattr(downloader, '_write_at', check_write_at)
+        fd = FileDownloader(self.filename, [rangeserver.url],
+                            hashlib.sha256(self.data).hexdigest(),
+                            resume=True)
+        fd.download_max_size = 0
+        fd.block_size = 1024
+        assert fd.download_verify_write() is True
+        assert len(sizes) > 1
+        assert all(size <= offset for size, offset in sizes)
+
+
+@pytest.mark.usefixtures("cleandir")
+class TestReadInto(object):
+
+    filename = 'readinto.bin'
+    data = os.urandom(1024 * 1024 * 5 + 3)
+
+    def test_file_mode(self, rangeserver):
+        with open(self.filename, 'wb') as f:
+            f.write(self.data)
+        os.mkdir('client')
+        os.chdir('client')
+        fd = FileDownloader(self.filename, [rangeserver.url],
+                            hashlib.sha256(self.data).hexdigest())
+        fd.download_max_size = 1024 * 1024
+        assert fd.download_verify_write() is True
+        with open(self.filename, 'rb') as f:
+            assert f.read() == self.data
+
+    def test_write_at(self):
+        with open(self.filename, 'w+b') as f:
+            _preallocate(f, 10)
+            _write_at(f, b'world', 5)
+            _write_at(f, bytearray(b'hello'), 0)
+            f.seek(0)
+            assert f.read() == b'helloworld'
+
+
+@pytest.mark.usefixtures("cleandir")
+class TestSegments(object):
+
+    filename = 'segments.bin'
+    data = os.urandom(1024 * 64)
+    file_hash = hashlib.sha256(data).hexdigest()
+
+    def _download(self, server):
+        with open(self.filename, 'wb') as f:
+            f.write(self.data)
+        os.mkdir('client')
+        os.chdir('client')
+        fd = FileDownloader(self.filename, [server.url], self.file_hash,
+                            segments=4)
+        fd.min_segment_size = 1024 * 16
+        assert fd.download_verify_write() is True
+        with open(self.filename, 'rb') as f:
+            assert f.read() == self.data
+
+    def test_segments(self, rangeserver):
+        self._download(rangeserver)
+        ranges = sorted(r['Range'] for r in rangeserver.requests[1:])
+        assert ranges == ['bytes=0-16383', 'bytes=16384-32767',
+                          'bytes=32768-49151', 'bytes=49152-65535']
+
+    def test_no_range_support(self, rangeserver):
+        rangeserver.ranges = False
+        self._download(rangeserver)
+        assert len(rangeserver.requests) == 1
+
+
+@pytest.mark.usefixtures("cleandir")
+class TestFailover(object):
+
+    filename = 'failover.bin'
+    data = os.urandom(1024 * 64)
+    file_hash = hashlib.sha256(data).hexdigest()
+
+    @pytest.fixture(autouse=True)
+    def no_backoff(self, monkeypatch):
+        monkeypatch.setattr(FileDownloader, 'BACKOFF_BASE', 0)
+
+    def _setup(self, rangeservers):
+        with open(self.filename, 'wb') as f:
+            f.write(self.data)
+        bad = rangeservers()
+        bad.drop_after = 1024 * 20
+        good = rangeservers()
+        os.mkdir('client')
+        os.chdir('client')
+        return bad, good
+
+    @pytest.mark.parametrize('download_max_size', [0, 1024 * 1024])
+    def test_failover(self, rangeservers, download_max_size):
+        bad, good = self._setup(rangeservers)
+        fd = FileDownloader(self.filename, [bad.url, good.url],
+                            self.file_hash)
+        fd.download_max_size = download_max_size
+        assert fd.download_verify_return() == self.data
+        assert len(bad.requests) == 1
+        assert good.requests[0]['Range'] == 'bytes=20480-'
+
+    def test_failover_error_page(self, rangeservers):
+        bad, good = self._setup(rangeservers)
+        bad.drop_after = 0
+        # Mirror without the file
+        missing = rangeservers()
+        missing.root = os.getcwd()
+        fd = FileDownloader(self.filename, [bad.url, missing.url, good.url],
+                            self.file_hash)
+        assert fd.download_verify_return() == self.data
+        assert len(missing.requests) == 1
+
+    def test_retry_budget(self, rangeservers):
+        bad, good = self._setup(rangeservers)
+        good.drop_after = 0
+        fd = FileDownloader(self.filename, [bad.url, good.url],
+                            self.file_hash, mirror_retries=2)
+        assert fd.download_verify_return() is None
+        assert len(bad.requests) == 2
+        assert len(good.requests) == 2
+
+    def test_mirror_stats(self, rangeservers):
+        bad, good = self._setup(rangeservers)
+        ms = MirrorSelector([bad.url, good.url], os.getcwd(), None)
+        fd = FileDownloader(self.filename, [bad.url, good.url],
+                            self.file_hash, mirrors=ms)
+        assert fd.download_verify_return() == self.data
+        assert ms.stats[bad.url]['failures'] == 1
+        assert ms.stats[good.url]['ttfb'] > 0
+        assert ms.get_urls() == [good.url, bad.url]
+        assert os.path.exists(ms.path)
+
+
+@pytest.mark.usefixtures("cleandir")
+class TestSharedPool(object):
+
+    def test_shared_pool(self, rangeserver):
+        for name in ('one.txt', 'two.txt'):
+            with open(name, 'wb') as f:
+                f.write(name.encode('utf-8'))
+        http_pool = create_http_pool(secure=False)
+        for name in ('one.txt', 'two.txt'):
+            fd = FileDownloader(name, [rangeserver.url], http_pool=http_pool)
+            assert fd.http_pool is http_pool
+            assert fd.download_verify_return() == name.encode('utf-8')
+        pool = http_pool.connection_from_url(rangeserver.url)
+        assert pool.num_connections == 1
+
+
+@pytest.mark.usefixtures("cleandir")
+class TestRateLimiter(object):
+
+    filename = 'throttle.bin'
+    data = os.urandom(1024 * 64)
+    file_hash = hashlib.sha256(data).hexdigest()
+
+    def test_unlimited(self):
+        limiter = RateLimiter()
+        assert limiter.block_size(4194304) == 4194304
+        start = time.time()
+        limiter.consume(1024 * 1024 * 100)
+        assert time.time() - start < 0.1
+
+    def test_throttled_download(self, rangeserver):
+        with open(self.filename, 'wb') as f:
+            f.write(self.data)
+        os.mkdir('client')
+        os.chdir('client')
+        limiter = RateLimiter(1024 * 128, burst=1024 * 16)
+        fd = FileDownloader(self.filename, [rangeserver.url], self.file_hash,
+                            rate_limiter=limiter)
+        start = time.time()
+        assert fd.download_verify_return() == self.data
+        # 64k at 128k/s with an empty bucket
+        assert time.time() - start > 0.35
+
+    def test_change_rate(self):
+        limiter = RateLimiter(1)
+        t = threading.Thread(target=limiter.consume, args=(1024 * 16,))
+        t.start()
+        time.sleep(0.1)
+        assert t.is_alive()
+        limiter.set_rate(None)
+        t.join(1)
+        assert not t.is_alive()
+
+
+@pytest.mark.usefixtures("cleandir")
+class TestCancel(object):
+
+    filename = 'cancel.bin'
+    data = os.urandom(1024 * 64)
+    file_hash = hashlib.sha256(data).hexdigest()
+
+    def test_cancel(self, rangeserver):
+        with open(self.filename, 'wb') as f:
+            f.write(self.data)
+        os.mkdir('client')
+        os.chdir('client')
+        cancel = threading.Event()
+        cancel.set()
+        fd = FileDownloader(self.filename, [rangeserver.url], self.file_hash,
+                            cancel_event=cancel)
+        with pytest.raises(FileDownloaderError):
+            fd.download_verify_return()
+
+    def test_cancel_before_write(self, rangeserver):
+        with open(self.filename, 'wb') as f:
+            f.write(self.data)
+        os.mkdir('client')
+        os.chdir('client')
+        cancel = threading.Event()
+
+        def hook(status):
+            if status['status'] == 'finished':
+                cancel.set()
+
+        fd = FileDownloader(self.filename, [rangeserver.url], self.file_hash,
+                            progress_hooks=[hook], cancel_event=cancel)
+        with pytest.raises(FileDownloaderError):
+            fd.download_verify_write()
+        assert os.listdir(os.getcwd()) == []
+
+    @pytest.mark.skipif(not hasattr(os, 'link'), reason='No hard links')
+    @pytest.mark.parametrize('download_max_size', [0, 1024 * 1024])
+    def test_write_replaces_file(self, rangeserver, download_max_size):
+        with open(self.filename, 'wb') as f:
+            f.write(self.data)
+        os.mkdir('client')
+        os.chdir('client')
+        with open(self.filename, 'wb') as f:
+            f.write(b'patched')
+        # Acts like a reader with the old file open
+        os.link(self.filename, 'reader')
+        fd = FileDownloader(self.filename, [rangeserver.url], self.file_hash)
+        fd.download_max_size = download_max_size
+        assert fd.download_verify_write() is True
+        with open('reader', 'rb') as f:
+            assert f.read() == b'patched'
+        with open(self.filename, 'rb') as f:
+            assert f.read() == self.data
+        assert sorted(os.listdir(os.getcwd())) == sorted(['reader',
+                                                          self.filename])
+
+
+@pytest.mark.usefixtures("cleandir")
+class TestBuffer(object):
+
+    filename = 'buffer.bin'
+    data = os.urandom(1024 * 64)
+    file_hash = hashlib.sha256(data).hexdigest()
+
+    @pytest.mark.parametrize('download_max_size', [0, 1024 * 1024])
+    def test_buffer(self, rangeserver, download_max_size):
+        with open(self.filename, 'wb') as f:
+            f.write(self.data)
+        os.mkdir('client')
+        os.chdir('client')
+        fd = FileDownloader(self.filename, [rangeserver.url], self.file_hash)
+        fd.download_max_size = download_max_size
+        buf = fd.download_verify_buffer()
+        assert buf[:] == self.data
+        fd.release()
+        assert os.listdir(os.getcwd()) == []
+
+    def test_bad_hash(self, rangeserver):
+        with open(self.filename, 'wb') as f:
+            f.write(self.data)
+        fd = FileDownloader(self.filename, [rangeserver.url], 'bad hash')
+        assert fd.download_verify_buffer() is None
+
+
+@pytest.mark.usefixtures("cleandir")
+class TestPipeline(object):
+
+    filename = 'pipeline.bin'
+    data = os.urandom(1024 * 1024 * 3 + 7)
+    file_hash = hashlib.sha256(data).hexdigest()
+
+    def _setup(self):
+        with open(self.filename, 'wb') as f:
+            f.write(self.data)
+        os.mkdir('client')
+        os.chdir('client')
+
+    @pytest.mark.parametrize('download_max_size', [0, 16 * 1024 * 1024])
+    def test_pipeline(self, rangeserver, download_max_size):
+        self._setup()
+        fd = FileDownloader(self.filename, [rangeserver.url], self.file_hash,
+                            pipeline=True)
+        fd.download_max_size = download_max_size
+        assert fd.download_verify_return() == self.data
+
+    def test_failover(self, rangeservers, monkeypatch):
+        monkeypatch.setattr(FileDownloader, 'BACKOFF_BASE', 0)
+        bad = rangeservers()
+        bad.drop_after = 1024 * 1024
+        good = rangeservers()
+        self._setup()
+        bad.root = good.root = os.path.dirname(os.getcwd())
+        fd = FileDownloader(self.filename, [bad.url, good.url],
+                            self.file_hash, pipeline=True)
+        assert fd.download_verify_write() is True
+        with open(self.filename, 'rb') as f:
+            assert f.read() == self.data
+
+    def test_worker_error(self):
+        def store(block, offset):
+            raise IOError('Disk full')
+
+        pipeline = _BlockPipeline(hashlib.sha256(), store, buffers=2)
+        buf = pipeline.get_buffer()
+        pipeline.submit(buf, 1, 0)
+        with pytest.raises(IOError):
+            # Fails once the worker reported the error
+            for _ in range(10):
+                pipeline.submit(pipeline.get_buffer(), 1, 0)
+        with pytest.raises(IOError):
+            pipeline.close()
+
+
+@pytest.mark.usefixtures("cleandir")
+class TestChunks(object):
+
+    filename = 'chunks.bin'
+    chunk_size = 1024 * 64
+    data = os.urandom(chunk_size * 5 + 100)
+    file_hash = hashlib.sha256(data).hexdigest()
+
+    def _setup(self, rangeservers, corrupt=(1, 3)):
+        # First server has a copy with corrupt chunks
+        for name, chunks in (('bad', corrupt), ('good', ())):
+            os.mkdir(name)
+            data = bytearray(self.data)
+            for c in chunks:
+                data[c * self.chunk_size] ^= 0xff
+            with open(os.path.join(name, self.filename), 'wb') as f:
+                f.write(data)
+        bad, good = rangeservers(), rangeservers()
+        bad.root = os.path.abspath('bad')
+        good.root = os.path.abspath('good')
+        os.mkdir('client')
+        os.chdir('client')
+        return bad, good
+
+    def _downloader(self, urls, **kwargs):
+        size = self.chunk_size
+        hashes = [hashlib.sha256(self.data[i:i + size]).hexdigest()
+                  for i in range(0, len(self.data), size)]
+        return FileDownloader(self.filename, urls, self.file_hash,
+                              chunk_size=size, chunk_hashes=hashes, **kwargs)
+
+    @pytest.mark.parametrize('download_max_size', [0, 16 * 1024 * 1024])
+    def test_repair(self, rangeservers, download_max_size):
+        bad, good = self._setup(rangeservers)
+        fd = self._downloader([bad.url, good.url])
+        fd.download_max_size = download_max_size
+        assert fd.download_verify_return() == self.data
+        # Only the corrupt chunks came from the good mirror
+        assert [r['Range'] for r in good.requests] == [
+            'bytes=65536-131071', 'bytes=196608-262143']
+
+    def test_segments(self, rangeservers):
+        bad, good = self._setup(rangeservers, corrupt=(0, 5))
+        fd = self._downloader([bad.url, good.url], segments=2)
+        fd.min_segment_size = 1
+        assert fd.download_verify_write() is True
+        with open(self.filename, 'rb') as f:
+            assert f.read() == self.data
+        assert len(good.requests) == 2
+
+    def test_not_repairable(self, rangeservers):
+        bad, good = self._setup(rangeservers)
+        fd = self._downloader([bad.url], resume=True)
+        fd.download_max_size = 0
+        assert fd.download_verify_write() is False
+        assert os.listdir(os.getcwd()) == []
+
+    def test_resume_verified_chunks(self, rangeservers):
+        bad, good = self._setup(rangeservers, corrupt=())
+        with open(self.filename + '.part', 'wb') as f:
+            f.write(self.data[:self.chunk_size * 2 + 10])
+        with open(self.filename + '.part.json', 'w') as f:
+            f.write(json.dumps({'hexdigest': self.file_hash,
+                                'chunks_verified': 2}))
+        fd = self._downloader([good.url], resume=True)
+        assert fd.download_verify_write() is True
+        assert good.requests[-1]['Range'] == 'bytes=131072-'
+        with open(self.filename, 'rb') as f:
+            assert f.read() == self.data
+
+    def test_interrupted_saves_verified_chunks(self, rangeservers):
+        bad, good = self._setup(rangeservers, corrupt=())
+        good.drop_after = self.chunk_size * 3 + 10
+        fd = self._downloader([good.url], resume=True, mirror_retries=0)
+        fd.download_max_size = 0
+        assert fd.download_verify_write() is False
+        with open(self.filename + '.part.json', 'r') as f:
+            assert json.loads(f.read())['chunks_verified'] == 3
+
+
+@pytest.mark.usefixtures("cleandir")
+class TestLocal(object):
+
+    filename = 'local.bin'
+    data = os.urandom(1024 * 300)
+    file_hash = hashlib.sha256(data).hexdigest()
+
+    def _setup(self, data=None):
+        os.mkdir('share')
+        with open(os.path.join('share', self.filename), 'wb') as f:
+            f.write(self.data if data is None else data)
+        os.mkdir('client')
+        os.chdir('client')
+        return os.path.abspath(os.path.join('..', 'share'))
+
+    @pytest.mark.parametrize('download_max_size', [0, 16 * 1024 * 1024])
+    def test_directory(self, download_max_size):
+        share = self._setup()
+        fd = FileDownloader(self.filename, [share], self.file_hash)
+        fd.download_max_size = download_max_size
+        assert fd.download_verify_write() is True
+        with open(self.filename, 'rb') as f:
+            assert f.read() == self.data
+        assert os.listdir(os.getcwd()) == [self.filename]
+
+    def test_file_url(self):
+        share = self._setup()
+        url = 'file://' + pathname2url(share) + '/'
+        fd = FileDownloader(self.filename, [url], self.file_hash)
+        assert fd.download_verify_return() == self.data
+
+    def test_bad_copy(self, rangeserver):
+        share = self._setup(data=b'0' * len(self.data))
+        rangeserver.root = os.path.dirname(share)
+        with open(os.path.join(rangeserver.root, self.filename), 'wb') as f:
+            f.write(self.data)
+        fd = FileDownloader(self.filename, [share, rangeserver.url],
+                            self.file_hash)
+        fd.download_max_size = 0
+        assert fd.download_verify_write() is True
+        with open(self.filename, 'rb') as f:
+            assert f.read() == self.data
+        # The local source is untouched
+        with open(os.path.join(share, self.filename), 'rb') as f:
+            assert f.read() == b'0' * len(self.data)
+
+    def test_chunk_repair_keeps_source(self, rangeserver):
+        bad = bytearray(self.data)
+        bad[0] ^= 0xff
+        share = self._setup(data=bytes(bad))
+        rangeserver.root = os.path.dirname(share)
+        with open(os.path.join(rangeserver.root, self.filename), 'wb') as f:
+            f.write(self.data)
+        size = 1024 * 64
+        hashes = [hashlib.sha256(self.data[i:i + size]).hexdigest()
+                  for i in range(0, len(self.data), size)]
+        fd = FileDownloader(self.filename, [share, rangeserver.url],
+                            self.file_hash, chunk_size=size,
+                            chunk_hashes=hashes)
+        fd.download_max_size = 0
+        assert fd.download_verify_write() is True
+        with open(self.filename, 'rb') as f:
+            assert f.read() == self.data
+        with open(os.path.join(share, self.filename), 'rb') as f:
+            assert f.read() == bad
+
+    def test_copy_file(self):
+        with open('src', 'wb') as f:
+            f.write(self.data)
+        with open('src', 'rb') as fsrc:
+            with open('dst', 'wb') as fdst:
+                copied = _kernel_copy(fsrc, fdst, len(self.data))
+        if copied is True:
+            with open('dst', 'rb') as f:
+                assert f.read() == self.data
+        _copy_file('src', 'dst')
+        with open('dst', 'rb') as f:
+            assert f.read() == self.data
+
+
+@pytest.mark.usefixtures("cleandir")
+class TestConditional(object):
+
+    def test_not_modified(self, rangeserver):
+        with open('versions.gz', 'wb') as f:
+            f.write(b'versions')
+        fd = FileDownloader('versions.gz', [rangeserver.url])
+        assert fd.download_verify_return() == b'versions'
+        assert fd.validators['etag'] is not None
+
+        fd = FileDownloader('versions.gz', [rangeserver.url],
+                            validators=fd.validators)
+        assert fd.download_verify_return() is None
+        assert fd.not_modified is True
+
+        # Changed files are downloaded
+        with open('versions.gz', 'wb') as f:
+            f.write(b'new versions')
+        fd = FileDownloader('versions.gz', [rangeserver.url],
+                            validators=fd.validators)
+        assert fd.download_verify_return() == b'new versions'
+        assert fd.not_modified is False
+
+
 @pytest.mark.usefixtue("cleandir")
 class TestGetHash(object):
 
@@ -0,0 +1,115 @@
+# ------------------------------------------------------------------------------
+# Copyright (c) 2015-2017 Digital Sapphire
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the
+# following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF
+# ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+# TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR
+# ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE
+# OR OTHER DEALINGS IN THE SOFTWARE.
+# ------------------------------------------------------------------------------
+from __future__ import unicode_literals
+
+import os
+import time
+
+import pytest
+
+from pyupdater.client import Client
+from pyupdater.client.downloader import create_http_pool, FileDownloader
+from pyupdater.client.mirrors import MirrorSelector
+
+
+DEAD_URL = 'http://127.0.0.1:1/'
+
+
+@pytest.mark.usefixtures("cleandir")
+class TestMirrorSelector(object):
+
+    def test_probe(self, rangeserver):
+        with open('keys.gz', 'wb') as f:
+            f.write(b'keys')
+        ms = MirrorSelector([DEAD_URL, rangeserver.url], os.getcwd(),
+                            create_http_pool(secure=False))
+        assert ms.needs_probe() is True
+        ms.probe()
+        assert ms.needs_probe() is False
+        assert ms.get_urls() == [rangeserver.url, DEAD_URL]
+
+        # Ranking is loaded by later sessions
+        ms = MirrorSelector([DEAD_URL, rangeserver.url], os.getcwd(),
+                            create_http_pool(secure=False))
+        assert ms.needs_probe() is False
+        assert ms.get_urls() == [rangeserver.url, DEAD_URL]
+
+    def test_downloads(self, rangeserver):
+        with open('app.zip', 'wb') as f:
+            f.write(b'app')
+        ms = MirrorSelector([DEAD_URL, rangeserver.url], os.getcwd(), None)
+        fd = FileDownloader('app.zip', [DEAD_URL, rangeserver.url],
+                            mirrors=ms)
+        assert fd.download_verify_return() == b'app'
+        assert ms.stats[DEAD_URL]['failures'] == 1
+        assert ms.stats[rangeserver.url]['ttfb'] > 0
+        assert ms.get_urls() == [rangeserver.url, DEAD_URL]
+
+    def test_missing_file(self, rangeserver):
+        ms = MirrorSelector([rangeserver.url], os.getcwd(), None)
+        fd = FileDownloader('app.zip', [rangeserver.url], 'hash',
+                            mirrors=ms)
+        assert fd.download_verify_return() is None
+        # A missing file isn't a failure of the mirror
+        assert rangeserver.url not in ms.stats
+
+    def test_ranking(self):
+        urls = ['http://one/', 'http://two/', 'http://three/']
+        ms = MirrorSelector(urls, os.getcwd(), None)
+        # Unranked mirrors keep their configured order
+        assert ms.get_urls() == urls
+        ms.record_success('http://three/', 0.05)
+        ms.record_success('http://two/', 0.5)
+        assert ms.get_urls() == ['http://three/', 'http://two/',
+                                 'http://one/']
+
+    def test_cooldown(self):
+        urls = ['http://one/', 'http://two/']
+        ms = MirrorSelector(urls, os.getcwd(), None)
+        ms.record_failure('http://one/')
+        # Mirrors in cooldown are kept as a last resort
+        assert ms.get_urls() == ['http://two/', 'http://one/']
+        ms.record_failure('http://two/')
+        assert sorted(ms.get_urls()) == urls
+        ms.stats['http://one/']['cooldown_until'] = time.time() - 1
+        assert ms.get_urls()[0] == 'http://one/'
+
+    def test_local_sources(self):
+        urls = ['http://one/', os.getcwd(), 'http://two/']
+        ms = MirrorSelector(urls, os.getcwd(), None)
+        ms.record_failure('http://one/')
+        assert ms.get_urls() == [os.getcwd(), 'http://two/', 'http://one/']
+        for u in ('http://one/', 'http://two/'):
+            ms.stats[u] = {'last_probe': time.time()}
+        # Local sources are never probed
+        assert ms.needs_probe() is False
+
+
+class TestSanitize(object):
+
+    def test_order(self):
+        urls = ['http://b.com', 'http://a.com/', 'http://b.com/']
+        assert Client._sanitize_update_url(urls) == ['http://b.com/',
+                                                     'http://a.com/']
@@ -24,9 +24,11 @@
 # ------------------------------------------------------------------------------
 from __future__ import unicode_literals
 
+import hashlib
 import io
 import os
 
+import bsdiff4
 from dsdev_utils.paths import ChDir
 import pytest
 
@@ -34,6 +36,7 @@ from pyupdater import settings
 from pyupdater.package_handler import PackageHandler
 from pyupdater.package_handler.package import Package, Patch, parse_platform
 from pyupdater.utils.config import Config
+from pyupdater.utils.diff_engines import get_engine
 from pyupdater.utils.exceptions import PackageHandlerError
 
 from tconfig import TConfig
@@ -88,6 +91,113 @@ class TestExecution(object):
         p = PackageHandler(config)
         p.process_packages()
 
+    def test_chunk_hashes(self):
+        data_dir = os.getcwd()
+        t_config = TConfig()
+        t_config.DATA_DIR = data_dir
+        t_config.UPDATE_PATCHES = False
+        t_config.UPDATE_CHUNK_SIZE = 1000
+        config = Config()
+        config.from_object(t_config)
+        p = PackageHandler(config)
+        data = os.urandom(2500)
+        with io.open(os.path.join(p.new_dir, 'Acme-mac-0.1.0.tar.gz'),
+                     'wb') as f:
+            f.write(data)
+        p.process_packages()
+        info = p.version_data['updates']['Acme']['0.1.0.2.0']['mac']
+        assert info['chunk_size'] == 1000
+        assert info['chunk_hashes'] == [
+            hashlib.sha256(data[i:i + 1000]).hexdigest()
+            for i in range(0, 2500, 1000)]
+
+    def test_skip_patches(self):
+        data_dir = os.getcwd()
+        t_config = TConfig()
+        t_config.DATA_DIR = data_dir
+        t_config.UPDATE_PATCHES = True
+        t_config.UPDATE_PATCH_BASES = 2
+        config = Config()
+        config.from_object(t_config)
+        releases = [os.urandom(5000)]
+        for i in range(3):
+            releases.append(releases[-1] + os.urandom(100))
+        for i, data in enumerate(releases):
+            p = PackageHandler(config)
+            with io.open(os.path.join(p.new_dir,
+                                      'Acme-mac-0.{}.0.tar.gz'.format(i + 1)),
+                         'wb') as f:
+                f.write(data)
+            p.process_packages()
+
+        updates = p.version_data['updates']['Acme']
+        info = updates['0.4.0.2.0']['mac']
+        assert list(info['patches'].keys()) == ['0.2.0.2.0']
+        skip = info['patches']['0.2.0.2.0']
+        with io.open(os.path.join(p.deploy_dir, skip['patch_name']),
+                     'rb') as f:
+            patch = f.read()
+        assert hashlib.sha256(patch).hexdigest() == skip['patch_hash']
+        assert bsdiff4.patch(releases[1], patch) == releases[3]
+        assert 'patches' not in updates['0.2.0.2.0']['mac']
+        # Only archives needed as bases for the next release are kept
+        assert sorted(os.listdir(p.files_dir)) == ['Acme-mac-0.3.0.tar.gz',
+                                                   'Acme-mac-0.4.0.tar.gz']
+
+    def test_patch_engine(self):
+        data_dir = os.getcwd()
+        t_config = TConfig()
+        t_config.DATA_DIR = data_dir
+        t_config.UPDATE_PATCHES = True
+        t_config.UPDATE_PATCH_ENGINES = [
+            {'engine': 'not-an-engine'},
+            {'engine': 'bsdiff4', 'min_size': 10 ** 9},
+            {'engine': 'xdelta', 'extensions': ['.gz']}]
+        config = Config()
+        config.from_object(t_config)
+        releases = [os.urandom(5000)]
+        releases.append(releases[-1] + os.urandom(100))
+        for i, data in enumerate(releases):
+            p = PackageHandler(config)
+            with io.open(os.path.join(p.new_dir,
+                                      'Acme-mac-0.{}.0.tar.gz'.format(i + 1)),
+                         'wb') as f:
+                f.write(data)
+            p.process_packages()
+
+        info = p.version_data['updates']['Acme']['0.2.0.2.0']['mac']
+        assert info['patch_engine'] == 'xdelta'
+        with io.open(os.path.join(p.deploy_dir, info['patch_name']),
+                     'rb') as f:
+            patch = f.read()
+        assert get_engine('xdelta').patch(releases[0], patch) == releases[1]
+
+    def test_patch_codec(self):
+        data_dir = os.getcwd()
+        t_config = TConfig()
+        t_config.DATA_DIR = data_dir
+        t_config.UPDATE_PATCHES = True
+        t_config.UPDATE_PATCH_CODEC = 'zlib'
+        config = Config()
+        config.from_object(t_config)
+        releases = [os.urandom(5000)]
+        releases.append(releases[-1] + os.urandom(100))
+        for i, data in enumerate(releases):
+            p = PackageHandler(config)
+            with io.open(os.path.join(p.new_dir,
+                                      'Acme-mac-0.{}.0.tar.gz'.format(i + 1)),
+                         'wb') as f:
+                f.write(data)
+            p.process_packages()
+
+        info = p.version_data['updates']['Acme']['0.2.0.2.0']['mac']
+        assert info['patch_format'] == 2
+        assert info['patch_codec'] == 'zlib'
+        with io.open(os.path.join(p.deploy_dir, info['patch_name']),
+                     'rb') as f:
+            patch = f.read()
+        assert get_engine('bsdiff4').patch(releases[0], patch) == releases[1]
+
 
 @pytest.mark.usefixtures('cleandir')
 class TestPackage(object):
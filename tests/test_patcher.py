@@ -24,13 +24,25 @@
 # ------------------------------------------------------------------------------
 from __future__ import unicode_literals, print_function
 
+import hashlib
 import io
 import json
+import mmap
 import os
+import threading
+import time
 
+import bsdiff4
 import pytest
+from dsdev_utils.helpers import Version
 
+from pyupdater.client.costs import CostModel
+from pyupdater.client.downloader import create_http_pool, FileDownloader
 from pyupdater.client.patcher import Patcher
+from pyupdater.client.planner import PatchPlanner
+from pyupdater.client.sizes import SizeProbe
+from pyupdater.utils.diff_engines import get_codec_names, get_engine
+from pyupdater.utils.exceptions import PatcherError
 
 
 def cb(status):
@@ -134,3 +146,493 @@ class TestExecution(object):
         data['progress_hooks'] = [cb]
         p = Patcher(**data)
         assert p.start() is True
+
+
+@pytest.mark.usefixtures("cleandir")
+class TestApplyPatch(object):
+
+    src = b'PyUpdater ' * 1024
+    dst = b'PyUpdated ' * 1024
+
+    def test_buffer(self):
+        patch = memoryview(bytearray(bsdiff4.diff(self.src, self.dst)))
+        assert Patcher._apply_patch(self.src, patch) == self.dst
+
+    def test_mmap(self):
+        with open('patch', 'wb') as f:
+            f.write(bsdiff4.diff(self.src, self.dst))
+        with open('patch', 'rb') as f:
+            patch = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            # Applying twice makes sure the buffer is rewound
+            for _ in range(2):
+                assert Patcher._apply_patch(self.src, patch) == self.dst
+        finally:
+            patch.close()
+
+
+@pytest.mark.usefixtures("cleandir")
+class TestPatchSizes(object):
+
+    @pytest.fixture(autouse=True)
+    def no_plan_cache(self, monkeypatch):
+        # Every test uses the same manifest with different files
+        monkeypatch.setattr(PatchPlanner, '_cache_hash', None)
+
+    def _setup(self, rangeserver, patches, patch_size, full_size):
+        # Manifest made before sizes were added to it
+        versions = {'4.1.0.2.0': {'mac': {'filename': 'Acme-mac-4.1.tar.gz',
+                                          'file_hash': 'hash-4.1'}}}
+        for i in range(2, patches + 2):
+            version = '4.{}.0.2.0'.format(i)
+            name = 'Acme-mac-{}'.format(i)
+            versions[version] = {'mac': {
+                'filename': 'Acme-mac-4.{}.tar.gz'.format(i),
+                'file_hash': 'hash-4.{}'.format(i),
+                'patch_name': name, 'patch_hash': 'patch-{}'.format(i)}}
+            with open(name, 'wb') as f:
+                f.write(b'0' * patch_size)
+        latest = versions[version]['mac']['filename']
+        with open(latest, 'wb') as f:
+            f.write(b'0' * full_size)
+
+        data = update_data.copy()
+        data['update_folder'] = os.getcwd()
+        data['data_dir'] = os.getcwd()
+        data['update_urls'] = [rangeserver.url]
+        data['latest_version'] = version
+        data['json_data'] = {'updates': {'Acme': versions}}
+        return data
+
+    def test_probe_many_small_patches(self, rangeserver):
+        data = self._setup(rangeserver, 6, 10, 10000)
+        p = Patcher(**data)
+        assert p._get_patch_info() is True
+        assert [x['patch_size'] for x in p.patch_data] == [10] * 6
+        assert len(rangeserver.requests) == 7
+
+        # Sizes are saved by hash
+        p = Patcher(**data)
+        assert p._get_patch_info() is True
+        assert len(rangeserver.requests) == 7
+
+    def test_probe_needed_patches(self, rangeserver):
+        data = self._setup(rangeserver, 10, 10, 10000)
+        data['latest_version'] = '4.5.0.2.0'
+        p = Patcher(**data)
+        assert p._get_patch_info() is True
+        assert len(p.patch_data) == 4
+        # The full update & the patches up to latest
+        assert len(rangeserver.requests) == 5
+
+    def test_probe_concurrency(self, rangeserver, monkeypatch):
+        data = self._setup(rangeserver, 6, 10, 10000)
+        state = {'active': 0, 'most': 0}
+        lock = threading.Lock()
+        probe = SizeProbe._probe
+
+        def count_probe(self, *args):
+            with lock:
+                state['active'] += 1
+                state['most'] = max(state['most'], state['active'])
+            time.sleep(0.05)
+            probe(self, *args)
+            with lock:
+                state['active'] -= 1
+
+        monkeypatch.setattr(SizeProbe, '_probe', count_probe)
+        data['http_pool'] = create_http_pool(maxsize=2)
+        p = Patcher(**data)
+        assert p._get_patch_info() is True
+        assert len(p.patch_data) == 6
+        assert state['most'] == 2
+
+    def test_probe_large_patches(self, rangeserver):
+        data = self._setup(rangeserver, 2, 6000, 10000)
+        p = Patcher(**data)
+        assert p._get_patch_info() is False
+
+    def test_probe_failed(self, rangeserver):
+        data = self._setup(rangeserver, 6, 10, 10000)
+        os.remove('Acme-mac-2')
+        p = Patcher(**data)
+        # Falls back to the limit of 4 patches
+        assert p._get_patch_info() is False
+
+
+@pytest.mark.usefixtures("cleandir")
+class TestApplyPatchFile(object):
+
+    @staticmethod
+    def _versions():
+        data = os.urandom(1024 * 64)
+        v2 = data[:1000] + os.urandom(5000) + data[1000:] * 2
+        v3 = v2[7000:] + b'PyUpdater' * 100 + v2[:7000]
+        return data, v2, v3
+
+    @staticmethod
+    def _patcher():
+        data = update_data.copy()
+        data['current_file_hash'] = 'hash-4.1'
+        return Patcher(**data)
+
+    def test_matches_bsdiff4(self):
+        src, dst, _ = self._versions()
+        with open('src', 'wb') as f:
+            f.write(src)
+        patch = bsdiff4.diff(src, dst)
+        p = self._patcher()
+        # Small blocks make sure the patch is applied piece by piece
+        p.BLOCK_SIZE = 1000
+        p._apply_patch_file('src', memoryview(patch), 'dst')
+        with open('dst', 'rb') as f:
+            assert f.read() == bsdiff4.patch(src, patch) == dst
+
+    def test_chained(self):
+        versions = self._versions()
+        with open('v0', 'wb') as f:
+            f.write(versions[0])
+        p = self._patcher()
+        for i in range(1, len(versions)):
+            patch = bsdiff4.diff(versions[i - 1], versions[i])
+            p._apply_patch_file('v{}'.format(i - 1), patch, 'v{}'.format(i))
+        with open('v2', 'rb') as f:
+            assert f.read() == versions[-1]
+
+    def test_corrupt(self):
+        src, dst, _ = self._versions()
+        with open('src', 'wb') as f:
+            f.write(src)
+        patch = bsdiff4.diff(src, dst)
+        p = self._patcher()
+        with pytest.raises(PatcherError):
+            p._apply_patch_file('src', b'NOTBSDIFF' + patch[9:], 'dst')
+        with pytest.raises(PatcherError):
+            p._apply_patch_file('src', patch[:len(patch) // 2], 'dst')
+
+
+def _patch_update(url, versions, engine=None, codec=None):
+    # Patches between every version & the update folder with the first
+    # version. Returns Patcher kwargs to update to the last version.
+    names = ['Acme-mac-4.{}.tar.gz'.format(i + 1)
+             for i in range(len(versions))]
+    manifest = {}
+    for i, data in enumerate(versions):
+        info = {'filename': names[i],
+                'file_hash': hashlib.sha256(data).hexdigest()}
+        if i > 0 and engine is not None:
+            for name, d in (('src', versions[i - 1]), ('dst', data)):
+                with open(name, 'wb') as f:
+                    f.write(d)
+            get_engine(engine).diff('src', 'dst', 'patch', codec=codec)
+            with open('patch', 'rb') as f:
+                patch = f.read()
+            info['patch_engine'] = engine
+            if codec is not None:
+                info['patch_format'] = 2
+                info['patch_codec'] = codec
+        elif i > 0:
+            patch = bsdiff4.diff(versions[i - 1], data)
+        if i > 0:
+            info['patch_name'] = 'Acme-mac-{}'.format(i + 1)
+            info['patch_hash'] = hashlib.sha256(patch).hexdigest()
+            info['patch_size'] = len(patch)
+            with open(info['patch_name'], 'wb') as f:
+                f.write(patch)
+        manifest['4.{}.0.2.0'.format(i + 1)] = {'mac': info}
+    manifest['4.{}.0.2.0'.format(len(versions))]['mac']['file_size'] = 10 ** 9
+    os.mkdir('update')
+    with open(os.path.join('update', names[0]), 'wb') as f:
+        f.write(versions[0])
+
+    data = update_data.copy()
+    data['current_version'] = '4.1.0.2.0'
+    data['current_filename'] = names[0]
+    data['current_file_hash'] = manifest['4.1.0.2.0']['mac']['file_hash']
+    data['latest_version'] = '4.{}.0.2.0'.format(len(versions))
+    data['update_folder'] = os.path.abspath('update')
+    data['update_urls'] = [url]
+    data['progress_hooks'] = []
+    data['json_data'] = {'updates': {'Acme': manifest}}
+    return data
+
+
+@pytest.mark.usefixtures("cleandir")
+class TestPatchFromDisk(object):
+
+    def test_execution(self, rangeserver, monkeypatch):
+        versions = TestApplyPatchFile._versions()
+        data = _patch_update(rangeserver.url, versions)
+        monkeypatch.setattr(Patcher, 'IN_MEMORY_MAX_SIZE', 0)
+        p = Patcher(**data)
+        assert p.start() is True
+        assert p.og_binary is None
+        with open(os.path.join('update', 'Acme-mac-4.3.tar.gz'), 'rb') as f:
+            assert f.read() == versions[-1]
+        # Patches & intermediate files are cleaned up
+        assert sorted(os.listdir('update')) == ['Acme-mac-4.1.tar.gz',
+                                                'Acme-mac-4.3.tar.gz']
+
+
+@pytest.mark.usefixtures("cleandir")
+class TestDiffEngine(object):
+
+    @pytest.mark.parametrize('max_size', [Patcher.IN_MEMORY_MAX_SIZE, 0])
+    def test_xdelta(self, rangeserver, monkeypatch, max_size):
+        versions = TestApplyPatchFile._versions()
+        data = _patch_update(rangeserver.url, versions, engine='xdelta')
+        monkeypatch.setattr(Patcher, 'IN_MEMORY_MAX_SIZE', max_size)
+        p = Patcher(**data)
+        assert p.start() is True
+        assert [x['patch_engine'] for x in p.patch_data] == ['xdelta'] * 2
+        with open(os.path.join('update', 'Acme-mac-4.3.tar.gz'), 'rb') as f:
+            assert f.read() == versions[-1]
+
+    @pytest.mark.parametrize('max_size', [Patcher.IN_MEMORY_MAX_SIZE, 0])
+    @pytest.mark.parametrize('codec', get_codec_names())
+    def test_format2(self, rangeserver, monkeypatch, codec, max_size):
+        versions = TestApplyPatchFile._versions()
+        data = _patch_update(rangeserver.url, versions, engine='bsdiff4',
+                             codec=codec)
+        monkeypatch.setattr(Patcher, 'IN_MEMORY_MAX_SIZE', max_size)
+        p = Patcher(**data)
+        assert p.start() is True
+        with open(os.path.join('update', 'Acme-mac-4.3.tar.gz'), 'rb') as f:
+            assert f.read() == versions[-1]
+
+    def test_unknown_codec(self, rangeserver):
+        versions = TestApplyPatchFile._versions()
+        data = _patch_update(rangeserver.url, versions, engine='bsdiff4',
+                             codec='zlib')
+        manifest = data['json_data']['updates']['Acme']
+        manifest['4.3.0.2.0']['mac']['patch_codec'] = 'not-a-codec'
+        p = Patcher(**data)
+        assert p.start() is False
+
+    def test_unknown_engine(self, rangeserver):
+        versions = TestApplyPatchFile._versions()
+        data = _patch_update(rangeserver.url, versions)
+        manifest = data['json_data']['updates']['Acme']
+        manifest['4.3.0.2.0']['mac']['patch_engine'] = 'not-an-engine'
+        p = Patcher(**data)
+        # Falls back to a full update
+        assert p.start() is False
+
+
+@pytest.mark.usefixtures("cleandir")
+class TestPipeline(object):
+
+    @staticmethod
+    def _versions(count):
+        versions = [os.urandom(1024 * 16)]
+        for i in range(count):
+            versions.append(versions[-1] + os.urandom(1024))
+        return versions
+
+    def test_apply_while_downloading(self, rangeserver, monkeypatch):
+        events = []
+        download = FileDownloader.download_verify_buffer
+        apply_patch = Patcher._apply_patch
+
+        def slow_download(fd):
+            time.sleep(0.2)
+            data = download(fd)
+            events.append(('downloaded', fd.filename))
+            return data
+
+        def record_apply(src, patch):
+            events.append(('applied', None))
+            return apply_patch(src, patch)
+
+        monkeypatch.setattr(FileDownloader, 'download_verify_buffer',
+                            slow_download)
+        monkeypatch.setattr(Patcher, '_apply_patch',
+                            staticmethod(record_apply))
+        statuses = []
+        versions = self._versions(4)
+        data = _patch_update(rangeserver.url, versions)
+        data['patch_downloads'] = 2
+        data['progress_hooks'] = [lambda s: statuses.append(s)]
+        p = Patcher(**data)
+        assert p.start() is True
+        with open(os.path.join('update', 'Acme-mac-4.5.tar.gz'), 'rb') as f:
+            assert f.read() == versions[-1]
+
+        # The first patch was applied before the last one downloaded
+        assert events.index(('applied', None)) < len(events) - 1
+        assert events[-1] == ('applied', None)
+        assert [s['downloaded'] for s in statuses] == [1, 2, 3, 4, 4]
+        assert statuses[-1]['status'] == 'finished'
+
+    def test_failed_download(self, rangeserver):
+        versions = self._versions(4)
+        data = _patch_update(rangeserver.url, versions)
+        os.remove('Acme-mac-3')
+        statuses = []
+        data['patch_downloads'] = 2
+        data['progress_hooks'] = [lambda s: statuses.append(s)]
+        p = Patcher(**data)
+        assert p.start() is False
+        assert statuses[-1]['status'] == 'failed to download all patches'
+        # Downloaded patches are removed
+        assert os.listdir('update') == ['Acme-mac-4.1.tar.gz']
+
+    def test_cancel(self, rangeserver):
+        versions = self._versions(4)
+        data = _patch_update(rangeserver.url, versions)
+        data['cancel_event'] = threading.Event()
+        data['cancel_event'].set()
+        p = Patcher(**data)
+        assert p.start() is False
+        # The current archive is untouched & temp files are removed
+        assert os.listdir('update') == ['Acme-mac-4.1.tar.gz']
+
+
+class TestPatchPlanner(object):
+
+    @staticmethod
+    def _versions(count, patch_size, skip_patches=None, file_size=None):
+        versions = {'4.1.0.2.0': {'mac': {'filename': 'Acme-mac-4.1.tar.gz',
+                                          'file_hash': 'hash-4.1'}}}
+        for i in range(2, count + 1):
+            versions['4.{}.0.2.0'.format(i)] = {'mac': {
+                'filename': 'Acme-mac-4.{}.tar.gz'.format(i),
+                'file_hash': 'hash-4.{}'.format(i),
+                'file_size': file_size,
+                'patch_name': 'Acme-mac-{}'.format(i),
+                'patch_hash': 'patch-{}'.format(i),
+                'patch_size': patch_size}}
+        for base, target, size in skip_patches or []:
+            info = versions['4.{}.0.2.0'.format(target)]['mac']
+            info.setdefault('patches', {})['4.{}.0.2.0'.format(base)] = {
+                'patch_name': 'Acme-mac-{}-{}'.format(base, target),
+                'patch_hash': 'patch-{}-{}'.format(base, target),
+                'patch_size': size}
+        return versions
+
+    @staticmethod
+    def _plan(versions, latest, full_size, **kwargs):
+        planner = PatchPlanner(versions, 'mac')
+        plan = planner.plan(Version('4.1.0.2.0'),
+                            Version('4.{}.0.2.0'.format(latest)),
+                            full_size, **kwargs)
+        return [p['patch_name'] for p in plan]
+
+    def test_chain(self):
+        versions = self._versions(5, 100)
+        assert self._plan(versions, 5, 1000) == ['Acme-mac-2', 'Acme-mac-3',
+                                                 'Acme-mac-4', 'Acme-mac-5']
+
+    def test_skip_patch(self):
+        versions = self._versions(5, 100, [(1, 5, 150), (1, 3, 250)])
+        assert self._plan(versions, 5, 1000) == ['Acme-mac-1-5']
+        # Two chain patches are smaller than the skip patch
+        assert self._plan(versions, 3, 1000) == ['Acme-mac-2', 'Acme-mac-3']
+
+    def test_mixed_path(self):
+        versions = self._versions(5, 100, [(1, 3, 50), (2, 5, 300)])
+        assert self._plan(versions, 5, 1000) == ['Acme-mac-1-3', 'Acme-mac-4',
+                                                 'Acme-mac-5']
+
+    def test_full_update_smaller(self):
+        versions = self._versions(5, 100, [(1, 5, 150)])
+        assert self._plan(versions, 5, 150) == []
+
+    def test_full_update_smaller_than_sized_path(self):
+        # The unsized skip patch doesn't undo the sized comparison
+        versions = self._versions(5, 100, [(1, 3, None)])
+        assert self._plan(versions, 5, 300) == []
+        # Without a sized path the fewest patches are used
+        versions = self._versions(5, None, [(1, 3, 100)])
+        assert self._plan(versions, 5, 300) == ['Acme-mac-1-3', 'Acme-mac-4',
+                                                'Acme-mac-5']
+
+    def test_cached_by_manifest(self):
+        calls = []
+
+        def get_sizes(files):
+            calls.append(files)
+            return dict((f[1], 10) for f in files)
+
+        versions = self._versions(3, None)
+        for _ in range(2):
+            assert self._plan(versions, 3, 1000, get_sizes=get_sizes,
+                              manifest_hash='a') == ['Acme-mac-2',
+                                                     'Acme-mac-3']
+        assert len(calls) == 1
+        self._plan(versions, 3, 1000, get_sizes=get_sizes,
+                   manifest_hash='b')
+        assert len(calls) == 2
+
+    @pytest.mark.usefixtures("cleandir")
+    def test_cost_model(self):
+        versions = self._versions(3, 100 * 1024, file_size=3000 * 1024)
+        costs = CostModel(os.getcwd())
+        costs.stats['download_rate'] = 1000 * 1024
+        # Patching is 10 times slower than downloading
+        costs.stats['apply_rate'] = 100 * 1024
+        assert self._plan(versions, 3, 3000 * 1024, cost_model=costs) == []
+
+        costs.stats['apply_rate'] = 100000 * 1024
+        assert self._plan(versions, 3, 3000 * 1024,
+                          cost_model=costs) == ['Acme-mac-2', 'Acme-mac-3']
+
+        # Without a measured download speed the fewest bytes win
+        costs.stats['apply_rate'] = 100 * 1024
+        del costs.stats['download_rate']
+        assert self._plan(versions, 3, 3000 * 1024,
+                          cost_model=costs) == ['Acme-mac-2', 'Acme-mac-3']
+
+
+@pytest.mark.usefixtures("cleandir")
+class TestCostModel(object):
+
+    def test_rates(self):
+        costs = CostModel(os.getcwd())
+        assert costs.estimate(1024) is None
+        # Small downloads mostly measure latency
+        costs.record_download(1024, 10.0)
+        assert costs.download_rate is None
+
+        costs.record_download(1024 * 1024, 1024 * 1024.0)
+        costs.record_apply(1024 * 1024, 0.5)
+        costs.save()
+
+        costs = CostModel(os.getcwd())
+        assert costs.download_rate == 1024 * 1024
+        assert costs.apply_rate == 2 * 1024 * 1024
+        assert costs.estimate(1024 * 1024, 1024 * 1024) == 1.5
+
+    def test_calibrate(self):
+        costs = CostModel(os.getcwd())
+        assert costs.apply_rate > 0
+        assert CostModel(os.getcwd()).stats.get('apply_rate') > 0
+
+    def test_download_throughput(self, rangeserver):
+        with open('file', 'wb') as f:
+            f.write(os.urandom(256 * 1024))
+        fd = FileDownloader('file', [rangeserver.url])
+        assert fd.download_verify_return() is not None
+        assert fd.throughput > 0
+
+
+@pytest.mark.usefixtures("cleandir")
+class TestSkipPatchUpdate(object):
+
+    def test_execution(self, rangeserver):
+        versions = TestPipeline._versions(4)
+        data = _patch_update(rangeserver.url, versions)
+        patch = bsdiff4.diff(versions[0], versions[-1])
+        with open('Acme-mac-1-5', 'wb') as f:
+            f.write(patch)
+        latest = data['json_data']['updates']['Acme']['4.5.0.2.0']['mac']
+        latest['patches'] = {'4.1.0.2.0': {
+            'patch_name': 'Acme-mac-1-5',
+            'patch_hash': hashlib.sha256(patch).hexdigest(),
+            'patch_size': len(patch)}}
+        p = Patcher(**data)
+        assert p.start() is True
+        with open(os.path.join('update', 'Acme-mac-4.5.tar.gz'), 'rb') as f:
+            assert f.read() == versions[-1]
+        # Only the skip patch was downloaded
+        assert len(rangeserver.requests) == 1
@@ -0,0 +1,146 @@
+# ------------------------------------------------------------------------------
+# Copyright (c) 2015-2017 Digital Sapphire
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the
+# following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF
+# ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+# TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR
+# ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE
+# OR OTHER DEALINGS IN THE SOFTWARE.
+# ------------------------------------------------------------------------------
+from __future__ import unicode_literals
+
+import hashlib
+import os
+import threading
+import time
+
+import pytest
+
+from pyupdater.client.downloader import FileDownloader
+from pyupdater.client.progress import ProgressReporter
+
+
+class TestProgressReporter(object):
+
+    def test_interval(self):
+        events = []
+        progress = ProgressReporter([events.append], total=1000,
+                                    interval=60, step=None)
+        for i in range(1000):
+            progress.update(i)
+        progress.flush(5)
+        progress.finish(1000)
+        assert progress.flush(5) is True
+        assert [e['status'] for e in events] == ['downloading', 'finished']
+
+    def test_step(self):
+        events = []
+        progress = ProgressReporter([events.append], total=1000,
+                                    interval=60, step=10)
+        for i in range(1001):
+            progress.update(i)
+            # Waiting keeps events from being coalesced by the reporter
+            progress.flush(5)
+        assert len(events) == 11
+
+    def test_numeric_fields(self):
+        events = []
+        progress = ProgressReporter([events.append], total=200, start=100)
+        time.sleep(0.01)
+        progress.finish(200)
+        progress.flush(5)
+        status = events[-1]
+        assert status['percent'] == 100.0
+        assert status['percent_complete'] == '100.0'
+        assert status['eta'] == 0
+        assert status['rate'] > 0
+
+    def test_unknown_total(self):
+        events = []
+        progress = ProgressReporter([events.append])
+        progress.update(100)
+        progress.flush(5)
+        assert events[0]['percent'] is None
+        assert events[0]['percent_complete'] == '-.-%'
+        assert events[0]['time'] == '--:--'
+
+    def test_slow_hook(self):
+        events = []
+
+        def slow(status):
+            time.sleep(0.2)
+            events.append(status)
+
+        progress = ProgressReporter([slow], total=1000, interval=0)
+        start = time.time()
+        for i in range(1000):
+            progress.update(i)
+        progress.finish(1000)
+        assert time.time() - start < 0.2
+        assert progress.flush(5) is True
+        # Statuses queued behind the slow hook are dropped
+        assert len(events) < 5
+        assert events[-1]['status'] == 'finished'
+
+    def test_blocking_hook(self):
+        release = threading.Event()
+        blocked = ProgressReporter([lambda s: release.wait(5)])
+        blocked.finish(100)
+        events = []
+        progress = ProgressReporter([events.append])
+        progress.finish(100)
+        # Other reporters aren't held up
+        assert progress.flush(5) is True
+        assert len(events) == 1
+        assert blocked.flush(0.1) is False
+        release.set()
+        assert blocked.flush(5) is True
+
+    def test_report(self):
+        events = []
+        progress = ProgressReporter([events.append])
+        for i in range(10):
+            progress.report({'downloaded': i})
+        assert progress.flush(5) is True
+        # Reports are never coalesced
+        assert [e['downloaded'] for e in events] == list(range(10))
+
+
+@pytest.mark.usefixtures("cleandir")
+class TestDownloadProgress(object):
+
+    filename = 'progress.bin'
+    data = os.urandom(1024 * 256)
+    file_hash = hashlib.sha256(data).hexdigest()
+
+    @pytest.mark.parametrize('segments', [1, 4])
+    def test_download(self, rangeserver, segments):
+        with open(self.filename, 'wb') as f:
+            f.write(self.data)
+        os.mkdir('client')
+        os.chdir('client')
+        events = []
+        fd = FileDownloader(self.filename, [rangeserver.url], self.file_hash,
+                            progress_hooks=[events.append], segments=segments)
+        fd.block_size = 1024
+        fd.min_segment_size = 1024 * 16
+        assert fd.download_verify_write() is True
+        # Final event is delivered before the download returns
+        assert events[-1]['status'] == 'finished'
+        assert events[-1]['downloaded'] == len(self.data)
+        assert len(events) <= 102
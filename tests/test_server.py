@@ -0,0 +1,226 @@
+# ------------------------------------------------------------------------------
+# Copyright (c) 2015-2017 Digital Sapphire
+#
+# Permission is hereby granted, free of charge, to any person obtaining
+# a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction, including
+# without limitation the rights to use, copy, modify, merge, publish,
+# distribute, sublicense, and/or sell copies of the Software, and to permit
+# persons to whom the Software is furnished to do so, subject to the
+# following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF
+# ANY KIND, EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED
+# TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT
+# SHALL THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR
+# ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE
+# OR OTHER DEALINGS IN THE SOFTWARE.
+# ------------------------------------------------------------------------------
+from __future__ import unicode_literals
+
+import gzip
+import hashlib
+import json
+import os
+
+import pytest
+from six.moves import http_client
+
+from pyupdater.client.downloader import create_http_pool, FileDownloader
+from pyupdater.server import UpdateServer
+
+
+DATA = os.urandom(1024 * 256)
+DATA_HASH = hashlib.sha256(DATA).hexdigest()
+FILENAME = 'Acme-mac-0.2.0.tar.gz'
+PATCH_NAME = 'Acme-mac-3'
+
+
+def _write_deploy(folder, manifest_hash=DATA_HASH, patch_hash=DATA_HASH):
+    if not os.path.exists(folder):
+        os.mkdir(folder)
+    for name in (FILENAME, PATCH_NAME):
+        with open(os.path.join(folder, name), 'wb') as f:
+            f.write(DATA)
+    # Skip patch from 0.1.0
+    patches = {'0.1.0.2.0': {'patch_name': PATCH_NAME,
+                             'patch_hash': patch_hash}}
+    manifest = {'updates': {'Acme': {'0.2.0.2.0': {'mac': {
+        'filename': FILENAME, 'file_hash': manifest_hash,
+        'patches': patches}}}}}
+    with gzip.open(os.path.join(folder, 'versions.gz'), 'wb') as f:
+        f.write(json.dumps(manifest).encode('utf-8'))
+
+
+@pytest.fixture
+def server():
+    _write_deploy('deploy')
+    servers = []
+
+    def make(root='deploy', **kwargs):
+        servers.append(UpdateServer(root, host='127.0.0.1', port=0,
+                                    **kwargs))
+        servers[-1].start()
+        return servers[-1]
+    yield make
+    for s in servers:
+        s.stop()
+
+
+@pytest.mark.usefixtures("cleandir")
+class TestUpdateServer(object):
+
+    def _get(self, url, **headers):
+        return create_http_pool(secure=False).request(
+            'GET', url + FILENAME, headers=headers, retries=False)
+
+    def test_get(self, server):
+        s = server()
+        r = self._get(s.url)
+        assert r.status == 200
+        assert r.data == DATA
+        assert r.headers['ETag'] == '"{}"'.format(DATA_HASH)
+        assert r.headers['Accept-Ranges'] == 'bytes'
+
+    def test_not_found(self, server):
+        s = server()
+        pool = create_http_pool(secure=False)
+        assert pool.request('GET', s.url + 'missing').status == 404
+        assert pool.request('GET', s.url + '..%2Fdeploy%2F' +
+                            FILENAME).status == 404
+
+    def test_ranges(self, server):
+        s = server()
+        r = self._get(s.url, Range='bytes=100-199')
+        assert r.status == 206
+        assert r.data == DATA[100:200]
+        assert r.headers['Content-Range'] == 'bytes 100-199/{}'.format(
+            len(DATA))
+        assert self._get(s.url, Range='bytes=-10').data == DATA[-10:]
+        assert self._get(s.url, Range='bytes=1000-').data == DATA[1000:]
+        r = self._get(s.url, Range='bytes={}-'.format(len(DATA)))
+        assert r.status == 416
+        # Malformed ranges get the full file
+        assert self._get(s.url, Range='bytes=a-b').status == 200
+        # The file changed since the client got the rest of it
+        r = self._get(s.url, Range='bytes=10-', **{'If-Range': '"other"'})
+        assert r.status == 200
+
+    def test_skip_patch_etag(self, server):
+        s = server()
+        _write_deploy('deploy', patch_hash='a' * 64)
+        r = create_http_pool(secure=False).request('GET', s.url + PATCH_NAME)
+        # Taken from the manifest
+        assert r.headers['ETag'] == '"{}"'.format('a' * 64)
+
+    def test_etag(self, server):
+        s = server()
+        etag = '"{}"'.format(DATA_HASH)
+        r = self._get(s.url, **{'If-None-Match': etag})
+        assert r.status == 304
+        # Files missing from the manifest are hashed
+        r = create_http_pool(secure=False).request('GET',
+                                                   s.url + 'versions.gz')
+        with open(os.path.join('deploy', 'versions.gz'), 'rb') as f:
+            data = f.read()
+        assert r.headers['ETag'] == '"{}"'.format(
+            hashlib.sha256(data).hexdigest())
+
+    def test_keep_alive(self, server):
+        s = server()
+        host, port = s.url[len('http://'):].strip('/').split(':')
+        conn = http_client.HTTPConnection(host, int(port))
+        for _ in range(2):
+            conn.request('GET', '/' + FILENAME)
+            r = conn.getresponse()
+            assert r.read() == DATA
+        assert r.getheader('Connection') != 'close'
+        conn.close()
+
+    def test_client_download(self, server):
+        s = server()
+        os.mkdir('client')
+        os.chdir('client')
+        fd = FileDownloader(FILENAME, [s.url], DATA_HASH, segments=4)
+        fd.min_segment_size = 1024
+        assert fd.download_verify_return() == DATA
+
+
+@pytest.mark.usefixtures("cleandir")
+class TestProxy(object):
+
+    def test_proxy(self, server, rangeserver):
+        _write_deploy('origin')
+        rangeserver.root = os.path.abspath('origin')
+        s = server('cache', origin=[rangeserver.url])
+        pool = create_http_pool(secure=False)
+        assert pool.request('GET', s.url + 'versions.gz').status == 200
+        assert pool.request('GET', s.url + FILENAME).data == DATA
+        # Served from the cache from now on
+        count = len(rangeserver.requests)
+        assert pool.request('GET', s.url + FILENAME).data == DATA
+        assert len(rangeserver.requests) == count
+        assert os.path.exists(os.path.join('cache', FILENAME))
+        assert pool.request('GET', s.url + 'missing').status == 404
+
+    def test_manifest_revalidated(self, server, rangeserver):
+        _write_deploy('origin')
+        rangeserver.root = os.path.abspath('origin')
+        s = server('cache', origin=[rangeserver.url], manifest_ttl=0)
+        pool = create_http_pool(secure=False)
+        for _ in range(2):
+            r = pool.request('GET', s.url + 'versions.gz')
+            assert r.status == 200
+        # Second request was a conditional request answered with a 304
+        assert 'If-None-Match' in rangeserver.requests[-1]
+
+    def test_bad_origin_copy(self, server, rangeserver):
+        _write_deploy('origin', manifest_hash='bad')
+        rangeserver.root = os.path.abspath('origin')
+        s = server('cache', origin=[rangeserver.url])
+        pool = create_http_pool(secure=False)
+        pool.request('GET', s.url + 'versions.gz')
+        assert pool.request('GET', s.url + FILENAME).status == 404
+        assert os.listdir('cache') == ['versions.gz']
+
+    def test_unverified_refetched(self, server, rangeserver):
+        _write_deploy('origin')
+        with open(os.path.join('origin', 'extra'), 'wb') as f:
+            f.write(b'partial')
+        rangeserver.root = os.path.abspath('origin')
+        s = server('cache', origin=[rangeserver.url], manifest_ttl=0)
+        pool = create_http_pool(secure=False)
+        assert pool.request('GET', s.url + 'extra').data == b'partial'
+        with open(os.path.join('origin', 'extra'), 'wb') as f:
+            f.write(b'complete')
+        # Files missing from the manifest aren't cached for good
+        assert pool.request('GET', s.url + 'extra').data == b'complete'
+
+    def test_head(self, server, rangeserver):
+        _write_deploy('origin')
+        rangeserver.root = os.path.abspath('origin')
+        s = server('cache', origin=[rangeserver.url])
+        pool = create_http_pool(secure=False)
+        pool.request('GET', s.url + 'versions.gz')
+        r = pool.request('HEAD', s.url + FILENAME)
+        assert r.status == 200
+        assert r.headers['Content-Length'] == str(len(DATA))
+        assert r.headers['ETag'] == '"{}"'.format(DATA_HASH)
+        # Answered without downloading the file
+        assert FILENAME not in os.listdir('cache')
+        assert pool.request('HEAD', s.url + 'missing').status == 404
+
+    def test_skip_patch_verified(self, server, rangeserver):
+        _write_deploy('origin', patch_hash='bad')
+        rangeserver.root = os.path.abspath('origin')
+        s = server('cache', origin=[rangeserver.url])
+        pool = create_http_pool(secure=False)
+        pool.request('GET', s.url + 'versions.gz')
+        assert pool.request('GET', s.url + PATCH_NAME).status == 404
+        assert pool.request('GET', s.url + FILENAME).status == 200
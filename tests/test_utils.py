@@ -34,6 +34,8 @@ from pyupdater.utils import (check_repo,
                              make_archive,
                              remove_dot_files,
                              )
+from pyupdater.utils.diff_engines import (Bsdiff4Engine, get_codec_names,
+                                          get_engine, get_engine_names)
 
 
 @pytest.mark.usefixtures('cleandir')
@@ -82,3 +84,73 @@ class TestUtils1(object):
         good_list = ['test', 'stuff']
         for n in remove_dot_files(bad_list):
             assert n in good_list
+
+
+@pytest.mark.usefixtures('cleandir')
+class TestDiffEngines(object):
+
+    @staticmethod
+    def _files():
+        src = os.urandom(1024 * 64)
+        dst = (src[:1000] + os.urandom(500) + src[1000:40000] +
+               src[50000:] + os.urandom(100))
+        for name, data in (('src', src), ('dst', dst)):
+            with io.open(name, 'wb') as f:
+                f.write(data)
+        return src, dst
+
+    @pytest.mark.parametrize('name', get_engine_names())
+    def test_round_trip(self, name):
+        src, dst = self._files()
+        engine = get_engine(name)
+        engine.diff('src', 'dst', 'patch')
+        with io.open('patch', 'rb') as f:
+            patch = f.read()
+        assert len(patch) < len(dst) // 2
+        assert engine.patch(src, patch) == dst
+        engine.patch_file('src', patch, 'out')
+        with io.open('out', 'rb') as f:
+            assert f.read() == dst
+
+    @pytest.mark.parametrize('codec', get_codec_names() + ['auto'])
+    def test_bsdiff4_format2(self, codec):
+        src, dst = self._files()
+        engine = get_engine('bsdiff4')
+        used = engine.diff('src', 'dst', 'patch', codec=codec)
+        assert used in get_codec_names()
+        if codec != 'auto':
+            assert used == codec
+        with io.open('patch', 'rb') as f:
+            patch = f.read()
+        assert Bsdiff4Engine.read_header(patch)[0] == used
+        assert engine.patch(src, patch) == dst
+
+    def test_xdelta_many_instructions(self):
+        # Instructions span the pieces the patch is decompressed in
+        src = os.urandom(1024 * 1024 * 2)
+        dst = bytearray(src)
+        for i in range(0, len(dst), 1000):
+            dst[i:i + 10] = os.urandom(10)
+        for name, data in (('src', src), ('dst', dst)):
+            with io.open(name, 'wb') as f:
+                f.write(data)
+        engine = get_engine('xdelta')
+        engine.diff('src', 'dst', 'patch')
+        with io.open('patch', 'rb') as f:
+            patch = f.read()
+        assert engine.patch(src, patch) == dst
+
+    def test_xdelta_corrupt(self):
+        src, _ = self._files()
+        engine = get_engine('xdelta')
+        engine.diff('src', 'dst', 'patch')
+        with io.open('patch', 'rb') as f:
+            patch = f.read()
+        with pytest.raises(ValueError):
+            engine.patch(src, b'NOTXDLT1' + patch[8:])
+        with pytest.raises(ValueError):
+            engine.patch(src, patch[:len(patch) // 2])
+
+    def test_unknown(self):
+        assert get_engine('not-an-engine') is None
+        assert get_engine(None).name == 'bsdiff4'